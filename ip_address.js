@@ -0,0 +1,3 @@
+// Dynamically generated js file for IP address
+const ip_address = '192.0.2.2';
+const port = '9812';
@@ -27,14 +27,19 @@ stream audio to Chromecast Audio
 
 
 import argparse
+import atexit
 import datetime
 import logging
+import logging.handlers
 import mutagen.easyid3  # python -m pip install mutagen
 import mutagen.id3      # python -m pip install mutagen
 import os
 import pathlib
 import pychromecast     # python -m pip install PyChromecast
+import queue
 import random
+import re
+import signal
 import socket
 import subprocess
 import threading
@@ -70,17 +75,78 @@ logging_formatter = logging.Formatter(
         datefmt='%m/%d %H:%M:%S',
         )
 
+class RepeatedMessageFilter(logging.Filter):
+    """ rate limits repeated identical warnings (and errors)
+        - messages are considered identical if they only differ in their numbers
+          (e.g. "...update_status()!: 17" and "...update_status()!: 18")
+        - within each period, the first `burst` of identical messages are passed,
+          the rest are dropped and counted in a summary passed with the next one
+          allowed through
+    """
+    def __init__(self, burst=5, period=10):
+        super().__init__()
+        self.burst = burst
+        self.period = period
+        self.lock = threading.Lock()
+        self.seen = {}  # key -> [period start time, count in period, suppressed]
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING:
+            return True
+        key = (record.levelno, re.sub(r'\d+', '#', record.getMessage()))
+        now = time.time()
+        with self.lock:
+            entry = self.seen.get(key)
+            if entry is None or now - entry[0] >= self.period:
+                suppressed = entry[2] if entry else 0
+                self.seen[key] = [now, 1, 0]
+                if len(self.seen) > 1000:   # forget old messages
+                    self.seen = {k: v for k, v in self.seen.items() if now - v[0] < self.period}
+            else:
+                entry[1] += 1
+                if entry[1] > self.burst:
+                    entry[2] += 1
+                    return False
+                suppressed = 0
+        if suppressed:
+            record.msg = "%s  [%d similar messages suppressed]" % (record.getMessage(), suppressed)
+            record.args = None
+        return True
+
 # log to file
-logging_fh = logging.FileHandler('s2c.log', mode='w')
+# - via a queue, so that callers (including the pychromecast socket thread) never
+#   wait on file I/O -- the background QueueListener thread does the writing
+# - appends (so the log from before a restart isn't lost) and rotates by size
+# - child processes (media processes, the benchmark's server) are given their
+#   own file via S2C_LOG, as rotation isn't safe with several processes writing
+LOG_FILE_ENV = "S2C_LOG"
+logging_fh = logging.handlers.RotatingFileHandler(os.environ.get(LOG_FILE_ENV, 's2c.log'), mode='a',
+        maxBytes=5 * 1024 * 1024, backupCount=3)
 logging_fh.setFormatter(logging_formatter)
 logging_fh.setLevel(logging.INFO)
-logger.addHandler(logging_fh)
+
+logging_queue = queue.Queue(-1)
+logging_qh = logging.handlers.QueueHandler(logging_queue)
+logging_qh.addFilter(RepeatedMessageFilter())
 
 # log warnings to console screen
 logging_ch = logging.StreamHandler()
 logging_ch.setFormatter(logging_formatter)
 logging_ch.setLevel(logging.WARN)
-#logger.addHandler(logging_ch)
+
+logging_listener = logging.handlers.QueueListener(logging_queue,
+        logging_fh,
+        #logging_ch,
+        respect_handler_level=True)
+
+# process pool workers (see pool_context()) re-import this script as
+# __mp_main__, they don't log to the file or rewrite ip_address.js
+IS_POOL_WORKER = __name__ == '__mp_main__'
+
+if not IS_POOL_WORKER:
+    logger.addHandler(logging_qh)
+    logging_listener.start()
+    atexit.register(logging_listener.stop)    # flush queued records on exit
 
 
 # helpers
@@ -134,10 +200,15 @@ def get_ip_address():
     return ip_address
 
 IP_ADDRESS = get_ip_address()
-with open("ip_address.js", "w") as js_file:
-    js_file.write("// Dynamically generated js file for IP address\n")
-    js_file.write("const ip_address = '%s';\n" % IP_ADDRESS)
-    js_file.write("const port = '%d';\n" % PORT)
+
+def write_ip_address_js():
+    with open("ip_address.js", "w") as js_file:
+        js_file.write("// Dynamically generated js file for IP address\n")
+        js_file.write("const ip_address = '%s';\n" % IP_ADDRESS)
+        js_file.write("const port = '%d';\n" % PORT)
+
+if not IS_POOL_WORKER:
+    write_ip_address_js()
 
 def to_min_sec(seconds, resolution="seconds"):
     """ convert floating pt seconds value to mm:ss.xx or mm:ss.x or mm:ss
@@ -172,10 +243,1676 @@ def _clear_line2():
     print("\r" + " " * 120 + "\r", end='')
 
 
+# Metrics
+#
+# Always-on counters, gauges and latency histograms, served in Prometheus text
+# format at /metrics. Recording is a dict lookup and a couple of additions
+# under one lock, so it's cheap enough for the hot paths (http handlers,
+# device calls, status callbacks).
+
+import bisect
+import contextlib
+
+class Metrics():  # {
+    """ Thread-safe metrics registry
+        - labels are passed as tuple of (name, value) pairs, e.g. (('path', 'media'),)
+    """
+    LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.types = {}         # name -> (type, help)
+        self.values = {}        # (name, labels) -> counter/gauge value
+        self.histograms = {}    # (name, labels) -> [bucket counts..., sum, count]
+
+    def describe(self, name, metric_type, help_text):
+        self.types[name] = (metric_type, help_text)
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, labels=(), value=0):
+        with self.lock:
+            self.values[(name, labels)] = value
+
+    def observe(self, name, labels, seconds):
+        key = (name, labels)
+        i = bisect.bisect_left(self.LATENCY_BUCKETS, seconds)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [0] * (len(self.LATENCY_BUCKETS) + 3)
+            hist[i] += 1    # last bucket (+Inf) at index len(LATENCY_BUCKETS)
+            hist[-2] += seconds
+            hist[-1] += 1
+
+    @contextlib.contextmanager
+    def time(self, name, labels=()):
+        """ observe duration of with-block
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, labels, time.perf_counter() - start)
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        labels = labels + extra
+        if not labels:
+            return ""
+        return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                for k, v in labels)
+
+    def render(self):
+        """ returns metrics in Prometheus text exposition format
+        """
+        with self.lock:
+            values = sorted(self.values.items())
+            histograms = sorted((key, list(hist)) for key, hist in self.histograms.items())
+        lines = []
+        described = set()
+        def describe(name, default_type):
+            if name not in described:
+                described.add(name)
+                metric_type, help_text = self.types.get(name, (default_type, ""))
+                if help_text:
+                    lines.append("# HELP %s %s" % (name, help_text))
+                lines.append("# TYPE %s %s" % (name, metric_type))
+
+        for (name, labels), value in values:
+            describe(name, 'counter' if name.endswith('_total') else 'gauge')
+            lines.append("%s%s %s" % (name, self._format_labels(labels), value))
+        for (name, labels), hist in histograms:
+            describe(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip(self.LATENCY_BUCKETS + ("+Inf",), hist):
+                cumulative += count
+                lines.append("%s_bucket%s %d" % (name, self._format_labels(labels, (('le', bound),)), cumulative))
+            lines.append("%s_sum%s %f" % (name, self._format_labels(labels), hist[-2]))
+            lines.append("%s_count%s %d" % (name, self._format_labels(labels), hist[-1]))
+        return "\n".join(lines) + "\n"
+# } ## class Metrics():
+
+
+theMetrics = Metrics()      # global singleton
+theMetrics.describe('s2c_http_requests_total', 'counter', "HTTP requests by method and path/command")
+theMetrics.describe('s2c_http_request_duration_seconds', 'histogram', "HTTP request handling time, including transfer")
+theMetrics.describe('s2c_http_bytes_served_total', 'counter', "HTTP response bytes by path/command")
+theMetrics.describe('s2c_http_active_connections', 'gauge', "HTTP requests currently being handled")
+theMetrics.describe('s2c_device_call_duration_seconds', 'histogram', "Round-trip time of calls to the Chromecast")
+theMetrics.describe('s2c_device_exceptions_total', 'counter', "Exceptions from calls to the Chromecast")
+theMetrics.describe('s2c_lock_wait_seconds', 'histogram', "Time waiting to acquire lock")
+
+
+class TimedRLock():  # {
+    """ threading.RLock that records acquire wait times in theMetrics
+    """
+    def __init__(self, name):
+        self._lock = threading.RLock()
+        self.labels = (('lock', name),)
+
+    def acquire(self, blocking=True, timeout=-1):
+        start = time.perf_counter()
+        acquired = self._lock.acquire(blocking, timeout)
+        theMetrics.observe('s2c_lock_wait_seconds', self.labels, time.perf_counter() - start)
+        return acquired
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
+# } ## class TimedRLock():
+
+
 # globals, overwrite these with proper values
 PLAYLIST_FOLDER = None
 SERVER_DIRECTORY = None
 WEB_PAGE_REL_PATH = None
+FAKE_DEVICES = 0            # number of FakeChromecast devices to use instead of discovery
+FAKE_DEVICE_SPEED = 1.0
+
+
+# Play history
+#
+# Persistent record of what was played, stored in SQLite so that it survives
+# restarts (unlike s2c.log which is truncated on each start).
+# - one row per event: 'start' (track sent to device), 'end' (track played to
+#   completion) or 'skip' (track replaced/stopped before it finished)
+# - events are queued in memory and written in batches from a background
+#   thread, so callers (pychromecast callback thread, http handler threads)
+#   never wait on SD-card I/O
+# - statistics queries are served from the (event, ts, ...) covering index,
+#   so they only touch the rows within the requested time range
+# - also keeps the analyzed loudness gains (keyed by path, size and mtime), so
+#   tracks without ReplayGain tags are only decoded once, see "Loudness"
+
+import json
+import sqlite3
+import urllib.parse
+
+class PlayHistory():  # {
+    """ Play-history store with batched writes and indexed statistics queries
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS events (
+            ts      REAL NOT NULL,
+            event   TEXT NOT NULL,
+            device  TEXT NOT NULL DEFAULT '',
+            path    TEXT NOT NULL DEFAULT '',
+            artist  TEXT NOT NULL DEFAULT '',
+            title   TEXT NOT NULL DEFAULT '',
+            album   TEXT NOT NULL DEFAULT ''
+        );
+        CREATE INDEX IF NOT EXISTS events_event_ts ON events(event, ts, artist, title);
+        CREATE INDEX IF NOT EXISTS events_ts ON events(ts);
+        CREATE TABLE IF NOT EXISTS gains (
+            path    TEXT PRIMARY KEY,
+            size    INTEGER NOT NULL,
+            mtime   REAL NOT NULL,
+            gain    REAL NOT NULL
+        );
+    """
+    EVENTS = ('start', 'end', 'skip')
+    FLUSH_INTERVAL = 5      # seconds between writes
+    FLUSH_BATCH = 50        # write early once this many events are queued
+
+    def __init__(self, db_filename):
+        self.db_filename = db_filename
+        self.pending = []
+        self.cv = threading.Condition()
+        self.write_lock = threading.Lock()  # serializes batch writes
+        self.closed = False
+        with self._connect() as conn:
+            conn.executescript(self.SCHEMA)
+        conn.close()
+        self.writer_thread = threading.Thread(target=self._writer, daemon=True)
+        self.writer_thread.start()
+
+    def _connect(self):
+        # generous timeout since reader (stats) and writer may overlap
+        return sqlite3.connect(self.db_filename, timeout=10)
+
+    def record(self, event, path, artist="", title="", album="", device="", ts=None):
+        """ queue an event for writing, returns immediately
+        """
+        assert event in self.EVENTS, "Invalid history event: %s" % event
+        row = (time.time() if ts is None else ts, event, device, path, artist, title, album)
+        with self.cv:
+            self.pending.append(row)
+            if len(self.pending) >= self.FLUSH_BATCH:
+                self.cv.notify()
+
+    def _write_pending(self, conn):
+        with self.write_lock:
+            with self.cv:
+                batch, self.pending = self.pending, []
+            if batch:
+                with conn:  # single transaction per batch
+                    conn.executemany("INSERT INTO events VALUES (?, ?, ?, ?, ?, ?, ?)", batch)
+        return len(batch)
+
+    def _writer(self):
+        conn = self._connect()
+        while True:
+            with self.cv:
+                if not self.closed and len(self.pending) < self.FLUSH_BATCH:
+                    self.cv.wait(self.FLUSH_INTERVAL)
+                closed = self.closed
+            try:
+                self._write_pending(conn)
+            except sqlite3.Error as error:
+                logger.warning("Handled exception writing play history!")
+                logger.warning("  %s" % error)
+            if closed:
+                break
+        conn.close()
+
+    def flush(self):
+        """ write any queued events now (from the calling thread)
+        """
+        conn = self._connect()
+        try:
+            return self._write_pending(conn)
+        finally:
+            conn.close()
+
+    def close(self):
+        with self.cv:
+            self.closed = True
+            self.cv.notify()
+        self.writer_thread.join()
+
+    def get_gains(self, keys):
+        """ returns {path: gain} of the stored gains for keys [(path, size, mtime), ...]
+            - a gain only matches if the file's size and mtime are unchanged
+        """
+        gains = {}
+        conn = self._connect()
+        try:
+            for path, size, mtime in keys:
+                row = conn.execute("SELECT size, mtime, gain FROM gains WHERE path = ?", (path,)).fetchone()
+                if row and row[0] == size and row[1] == mtime:
+                    gains[path] = row[2]
+        finally:
+            conn.close()
+        return gains
+
+    def set_gains(self, rows):
+        """ store analyzed gains, rows [(path, size, mtime, gain), ...]
+        """
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO gains VALUES (?, ?, ?, ?)", rows)
+        finally:
+            conn.close()
+
+    def get_stats(self, since=None, until=None, limit=10):
+        """ returns dictionary of statistics for events with since <= ts < until
+            - top_artists: [(artist, plays), ...]
+            - top_tracks: [(artist, title, plays), ...]
+            - most_skipped: [(artist, title, skips, plays), ...]
+            - plays, ends, skips, skip_rate: totals over the range
+        """
+        since = 0 if since is None else since
+        until = time.time() + 1 if until is None else until
+        rng = (since, until)
+        conn = self._connect()
+        try:
+            top_artists = conn.execute(
+                    "SELECT artist, COUNT(*) AS n FROM events"
+                    " WHERE event = 'start' AND ts >= ? AND ts < ?"
+                    " GROUP BY artist ORDER BY n DESC, artist LIMIT ?", rng + (limit,)).fetchall()
+            top_tracks = conn.execute(
+                    "SELECT artist, title, COUNT(*) AS n FROM events"
+                    " WHERE event = 'start' AND ts >= ? AND ts < ?"
+                    " GROUP BY artist, title ORDER BY n DESC, artist, title LIMIT ?", rng + (limit,)).fetchall()
+            most_skipped = conn.execute(
+                    "SELECT s.artist, s.title, s.n, COALESCE(p.n, 0) FROM"
+                    " (SELECT artist, title, COUNT(*) AS n FROM events"
+                    "   WHERE event = 'skip' AND ts >= ? AND ts < ? GROUP BY artist, title) AS s"
+                    " LEFT JOIN"
+                    " (SELECT artist, title, COUNT(*) AS n FROM events"
+                    "   WHERE event = 'start' AND ts >= ? AND ts < ? GROUP BY artist, title) AS p"
+                    " USING (artist, title)"
+                    " ORDER BY s.n DESC, s.artist, s.title LIMIT ?", rng + rng + (limit,)).fetchall()
+            totals = dict.fromkeys(self.EVENTS, 0)
+            for event in self.EVENTS:
+                totals[event] = conn.execute(
+                        "SELECT COUNT(*) FROM events WHERE event = ? AND ts >= ? AND ts < ?",
+                        (event,) + rng).fetchone()[0]
+        finally:
+            conn.close()
+
+        return {
+                'since': since,
+                'until': until,
+                'plays': totals['start'],
+                'ends': totals['end'],
+                'skips': totals['skip'],
+                'skip_rate': totals['skip'] / totals['start'] if totals['start'] else 0.0,
+                'top_artists': top_artists,
+                'top_tracks': top_tracks,
+                'most_skipped': most_skipped,
+                }
+# } ## class PlayHistory():
+
+
+thePlayHistory = None       # global singleton, set up in main()
+
+
+# Music library
+#
+# In-memory index of track metadata (tags, duration, cover-art presence) for
+# the files under the playlist folder.
+# - built by LibraryScanner which walks the folder (same walk as play_folder)
+#   and spreads the CPU-bound tag parsing across a pool of worker processes
+# - results stream back in walk order as each chunk completes, so consumers can
+#   start using the index before the scan finishes
+
+import collections
+import concurrent.futures
+import itertools
+import multiprocessing
+import mutagen          # python -m pip install mutagen
+import mutagen.mp3      # python -m pip install mutagen
+import mutagen.flac
+import tempfile
+
+TrackInfo = collections.namedtuple('TrackInfo',
+        'path artist title album duration bitrate has_cover size mtime track_gain album_gain',
+        defaults=(None, None))   # gains in dB, see "Loudness"
+
+# other formats are played via theTranscoder (if available), see "Transcoding"
+TRANSCODE_SUFFIXES = ('.flac', '.m4a', '.mp4', '.aac', '.ogg', '.oga', '.opus', '.wav', '.wma')
+
+def track_suffixes():
+    return ('.mp3',) + (TRANSCODE_SUFFIXES if theTranscoder else ())
+
+def find_tracks(folder):
+    """ generator of the track file paths under folder
+        - mp3 files, plus the other formats if they can be transcoded
+    """
+    suffixes = track_suffixes()
+    if suffixes == ('.mp3',):
+        for pp in pathlib.Path(folder).rglob("*.[mM][pP]3"):
+            yield str(pp)
+        return
+    for pp in pathlib.Path(folder).rglob("*"):
+        if pp.suffix.lower() in suffixes:
+            yield str(pp)
+
+def read_track_art(path):
+    """ returns cover art image data of track path, None if there isn't any
+    """
+    if not path.lower().endswith(".mp3"):
+        return read_cover_art(path)
+    try:
+        tags = mutagen.id3.ID3(path)
+    except mutagen.MutagenError:
+        return None
+    for key in ["APIC:", "APIC:Cover"]:  # try these keys
+        pic_tag = tags.get(key)
+        if pic_tag and len(pic_tag.data) > 0:
+            return pic_tag.data
+    return None
+
+def read_cover_art(path):
+    """ returns cover art image data from the tags of (non-mp3) file, None if there isn't any
+    """
+    try:
+        audio = mutagen.File(path)
+    except (OSError, mutagen.MutagenError):
+        return None
+    if audio is None:
+        return None
+    pictures = getattr(audio, 'pictures', None)   # FLAC
+    if pictures:
+        return pictures[0].data
+    tags = audio.tags if audio.tags is not None else {}
+    if 'covr' in tags and tags['covr']:   # MP4
+        return bytes(tags['covr'][0])
+    for key in tags.keys():    # ID3
+        if key.startswith("APIC") and len(tags[key].data) > 0:
+            return tags[key].data
+    return None
+
+def read_track_info(path):
+    """ returns TrackInfo for track file, or None if it can't be read/parsed
+        - module-level fcn so it can be run in the scanner's worker processes
+    """
+    try:
+        st = os.stat(path)
+        if not path.lower().endswith(".mp3"):
+            audio = mutagen.File(path, easy=True)
+            if audio is None:
+                raise mutagen.MutagenError("unknown format")
+        else:
+            audio = mutagen.mp3.MP3(path)
+    except (OSError, mutagen.MutagenError) as error:
+        logger.debug("Unable to read track info: %s (%s)" % (path, error))
+        return None
+
+    if not path.lower().endswith(".mp3"):
+        tags = audio.tags if audio.tags is not None else {}
+        def easy_text(key):
+            return str(tags[key][0]) if key in tags and tags[key] else ""
+        return TrackInfo(path, easy_text('artist'), easy_text('title'), easy_text('album'),
+                audio.info.length, getattr(audio.info, 'bitrate', 0), read_cover_art(path) is not None,
+                st.st_size, st.st_mtime,
+                parse_gain(easy_text('replaygain_track_gain')), parse_gain(easy_text('replaygain_album_gain')))
+
+    tags = audio.tags if audio.tags is not None else {}
+    def text(key):
+        frame = tags.get(key)
+        return str(frame.text[0]) if frame and frame.text else ""
+    def txxx_text(desc):
+        # ReplayGain descriptions are upper or lower case depending on the tagger
+        for key in tags.keys():
+            if key.upper() == "TXXX:" + desc:
+                return text(key)
+        return ""
+
+    has_cover = any(key.startswith("APIC") and len(tags[key].data) > 0 for key in tags.keys())
+    return TrackInfo(path, text('TPE1'), text('TIT2'), text('TALB'),
+            audio.info.length, audio.info.bitrate, has_cover, st.st_size, st.st_mtime,
+            parse_gain(txxx_text('REPLAYGAIN_TRACK_GAIN')), parse_gain(txxx_text('REPLAYGAIN_ALBUM_GAIN')))
+
+def parse_gain(text):
+    """ ReplayGain tag value, e.g. "-6.20 dB" -> -6.2, None if missing/invalid
+    """
+    try:
+        return float(text.strip().split()[0])
+    except (IndexError, ValueError):
+        return None
+
+def pool_context():
+    """ multiprocessing context for process pools
+        - not fork: the pools are created once pychromecast's, the http server's and the
+          logging threads are running, and a forked child can deadlock on a lock one of
+          them held
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+def _read_track_info_batch(paths):
+    return [read_track_info(path) for path in paths]
+
+def _chunked(iterable, chunk_size):
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class LibraryScanner():  # {
+    """ Parallel extraction of track info using a process pool
+
+        - scan() is a generator yielding TrackInfo in walk order
+        - progress_callback(scanned, found) called as each chunk completes
+          (found keeps growing until the folder walk is done)
+        - cancel() may be called from any thread, scan() stops after the
+          in-flight chunk
+    """
+    def __init__(self, workers=None, chunk_size=32, progress_callback=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.progress_callback = progress_callback
+        self.cancelled = threading.Event()
+        self.found = 0      # files handed to workers
+        self.scanned = 0    # files processed by workers
+        self.errors = 0     # files that couldn't be parsed
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def scan(self, folder_or_paths):
+        """ folder_or_paths: folder to walk or iterable of file paths
+        """
+        if isinstance(folder_or_paths, (str, pathlib.PurePath)):
+            paths = find_tracks(folder_or_paths)
+        else:
+            paths = folder_or_paths
+        chunks = _chunked(paths, self.chunk_size)
+        max_in_flight = 2 * self.workers    # keep workers busy without reading ahead too far
+
+        with concurrent.futures.ProcessPoolExecutor(self.workers, mp_context=pool_context()) as pool:
+            in_flight = collections.deque()
+            try:
+                while not self.cancelled.is_set():
+                    while len(in_flight) < max_in_flight:
+                        chunk = next(chunks, None)
+                        if chunk is None:
+                            break
+                        self.found += len(chunk)
+                        in_flight.append(pool.submit(_read_track_info_batch, chunk))
+                    if not in_flight:
+                        break
+
+                    # oldest chunk first, so results are in walk order
+                    results = in_flight.popleft().result()
+                    self.scanned += len(results)
+                    if self.progress_callback:
+                        self.progress_callback(self.scanned, self.found)
+                    for info in results:
+                        if info is None:
+                            self.errors += 1
+                        else:
+                            yield info
+            finally:
+                for future in in_flight:
+                    future.cancel()
+# } ## class LibraryScanner():
+
+
+class LibraryIndex():  # {
+    """ Thread-safe in-memory index: path -> TrackInfo
+        - with secondary (lower-cased) artist and album indexes for filtering
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.tracks = {}
+        self.by_artist = collections.defaultdict(set)
+        self.by_album = collections.defaultdict(set)
+        self.folders = {}   # absolute path -> folder as scanned (the form of its tracks' paths)
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def __contains__(self, path):
+        return path in self.tracks
+
+    def get(self, path):
+        return self.tracks.get(path)
+
+    def paths(self):
+        with self.lock:
+            return list(self.tracks)
+
+    def add(self, info):
+        theTracks.register(info.path)   # servable by track ID
+        with self.lock:
+            self.remove(info.path)
+            self.tracks[info.path] = info
+            self.by_artist[info.artist.lower()].add(info.path)
+            self.by_album[info.album.lower()].add(info.path)
+
+    def remove(self, path):
+        with self.lock:
+            info = self.tracks.pop(path, None)
+            if info:
+                self.by_artist[info.artist.lower()].discard(info.path)
+                self.by_album[info.album.lower()].discard(info.path)
+            return info
+
+    def filter(self, artist=None, album=None):
+        """ returns list of paths matching (case-insensitive) artist and/or album
+        """
+        with self.lock:
+            matches = None
+            if artist is not None:
+                matches = set(self.by_artist.get(artist.lower(), ()))
+            if album is not None:
+                album_matches = self.by_album.get(album.lower(), set())
+                matches = set(album_matches) if matches is None else matches & album_matches
+            return sorted(self.tracks if matches is None else matches)
+
+    def set_gain(self, path, track_gain):
+        """ store (analyzed) track gain for path
+        """
+        with self.lock:
+            info = self.tracks.get(path)
+            if info:
+                self.tracks[path] = info._replace(track_gain=track_gain)
+
+    def get_gain(self, path, album=False):
+        """ gain (dB) for path, None if not known
+            album - album gain: from the tags, or else combined from the album's track gains
+        """
+        with self.lock:
+            info = self.tracks.get(path)
+            if info is None:
+                return None
+            if not album or not info.album:
+                return info.track_gain
+            if info.album_gain is not None:
+                return info.album_gain
+            gains = [self.tracks[p].track_gain for p in self.by_album[info.album.lower()]
+                    if self.tracks[p].album == info.album and self.tracks[p].track_gain is not None]
+        if not gains:
+            return None
+        # album loudness is the power average of its tracks' loudness
+        return -10 * math.log10(sum(10 ** (-gain / 10) for gain in gains) / len(gains))
+
+    def scan(self, folder, scanner=None):
+        """ (re)scan folder into the index, returns number of tracks added
+        """
+        scanner = scanner or LibraryScanner()
+        n = 0
+        for info in scanner.scan(folder):
+            self.add(info)
+            n += 1
+        if not scanner.cancelled.is_set():
+            with self.lock:
+                self.folders[os.path.abspath(folder)] = str(pathlib.Path(folder))
+        return n
+
+    def locate(self, path):
+        """ index form of (absolute, normalised) path
+            - None if path is under a scanned folder but isn't in the index
+            - path itself if it's outside the scanned folders (the index can't tell)
+        """
+        with self.lock:
+            folders = list(self.folders.items())
+        for abs_folder, folder in folders:
+            if path.startswith(os.path.join(abs_folder, "")):
+                key = os.path.join(folder, path[len(abs_folder)+1:])
+                return key if key in self.tracks else None
+        return path
+# } ## class LibraryIndex():
+
+
+theLibrary = LibraryIndex()     # global singleton
+
+
+# Playlist files
+#
+# .m3u/.m3u8 playlists: load_m3u() streams the entries from the file (so a
+# large playlist isn't read in first) and checks them against theLibrary, only
+# entries outside the scanned folders are checked on disk. Missing entries are
+# reported together, once the whole playlist has been read.
+# - entries outside theTracks roots can't be served, so are reported as missing
+# - entries are relative to the playlist's folder, file:// URLs are accepted
+# - lines are UTF-8, falling back to Latin-1 (older .m3u files)
+# - save_m3u() writes #EXTINF info for the tracks in theLibrary
+
+import codecs
+
+M3U_SUFFIXES = ('.m3u', '.m3u8')
+
+def iter_m3u(filename):
+    """ generator of the entries of playlist filename, as absolute normalised paths
+        - URLs (other than file://) are yielded as they are
+    """
+    base = os.path.dirname(os.path.abspath(filename))
+    with open(filename, 'rb') as f:
+        for n, line in enumerate(f):
+            if n == 0 and line.startswith(codecs.BOM_UTF8):
+                line = line[len(codecs.BOM_UTF8):]
+            try:
+                entry = line.decode('utf-8').strip()
+            except UnicodeDecodeError:
+                entry = line.decode('latin-1').strip()
+            if not entry or entry.startswith('#'):
+                continue
+            if entry.lower().startswith('file://'):
+                entry = urllib.parse.unquote(urllib.parse.urlsplit(entry).path)
+            elif re.match(r'[a-zA-Z][a-zA-Z0-9+.-]+://', entry):
+                yield entry
+                continue
+            if os.sep == '/':
+                entry = entry.replace('\\', '/')  # written on Windows
+            yield os.path.normpath(os.path.join(base, entry))
+
+def load_m3u(filename, library=None, tracks=None):
+    """ returns (list of track paths, list of missing entries) of playlist filename
+        - paths of tracks in the library are in its form, see LibraryIndex.locate()
+        - entries that tracks (default theTracks) can't serve are missing
+    """
+    library = theLibrary if library is None else library
+    tracks = theTracks if tracks is None else tracks
+    paths = []
+    missing = []
+    for entry in iter_m3u(filename):
+        path = library.locate(entry)
+        # (library tracks were registered by the scan, so are under the roots)
+        if path is not None and (path in library
+                or (is_track_file(path) and os.path.isfile(path) and tracks.servable(path))):
+            paths.append(path)
+        else:
+            missing.append(entry)
+    if missing:
+        logger.warning("Playlist %s: %d of %d entries missing: %s%s" % (filename, len(missing),
+            len(paths) + len(missing), ", ".join(missing[:5]), ", .." if len(missing) > 5 else ""))
+    return paths, missing
+
+def save_m3u(paths, filename, library=None):
+    """ writes paths to playlist filename, returns number of entries
+        - entries under the playlist's folder are written relative to it
+    """
+    library = theLibrary if library is None else library
+    base = os.path.join(os.path.dirname(os.path.abspath(filename)), "")
+    n = 0
+    with open(filename + ".part", 'w', encoding='utf-8') as f:
+        f.write("#EXTM3U\n")
+        for path in paths:
+            info = library.get(path)
+            if info:
+                f.write("#EXTINF:%d,%s - %s\n" % (round(info.duration or -1), info.artist, info.title))
+            abs_path = os.path.abspath(path)
+            f.write("%s\n" % (abs_path[len(base):] if abs_path.startswith(base) else abs_path))
+            n += 1
+    os.replace(filename + ".part", filename)
+    return n
+
+
+# Live library updates
+#
+# LibraryWatcher keeps theLibrary in sync with the playlist folder and reports
+# the changes to a callback (used to update the playing playlist), so new music
+# is picked up without a full rescan.
+# - on Linux uses inotify (via ctypes, no extra dependencies) with a watch on
+#   every sub-folder
+# - events are debounced: changes are applied once the folder has been quiet
+#   for a while, and files being written are held back until they're closed,
+#   so a bulk copy results in one update
+# - falls back to a periodic mtime sweep where inotify isn't available (non-
+#   Linux, or network filesystems where remote changes don't generate events)
+
+import ctypes
+import ctypes.util
+import select
+import struct
+
+def is_track_file(path):
+    """ matches the files found by find_tracks()
+    """
+    return path.lower().endswith(track_suffixes())
+
+# filesystems that don't deliver inotify events for changes made by other hosts
+NO_INOTIFY_FSTYPES = ('nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'fuse.sshfs', '9p', 'afs', 'ceph')
+
+def get_fstype(path):
+    """ returns filesystem type of path (from /proc/self/mounts) or None if unknown
+    """
+    path = os.path.realpath(path)
+    best_mount, best_fstype = "", None
+    try:
+        with open("/proc/self/mounts") as mounts:
+            for line in mounts:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount_point = fields[1].replace("\\040", " ")
+                if (path == mount_point or path.startswith(mount_point.rstrip("/") + "/")) \
+                        and len(mount_point) > len(best_mount):
+                    best_mount, best_fstype = mount_point, fields[2]
+    except OSError:
+        pass
+    return best_fstype
+
+
+class Inotify():  # {
+    """ Minimal ctypes wrapper of the Linux inotify API
+    """
+    IN_CLOSE_WRITE  = 0x00000008
+    IN_MOVED_FROM   = 0x00000040
+    IN_MOVED_TO     = 0x00000080
+    IN_CREATE       = 0x00000100
+    IN_DELETE       = 0x00000200
+    IN_DELETE_SELF  = 0x00000400
+    IN_MOVE_SELF    = 0x00000800
+    IN_Q_OVERFLOW   = 0x00004000
+    IN_IGNORED      = 0x00008000
+    IN_ONLYDIR      = 0x01000000
+    IN_ISDIR        = 0x40000000
+
+    EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+    def __init__(self):
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify only available on Linux")
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return wd
+
+    def rm_watch(self, wd):
+        if self.libc.inotify_rm_watch(self.fd, wd) < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+    def read_events(self, timeout):
+        """ returns list of (wd, mask, cookie, name) tuples, [] if none within timeout
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + self.EVENT_HEADER.size <= len(buf):
+            wd, mask, cookie, length = self.EVENT_HEADER.unpack_from(buf, offset)
+            offset += self.EVENT_HEADER.size
+            name = os.fsdecode(buf[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+# } ## class Inotify():
+
+
+class LibraryWatcher():  # {
+    """ Applies file add/move/delete under folder to a LibraryIndex
+
+        on_change(added, removed) -- called (from the watcher thread) with lists
+        of track paths after each debounced batch of changes is applied
+    """
+    WATCH_MASK = (Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_FROM | Inotify.IN_MOVED_TO
+            | Inotify.IN_CREATE | Inotify.IN_DELETE | Inotify.IN_DELETE_SELF | Inotify.IN_MOVE_SELF
+            | Inotify.IN_ONLYDIR)
+    SCAN_POOL_THRESHOLD = 32    # use a LibraryScanner pool for batches bigger than this
+
+    def __init__(self, folder, library, on_change=None, debounce=2.0, sweep_interval=60,
+            use_inotify=True):
+        self.folder = str(pathlib.Path(folder))  # paths then match those from find_tracks()
+        self.library = library
+        self.on_change = on_change
+        self.debounce = debounce
+        self.sweep_interval = sweep_interval
+        self.stopped = threading.Event()
+        self.pending = {}       # path -> 'add' | 'remove'
+        self.writing = set()    # files created but not yet closed, not added until they are
+        self.last_event = 0
+        self.wds = {}           # inotify watch descriptor -> folder
+        self.snapshot = None    # path -> mtime, for mtime sweeps
+        self.inotify = None
+        if use_inotify:
+            fstype = get_fstype(self.folder)
+            if fstype in NO_INOTIFY_FSTYPES:
+                logger.info("LibraryWatcher: %s is on %s, using mtime sweeps" % (self.folder, fstype))
+            else:
+                try:
+                    self.inotify = Inotify()
+                except (OSError, AttributeError) as error:
+                    logger.info("LibraryWatcher: inotify unavailable (%s), using mtime sweeps" % error)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def start(self):
+        if self.inotify:
+            self._watch_tree(self.folder)
+        else:
+            self.snapshot = self._take_snapshot()
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        if self.inotify:
+            self.inotify.close()
+
+    def _run(self):
+        while not self.stopped.is_set():
+            if self.inotify:
+                events = self.inotify.read_events(timeout=min(self.debounce, 0.5))
+                if events:
+                    self.last_event = time.time()
+                    for event in events:
+                        self._handle_event(*event)
+            else:
+                self.stopped.wait(self.sweep_interval)
+                if not self.stopped.is_set():
+                    self._sweep()
+            if self.pending and (time.time() - self.last_event) >= self.debounce:
+                self._apply_pending()
+
+    # inotify mode
+
+    def _watch_tree(self, top):
+        """ add watches to top and its sub-folders, returns track files found
+        """
+        found = []
+        for dirpath, dirnames, filenames in os.walk(top):
+            try:
+                wd = self.inotify.add_watch(dirpath, self.WATCH_MASK)
+            except OSError as error:
+                logger.warning("LibraryWatcher: unable to watch %s: %s" % (dirpath, error))
+                continue
+            self.wds[wd] = dirpath
+            found.extend(os.path.join(dirpath, f) for f in filenames if is_track_file(f))
+        return found
+
+    def _unwatch_tree(self, top):
+        """ remove the watches of top and its sub-folders (moved out of the folder, or deleted)
+        """
+        prefix = os.path.join(top, "")
+        for wd, folder in list(self.wds.items()):
+            if folder == top or folder.startswith(prefix):
+                del self.wds[wd]
+                try:
+                    self.inotify.rm_watch(wd)
+                except OSError:
+                    pass    # (already gone with the folder)
+
+    def _handle_event(self, wd, mask, cookie, name):
+        if mask & Inotify.IN_Q_OVERFLOW:
+            # lost events, fall back to comparing against the folder contents
+            logger.warning("LibraryWatcher: inotify queue overflow, resyncing")
+            self._resync()
+            return
+        if mask & Inotify.IN_IGNORED:
+            self.wds.pop(wd, None)
+            return
+        folder = self.wds.get(wd)
+        if folder is None:
+            return
+        if mask & Inotify.IN_MOVE_SELF:
+            # moves within the folder are re-watched (IN_MOVED_TO), only the
+            # folder itself moving (or an unwatched parent of a sub-folder) gets here
+            if not os.path.isdir(folder):
+                logger.warning("LibraryWatcher: %s moved away, no longer watched" % folder)
+                self._unwatch_tree(folder)
+            return
+        if not name:
+            return
+        path = os.path.join(folder, name)
+
+        if mask & Inotify.IN_ISDIR:
+            if mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                for track in self._watch_tree(path):
+                    self.pending[track] = 'add'
+            elif mask & (Inotify.IN_DELETE | Inotify.IN_MOVED_FROM):
+                self._unwatch_tree(path)
+                prefix = path + os.sep
+                self.writing = set(p for p in self.writing if not p.startswith(prefix))
+                for track in self.library.paths():
+                    if track.startswith(prefix):
+                        self.pending[track] = 'remove'
+                for pending in list(self.pending):
+                    if pending.startswith(prefix):
+                        self.pending[pending] = 'remove'
+            return
+
+        if not is_track_file(name):
+            return
+        if mask & Inotify.IN_CREATE:
+            self.writing.add(path)
+        elif mask & (Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO):
+            self.writing.discard(path)
+            self.pending[path] = 'add'
+        elif mask & (Inotify.IN_DELETE | Inotify.IN_MOVED_FROM):
+            self.writing.discard(path)
+            self.pending[path] = 'remove'
+
+    def _resync(self):
+        on_disk = set(self._take_snapshot())
+        self.writing &= on_disk
+        for path in on_disk:
+            if path not in self.library:
+                self.pending[path] = 'add'
+        for path in self.library.paths():
+            if path not in on_disk:
+                self.pending[path] = 'remove'
+
+    # mtime sweep mode
+
+    def _take_snapshot(self):
+        snapshot = {}
+        stack = [self.folder]
+        while stack:
+            try:
+                with os.scandir(stack.pop()) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                stack.append(entry.path)
+                            elif is_track_file(entry.name):
+                                snapshot[entry.path] = entry.stat().st_mtime
+                        except OSError:
+                            pass
+            except OSError:
+                pass
+        return snapshot
+
+    def _sweep(self):
+        snapshot = self._take_snapshot()
+        for path, mtime in snapshot.items():
+            if self.snapshot.get(path) != mtime:
+                self.pending[path] = 'add'
+        for path in self.snapshot:
+            if path not in snapshot:
+                self.pending[path] = 'remove'
+        self.snapshot = snapshot
+        # files still changing between sweeps are picked up by the next one
+        self.last_event = 0
+
+    # apply
+
+    def _apply_pending(self):
+        pending, self.pending = self.pending, {}
+        # (a file still being written, e.g. found by a resync, is added on its IN_CLOSE_WRITE)
+        to_add = [path for path, op in pending.items() if op == 'add' and path not in self.writing]
+        removed = [path for path, op in pending.items() if op == 'remove']
+
+        for path in removed:
+            self.library.remove(path)
+
+        if len(to_add) > self.SCAN_POOL_THRESHOLD:
+            infos = LibraryScanner().scan(to_add)
+        else:
+            infos = (read_track_info(path) for path in to_add)
+        added = []
+        for info in infos:
+            if info is not None:
+                self.library.add(info)
+                added.append(info.path)
+
+        logger.info("LibraryWatcher: %d added, %d removed" % (len(added), len(removed)))
+        if self.on_change and (added or removed):
+            try:
+                self.on_change(added, removed)
+            except Exception as error:
+                logger.warning("LibraryWatcher: on_change failed: %s" % error)
+# } ## class LibraryWatcher():
+
+
+def make_synthetic_library(folder, n_tracks, seconds=2, n_artists=10, cover=True):
+    """ writes n_tracks small (silent) tagged mp3 files under folder
+        - for tests and benchmarks, returns list of the file paths
+    """
+    # MPEG-1 Layer III frame header: 128kbps, 44.1kHz, stereo -> 417 byte frames of 1152 samples
+    frame = b'\xff\xfb\x90\x00' + b'\x00' * 413
+    n_frames = max(1, int(seconds * 44100 / 1152))
+    paths = []
+    for i in range(n_tracks):
+        artist = "Artist %02d" % (i % n_artists)
+        album = "Album %02d" % ((i // 5) % (2 * n_artists))
+        subfolder = os.path.join(folder, artist, album)
+        os.makedirs(subfolder, exist_ok=True)
+        path = os.path.join(subfolder, "Track %04d.mp3" % i)
+        with open(path, "wb") as f:
+            f.write(frame * n_frames)
+        tags = mutagen.id3.ID3()
+        tags.add(mutagen.id3.TPE1(encoding=3, text=artist))
+        tags.add(mutagen.id3.TIT2(encoding=3, text="Title %04d" % i))
+        tags.add(mutagen.id3.TALB(encoding=3, text=album))
+        if cover:
+            tags.add(mutagen.id3.APIC(encoding=3, mime='image/jpeg', type=3, desc='Cover',
+                data=b'\xff\xd8\xff\xe0' + bytes(1024)))
+        tags.save(path)
+        paths.append(path)
+    return paths
+
+def make_synthetic_flac(path, seconds=2, artist="", title="", album="", cover=True):
+    """ writes a small tagged flac file (header only, no audio frames), for tests
+    """
+    rate = 44100
+    # STREAMINFO: block sizes, frame sizes, then rate(20) channels-1(3) bits-1(5) total samples(36), md5
+    bits = (rate << 44) | ((2 - 1) << 41) | ((16 - 1) << 36) | int(seconds * rate)
+    info = struct.pack(">HH", 4096, 4096) + bytes(6) + bits.to_bytes(8, 'big') + bytes(16)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"fLaC" + bytes([0x80]) + len(info).to_bytes(3, 'big') + info + bytes(4096))
+    audio = mutagen.flac.FLAC(path)
+    audio['artist'] = artist
+    audio['title'] = title
+    audio['album'] = album
+    if cover:
+        picture = mutagen.flac.Picture()
+        picture.type = 3
+        picture.mime = 'image/jpeg'
+        picture.data = b'\xff\xd8\xff\xe0' + bytes(1024)
+        audio.add_picture(picture)
+    audio.save()
+    return path
+
+def bench_library_scan(folder, worker_counts=(1, 2, 4), chunk_size=32):
+    """ time a full library scan at each worker count, returns {workers: seconds}
+    """
+    # warm the page cache so the first run isn't penalized
+    n_files = 0
+    for path in find_tracks(folder):
+        with open(path, "rb") as f:
+            while f.read(1024 * 1024):
+                pass
+        n_files += 1
+    results = {}
+    for workers in worker_counts:
+        scanner = LibraryScanner(workers=workers, chunk_size=chunk_size)
+        start = time.perf_counter()
+        n = sum(1 for _ in scanner.scan(folder))
+        elapsed = time.perf_counter() - start
+        results[workers] = elapsed
+        print("workers=%d: %d/%d tracks in %.2fs (%.0f tracks/s, speedup x%.2f)" % (
+            workers, n, n_files, elapsed, n / elapsed if elapsed else 0,
+            results[worker_counts[0]] / elapsed if elapsed else 0))
+    return results
+
+
+# Loudness
+#
+# Per-track gain (dB) evens out the volume between tracks:
+# - ReplayGain tags are read by the library scan (TrackInfo.track_gain/album_gain)
+# - tracks without them are analyzed in the background by LoudnessAnalyzer: an
+#   external decoder command (ffmpeg by default) writes mono 16-bit PCM to
+#   stdout, and the gain is the difference between a reference level and the
+#   track's loud-block RMS level (95th percentile of 50ms blocks, as ReplayGain)
+# - analysis runs on a process pool at low priority, results stored in theLibrary
+#   and in the play-history db (if enabled), so a track is only analyzed again
+#   when its size or mtime changes
+# - CcAudioStreamer.play() applies the gain as a receiver volume relative to the
+#   user's chosen volume, see CcAudioStreamer._apply_gain()
+
+import array
+import math
+import operator
+import shlex
+import shutil
+import warnings
+
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore', DeprecationWarning)
+    try:
+        import audioop      # C RMS, removed in Python 3.13
+    except ImportError:
+        audioop = None
+
+DEFAULT_ANALYSIS_COMMAND = "ffmpeg -v error -i {input} -vn -ac 1 -ar 11025 -f s16le -"
+LOUDNESS_REFERENCE_DB = -14.0    # RMS level (dBFS) of loud blocks that gets a gain of 0 dB
+ANALYSIS_RATE = 11025            # samples/s expected from the decoder
+GAIN_MODES = ('off', 'track', 'album')
+
+def analyze_loudness(path, command):
+    """ returns gain (dB) for path, by decoding it with command, None if it can't be decoded
+        - module-level fcn so it can be run in the analyzer's worker processes
+    """
+    command = [path if arg == "{input}" else arg for arg in command]
+    try:
+        pcm = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                stdin=subprocess.DEVNULL, check=True).stdout
+    except (OSError, subprocess.CalledProcessError) as error:
+        logger.debug("Unable to analyze loudness: %s (%s)" % (path, error))
+        return None
+    block = ANALYSIS_RATE // 20     # 50ms
+    n_blocks = len(pcm) // (2 * block)
+    if audioop:
+        if sys.byteorder == 'big':
+            pcm = audioop.byteswap(pcm, 2)
+        levels = [audioop.rms(pcm[2 * block * i:2 * block * (i + 1)], 2) ** 2 for i in range(n_blocks)]
+    else:
+        samples = array.array('h')
+        samples.frombytes(pcm[:2 * block * n_blocks])
+        if sys.byteorder == 'big':
+            samples.byteswap()
+        levels = []
+        for i in range(0, len(samples), block):
+            blk = samples[i:i + block]
+            levels.append(sum(map(operator.mul, blk, blk)) / block)
+    if not levels:
+        return None
+    levels.sort()
+    loud = levels[int(0.95 * (len(levels) - 1))]
+    if loud <= 0:
+        return 0.0      # silence: leave alone
+    level_db = 10 * math.log10(loud / 32768 ** 2)
+    return round(LOUDNESS_REFERENCE_DB - level_db, 2)
+
+def _analyze_loudness_batch(paths, command):
+    return [(path, analyze_loudness(path, command)) for path in paths]
+
+def _gain_key(path):
+    """ (path, size, mtime) that a stored gain is valid for, None if path can't be read
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (path, st.st_size, st.st_mtime)
+
+def _lower_priority():
+    """ worker process initializer, so analysis doesn't compete with playback/serving
+    """
+    try:
+        os.nice(10)
+    except (AttributeError, OSError):
+        pass
+
+class LoudnessAnalyzer():  # {
+    """ Background loudness analysis of tracks without ReplayGain tags, results stored in library
+        - analyze(paths) may be called repeatedly, e.g. after a scan and for added tracks
+        - store: optional PlayHistory, gains stored there are used instead of analyzing again
+    """
+    def __init__(self, library, command=DEFAULT_ANALYSIS_COMMAND, workers=1, chunk_size=8, store=None):
+        self.library = library
+        self.store = store
+        self.command = shlex.split(command)
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        self.pool = None
+        self.pending = 0
+        self.analyzed = 0
+        self.errors = 0
+        self.idle = threading.Event()   # set when nothing pending
+        self.idle.set()
+
+    @staticmethod
+    def available(command=DEFAULT_ANALYSIS_COMMAND):
+        return shutil.which(shlex.split(command)[0]) is not None
+
+    def analyze(self, paths):
+        """ queue the paths that have no track gain yet, returns number queued
+        """
+        paths = [p for p in paths if self.library.get(p) and self.library.get(p).track_gain is None]
+        if self.store and paths:
+            try:
+                stored = self.store.get_gains(filter(None, map(_gain_key, paths)))
+            except sqlite3.Error as error:
+                logger.warning("Unable to read stored gains: %s" % error)
+                stored = {}
+            for path, gain in stored.items():
+                self.library.set_gain(path, gain)
+            paths = [p for p in paths if p not in stored]
+        if not paths:
+            return 0
+        with self.lock:
+            if self.pool is None:
+                self.pool = concurrent.futures.ProcessPoolExecutor(self.workers,
+                        mp_context=pool_context(), initializer=_lower_priority)
+            self.pending += len(paths)
+            self.idle.clear()
+            for chunk in _chunked(paths, self.chunk_size):
+                future = self.pool.submit(_analyze_loudness_batch, chunk, self.command)
+                future.add_done_callback(self._chunk_done)
+        logger.info("Loudness analysis: %d tracks queued" % len(paths))
+        return len(paths)
+
+    def _chunk_done(self, future):
+        try:
+            results = future.result()
+        except (concurrent.futures.CancelledError, concurrent.futures.process.BrokenProcessPool) as error:
+            logger.warning("Loudness analysis stopped: %s" % error)
+            results = []
+            with self.lock:
+                self.pool = None    # a broken pool can't be used again, the next analyze() makes a new one
+                self.pending = 0
+                self.idle.set()
+        rows = []
+        for path, gain in results:
+            if gain is None:
+                self.errors += 1
+            else:
+                self.library.set_gain(path, gain)
+                self.analyzed += 1
+                key = _gain_key(path)
+                if key:
+                    rows.append(key + (gain,))
+        if self.store and rows:
+            try:
+                self.store.set_gains(rows)
+            except sqlite3.Error as error:
+                logger.warning("Unable to store gains: %s" % error)
+        with self.lock:
+            self.pending = max(0, self.pending - len(results))
+            if self.pending == 0:
+                self.idle.set()
+                logger.info("Loudness analysis done: %d analyzed, %d failed" % (self.analyzed, self.errors))
+
+    def stop(self):
+        with self.lock:
+            if self.pool:
+                self.pool.shutdown(wait=False, cancel_futures=True)
+                self.pool = None
+# }
+
+theLoudness = None          # global singleton, set in main() if a decoder is available
+GAIN_MODE = 'track'         # default CcAudioStreamer gain mode, one of GAIN_MODES
+
+
+# Track transitions
+#
+# The gap between a track finishing (device reports IDLE/FINISHED) and the next
+# track playing (device reports PLAYING) is broken into phases, so we can see
+# which dominates on each host:
+#   status_arrival      FINISHED arrival relative to the expected end of track
+#                       (from the last PLAYING status), not part of the gap
+#   index_advance       advancing the playlist index
+#   file_check          checking the next file exists
+#   tag_parse           reading the ID3 tags
+#   cover_extraction    extracting cover art to cover.jpg
+#   play_media          sending play_media
+#   block_until_active  waiting for the media session
+#   first_playing       from then until the device reports PLAYING
+
+class TransitionTimer():
+    """ phase timings for one track transition, see "Track transitions" above
+    """
+    def __init__(self, arrival_delay=None):
+        self.phases = {}
+        self.in_play = False        # CcAudioStreamer.play() in progress
+        self.playing_seen = False   # PLAYING reported before play() returned
+        if arrival_delay is not None:
+            self.phases['status_arrival'] = arrival_delay
+        self.start = self.mark_time = time.perf_counter()
+
+    def mark(self, phase):
+        """ ends phase (which started at the previous mark)
+        """
+        now = time.perf_counter()
+        self.phases[phase] = now - self.mark_time
+        self.mark_time = now
+
+    def gap(self):
+        return self.mark_time - self.start
+
+
+class TransitionStats():  # {
+    """ rolling window of completed TransitionTimers
+    """
+    PHASES = ('status_arrival', 'index_advance', 'file_check', 'tag_parse', 'cover_extraction',
+            'play_media', 'block_until_active', 'first_playing')
+
+    def __init__(self, window=100):
+        self.lock = threading.Lock()
+        self.transitions = collections.deque(maxlen=window)   # (gap, phases)
+        self.added = 0
+        self.status = (0, "")   # (added, status_text()) cached, as it's in every status
+
+    def add(self, timer):
+        gap = timer.gap()
+        with self.lock:
+            self.transitions.append((gap, dict(timer.phases)))
+            self.added += 1
+        theMetrics.observe('s2c_transition_gap_seconds', (), gap)
+        for phase, seconds in timer.phases.items():
+            theMetrics.observe('s2c_transition_phase_seconds', (('phase', phase),), max(0, seconds))
+        logger.info("Track transition gap: %.3fs (%s)" % (gap,
+            ", ".join("%s %.3f" % (p, timer.phases[p]) for p in self.PHASES if p in timer.phases)))
+
+    @staticmethod
+    def _percentiles(values):
+        values = sorted(values)
+        def pct(p):
+            return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+        return {'p50': pct(50), 'p90': pct(90), 'max': values[-1]}
+
+    def summary(self):
+        """ returns dictionary with count, gap percentiles, per-phase percentiles
+            and the phase with the largest median ('dominant')
+        """
+        with self.lock:
+            transitions = list(self.transitions)
+        result = {'count': len(transitions), 'gap': None, 'phases': {}, 'dominant': None}
+        if not transitions:
+            return result
+        result['gap'] = self._percentiles([gap for gap, phases in transitions])
+        for phase in self.PHASES:
+            values = [phases[phase] for gap, phases in transitions if phase in phases]
+            if values:
+                result['phases'][phase] = self._percentiles(values)
+        in_gap = [p for p in result['phases'] if p != 'status_arrival']
+        if in_gap:
+            result['dominant'] = max(in_gap, key=lambda p: result['phases'][p]['p50'])
+        return result
+
+    def status_text(self):
+        """ one line summary for the status, "" if none measured yet
+        """
+        added, text = self.status
+        if added != self.added:
+            added = self.added
+            summary = self.summary()
+            text = "gap p50 %.3fs p90 %.3fs (%s)" % (summary['gap']['p50'], summary['gap']['p90'],
+                    summary['dominant']) if summary['count'] else ""
+            self.status = (added, text)
+        return text
+
+    def format_summary(self):
+        """ summary() as lines of text, for console display
+        """
+        summary = self.summary()
+        if not summary['count']:
+            return ["Track transitions: none measured yet"]
+        gap = summary['gap']
+        lines = ["Track transitions (last %d): gap p50 %.3fs  p90 %.3fs  max %.3fs  (dominant: %s)" % (
+            summary['count'], gap['p50'], gap['p90'], gap['max'], summary['dominant'])]
+        for phase, p in summary['phases'].items():
+            lines.append("  %-20s p50 %7.3fs  p90 %7.3fs  max %7.3fs" % (phase, p['p50'], p['p90'], p['max']))
+        return lines
+# } ## class TransitionStats():
+
+
+theMetrics.describe('s2c_transition_gap_seconds', 'histogram', "Time from FINISHED to next track PLAYING")
+theMetrics.describe('s2c_transition_phase_seconds', 'histogram', "Track transition time by phase")
+
+
+# Connection supervision
+#
+# When calls to a device fail (it dropped off the network, rebooted, ...) the
+# session's ConnectionSupervisor marks it disconnected, so that status polling
+# stops hammering it, and reconnects in the background with exponential
+# backoff and jitter. Once the device is back, the session's playlist, index
+# and position are restored.
+# - the session is restored holding the CcAudioStreamer's session_lock (the
+#   InteractivePlayer's lock), as the UI and http commands play and change the
+#   playlist holding it
+# - each attempt's discovery is stopped once it's done (see find_device()),
+#   rather than leaving a zeroconf browser running per attempt
+
+class ConnectionSupervisor():  # {
+    """ Background reconnection of a CcAudioStreamer's device
+    """
+    BACKOFF_BASE = 1.0      # seconds, first retry delay (before jitter)
+    BACKOFF_MAX = 60.0      # seconds, cap on retry delay
+
+    def __init__(self, cas, backoff_base=None, backoff_max=None):
+        self.cas = cas
+        self.backoff_base = backoff_base or self.BACKOFF_BASE
+        self.backoff_max = backoff_max or self.BACKOFF_MAX
+        self.lock = threading.Lock()
+        self.connected = True
+        self.attempts = 0       # reconnect attempts since disconnect
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def backoff(self, attempt):
+        """ "full jitter" exponential backoff: uniform in [0, min(max, base * 2^attempt)]
+        """
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def report_failure(self, error):
+        """ call when a device call fails, starts reconnecting (if not already)
+        """
+        with self.lock:
+            if not self.connected or self.stopped.is_set():
+                return
+            self.connected = False
+            self.attempts = 0
+            session = self.cas.get_session()
+        logger.warning("Lost connection to %s (%s), reconnecting in background" % (self.cas.get_name(), error))
+        theMetrics.inc('s2c_device_disconnects_total', (('device', self.cas.get_name()),))
+        self.thread = threading.Thread(target=self._reconnect, args=(session,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _reconnect(self, session):
+        while not self.stopped.wait(self.backoff(self.attempts)):
+            self.attempts += 1
+            try:
+                self.cas.reconnect()
+            except Exception as error:
+                logger.warning("Reconnect to %s failed (attempt %d): %s" % (self.cas.get_name(), self.attempts, error))
+                continue
+            logger.warning("Reconnected to %s after %d attempts" % (self.cas.get_name(), self.attempts))
+            with self.lock:
+                self.connected = True
+            with self.cas.session_lock:
+                if self.stopped.is_set():
+                    return  # (disconnected, e.g. another device selected, while reconnecting)
+                try:
+                    self.cas.restore_session(session)
+                except Exception as error:
+                    logger.warning("Unable to restore session on %s: %s" % (self.cas.get_name(), error))
+            return
+
+    def stop(self):
+        self.stopped.set()
+# } ## class ConnectionSupervisor():
+
+
+theMetrics.describe('s2c_device_disconnects_total', 'counter', "Device connections lost")
+
+
+def find_device(name):
+    """ discover the device named name, returns it connected (None if not found)
+        - discovery is stopped once done, each pychromecast discovery otherwise keeps
+          its zeroconf browser (threads, sockets, the devices' records) running
+    """
+    if FAKE_DEVICES:
+        cc_audios, cc_groups = CcAudioStreamer.get_devices()
+        for cc in cc_audios + cc_groups:
+            if cc.name == name:
+                return cc
+        return None
+
+    ret = pychromecast.get_listed_chromecasts(friendly_names=[name])
+    ccs, browser = ret if isinstance(ret, tuple) else (ret, None)  # (see get_devices())
+    try:
+        for cc in ccs:
+            if cc.name == name:
+                cc.wait()
+                return cc
+        return None
+    finally:
+        if browser is not None:
+            if hasattr(browser, 'stop_discovery'):
+                browser.stop_discovery()
+            else:   # (PyChromecast 7.x)
+                pychromecast.discovery.stop_discovery(browser)
+
+
+# Memory watchdog
+#
+# Until the slow leak (see the TODO at the top) is found: with --max_rss_mb
+# the process restarts itself before the kernel's OOM killer gets to it.
+# - MemoryWatchdog samples RSS and calls on_limit once it passes
+#   RESTART_FRACTION of the ceiling
+# - the session (device, playlist, index, position, volume, up-next queue)
+#   is written to a handoff file (see CcAudioStreamer.get_handoff_state())
+#   and the process re-execs itself with S2C_HANDOFF=<file> in its
+#   environment; the new process reconnects to the device and resumes, so
+#   there's one short gap while it starts up
+# - no restart within MIN_UPTIME of starting (if a fresh process is already
+#   near the ceiling, restarting won't help)
+
+HANDOFF_ENV = "S2C_HANDOFF"
+
+def get_rss_kb():
+    """ resident set size of this process (KB), None where /proc isn't available
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError, IndexError):
+        return None
+
+class MemoryWatchdog():  # {
+    """ calls on_limit(rss_kb) (once) when RSS reaches RESTART_FRACTION of max_rss_mb
+    """
+    RESTART_FRACTION = 0.9
+    MIN_UPTIME = 60     # seconds
+    INTERVAL = 10       # seconds between samples
+
+    def __init__(self, max_rss_mb, on_limit, interval=None, min_uptime=None, get_rss=get_rss_kb):
+        self.max_rss_kb = max_rss_mb * 1024
+        self.on_limit = on_limit
+        self.interval = self.INTERVAL if interval is None else interval
+        self.min_uptime = self.MIN_UPTIME if min_uptime is None else min_uptime
+        self.get_rss = get_rss
+        self.start_time = time.time()
+        self.peak_rss_kb = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.get_rss() is None:
+            logger.warning("MemoryWatchdog: RSS not available on this platform, not watching")
+            return self
+        self.thread = threading.Thread(target=self._watch)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def _watch(self):
+        threshold = self.max_rss_kb * self.RESTART_FRACTION
+        warned = False
+        while not self.stopped.wait(self.interval):
+            rss = self.get_rss()
+            if rss is None:
+                continue
+            self.peak_rss_kb = max(self.peak_rss_kb, rss)
+            theMetrics.set('s2c_process_rss_bytes', (), rss * 1024)
+            if rss < threshold:
+                continue
+            if time.time() - self.start_time < self.min_uptime:
+                if not warned:
+                    logger.error("MemoryWatchdog: RSS %d MB near the %d MB limit %.0fs after starting, not restarting" % (
+                        rss // 1024, self.max_rss_kb // 1024, time.time() - self.start_time))
+                    warned = True
+                continue
+            logger.warning("MemoryWatchdog: RSS %d MB of %d MB limit" % (rss // 1024, self.max_rss_kb // 1024))
+            self.stopped.set()
+            self.on_limit(rss)
+
+    def stop(self):
+        self.stopped.set()
+# } ## class MemoryWatchdog():
+
+theMetrics.describe('s2c_process_rss_bytes', 'gauge', "Resident memory of this process (with --max_rss_mb)")
+
+def write_handoff(state, folder=None):
+    """ writes session state to a handoff file, returns its name
+    """
+    fd, filename = tempfile.mkstemp(prefix="s2c_handoff_", suffix=".json", dir=folder)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(state, f)
+    return filename
+
+def read_handoff():
+    """ session state handed off by the process that re-exec'd this one (see restart_with_handoff()),
+        None if there isn't any
+        - the handoff file is removed, and HANDOFF_ENV cleared (so it's not inherited)
+    """
+    filename = os.environ.pop(HANDOFF_ENV, None)
+    if not filename:
+        return None
+    try:
+        with open(filename) as f:
+            state = json.load(f)
+        os.remove(filename)
+    except (OSError, ValueError) as error:
+        logger.error("Unable to read handoff %s: %s" % (filename, error))
+        return None
+    logger.warning("Restarted (restart %d), resuming session on '%s' after %.1fs" % (
+        state.get('restarts', 0), state.get('device'), time.time() - state.get('time', time.time())))
+    return state
+
+def restart_with_handoff(state, argv=None):
+    """ re-exec this process with state handed off to the new one (doesn't return)
+    """
+    state['restarts'] = state.get('restarts', 0) + 1
+    os.environ[HANDOFF_ENV] = write_handoff(state)
+    logger.warning("Restarting (pid %d) with session handoff %s" % (os.getpid(), os.environ[HANDOFF_ENV]))
+    # atexit handlers don't run on exec
+    if theMediaProcesses:
+        theMediaProcesses.stop()    # (the new process starts its own)
+    if thePlayHistory:
+        thePlayHistory.close()
+    if theLoudness:
+        theLoudness.stop()
+    logging_listener.stop()     # writes out the queued records (QueueHandler.flush() doesn't)
+    NonBlockingConsole.restore_terminal()   # the new process's console saves the settings again
+    argv = argv or [sys.executable] + sys.argv
+    os.execv(argv[0], argv)
+
+
+class PlaylistScan():
+    """ progress of play_folder's walk of folder
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        self.start = time.perf_counter()
+        self.found = 0          # tracks found so far
+        self.done = False
+        self.elapsed = None     # seconds, once done
+        self.seen = set()
+
+    def __repr__(self):
+        if self.done:
+            return "<PlaylistScan %s: %d tracks in %.1fs>" % (self.folder, self.found, self.elapsed)
+        return "<PlaylistScan %s: %d tracks so far, %.1fs>" % (self.folder, self.found,
+            time.perf_counter() - self.start)
+
+class Playlist(list):
+    """ list of track paths
+        - .scan is the PlaylistScan while (and after) being built by play_folder
+    """
+    scan = None
 
 
 class CcAudioStreamer():  # {
@@ -186,6 +1923,9 @@ class CcAudioStreamer():  # {
         """
         """
         logger.info("Getting devices..")
+        if FAKE_DEVICES:
+            return get_fake_devices(FAKE_DEVICES, FAKE_DEVICE_SPEED)
+
         # get chromecasts
         # - API varies depending on PyChromecast version
         #  - doesn't seem to be way to determine PyChromecast version:
@@ -211,29 +1951,144 @@ class CcAudioStreamer():  # {
         logger.info("..done")
         return cc_audios, cc_groups
 
+    TRACK_HISTORY_LENGTH = 100  # tracks remembered for prev_track()
+
     def __init__(self, cc_device, **kwargs):
         """
         """
         self.cc = cc_device     # of type pychromecast.Chromecast
         self.cc.wait()
         self.new_media_status_callback = kwargs.get('new_media_status_callback', None)  # additional user-specified new_media_status callback
+        self.status_listeners = []  # fcn(snapshot) called per status, see _notify_status_listeners()
         self.mc = None
         self.state = 'UNKNOWN'
-        self.prev_playing_interrupted = datetime.datetime.now()
+        self.status_clock = datetime.datetime.now   # for new_media_status() timing, replaced when replaying
+        self.prev_playing_interrupted = self.status_clock()
         self.prev_filename = None
         self.master_playlist = []
         self.playlist = []
         self.playlist_index = None
+        self.playlist_source = None     # folder the playlist was built from
+        self.playlist_lock = threading.RLock()  # for changes while play_folder's walk is adding tracks
+        self.playlist_generation = 0    # incremented per playlist, ends stale play_folder walks
+        self.up_next = collections.deque()  # (track ID, path) queued to play before the rest of the playlist
+        self.queued_track = None        # path of the playing track if it was from up_next
+        self.track_history = collections.deque(maxlen=self.TRACK_HISTORY_LENGTH)    # for prev_track()
         self.muted = False
         self.pre_muted_vol = 0
-        self.consecutive_update_status_exceptions = 0
+        self.pre_muted_user_volume = None
+        self.find_device = kwargs.get('find_device', find_device)  # name -> device, for reconnecting
+        self.session_lock = kwargs.get('session_lock', threading.RLock())  # held to restore the session after reconnecting
+        self.write_cover = kwargs.get('write_cover', True)  # extract cover art to the web page's cover.jpg
+        self.supervisor = ConnectionSupervisor(self, **kwargs.get('supervisor_args', {}))
+        self.last_position = None   # (current_time, perf_counter() time, state) from last status
+        self.history_track = None   # (filename, artist, title, album) of track for play-history
+        self.transitions = TransitionStats()
+        self.transition = None      # TransitionTimer while advancing to next track
+        self.expected_end = None    # perf_counter() time current track expected to finish
+        self.gain_mode = kwargs.get('gain_mode', GAIN_MODE)    # see "Loudness"
+        self.playlist_album_mode = False    # playing an album (album gain)
+        self.gain_factor = 1.0      # volume factor applied for the current track's gain
+        self.user_volume = None     # user's chosen volume (before the gain factor)
 
     def disconnect(self):
         """
         """
         assert self.cc
+        self.supervisor.stop()
+        self.supervisor.connected = False
         self.cc.disconnect()
 
+    def is_connected(self):
+        return self.supervisor.connected
+
+    def reconnect(self):
+        """ rediscover the device and re-establish the media controller
+            - raises exception on failure
+        """
+        cc = self.find_device(self.get_name())
+        if cc is None:
+            raise ConnectionError("device not found")
+        cc.wait()
+        try:
+            self.cc.disconnect()
+        except Exception:
+            pass
+        self.cc = cc
+        self.mc = None
+        self._prep_media_controller(verbose_listener=getattr(self, 'verbose_listener', False))
+        self.mc.update_status()
+
+    def get_session(self):
+        """ returns (state, playlist_index, position) -- playback state to restore after reconnect
+        """
+        position = None
+        if self.last_position:
+            current_time, timestamp, state = self.last_position
+            position = current_time
+            if state == 'PLAYING':
+                position += time.perf_counter() - timestamp
+        return self.state, self.playlist_index, position
+
+    def restore_session(self, session):
+        """ resume playback from get_session() after reconnect
+        """
+        state, playlist_index, position = session
+        if state not in ('PLAYING', 'PAUSED', 'BUFFERING') or not (self.playlist or self.queued_track):
+            return
+        if playlist_index is not None and playlist_index < len(self.playlist):
+            self.playlist_index = playlist_index
+        logger.info("Restoring session: track %s/%d%s at %s (%s)" % (self.playlist_index, len(self.playlist),
+            " (queued track)" if self.queued_track else "", to_min_sec(position), state))
+        self.play(self.get_playlist_current_file(), start_time=position,
+                verbose_listener=getattr(self, 'verbose_listener', False))
+        if state == 'PAUSED':
+            self.pause()
+
+    def get_handoff_state(self):
+        """ returns JSON-able session state, for restore_handoff_state() in another process
+            - see "Memory watchdog"
+        """
+        self.get_track_info()   # (updates last_position)
+        state, playlist_index, position = self.get_session()
+        volume = self.pre_muted_user_volume if self.muted else self.user_volume
+        with self.playlist_lock:
+            return {
+                    'device': self.get_name(),
+                    'time': time.time(),
+                    'state': state,
+                    'position': position,
+                    'playlist': list(self.playlist),
+                    'playlist_index': playlist_index,
+                    'playlist_source': self.playlist_source,
+                    'album_mode': self.playlist_album_mode,
+                    'queued_track': self.queued_track,
+                    'up_next': [path for _, path in self.get_up_next()],
+                    'volume': volume if volume is not None else self.get_vol(),
+                    'muted': self.muted,
+                    }
+
+    def restore_handoff_state(self, handoff):
+        """ resume the session from get_handoff_state()
+        """
+        with self.playlist_lock:
+            self.playlist_album_mode = handoff.get('album_mode', False)
+            self.playlist_source = handoff.get('playlist_source')
+            self.master_playlist = handoff.get('playlist') or []
+            self.playlist = self.master_playlist
+            self.playlist_index = handoff.get('playlist_index') if self.playlist else None
+            self.queued_track = handoff.get('queued_track')
+        self.enqueue([path for path in handoff.get('up_next', []) if os.path.isfile(path)])
+        if handoff.get('volume') is not None:
+            self.set_vol(handoff['volume'])
+        if handoff.get('muted') and not self.muted:
+            self.vol_toggle_mute()  # before playing, which keeps it muted
+        position = handoff.get('position')
+        if position is not None and handoff.get('state') in ('PLAYING', 'BUFFERING'):
+            position += time.time() - handoff['time']  # carried on playing during the restart
+        if self.queued_track or self.playlist:
+            self.restore_session((handoff.get('state'), self.playlist_index, position))
+
     def get_name(self):
         return self.cc.name
 
@@ -251,18 +2106,124 @@ class CcAudioStreamer():  # {
         if self.verbose_listener:
             logger.info(msg)
 
+    def _record_history(self, event):
+        """ records event for the current play-history track
+            - 'end' or 'skip' also clear the current track
+        """
+        if self.history_track is None:
+            return
+        if thePlayHistory:
+            filename, artist, title, album = self.history_track
+            thePlayHistory.record(event, filename, artist, title, album, device=self.get_name())
+        if event != 'start':
+            self.history_track = None
+
+    def _mark_transition(self, phase):
+        if self.transition:
+            self.transition.mark(phase)
+
+    def _finish_transition(self):
+        self._mark_transition('first_playing')
+        self.transitions.add(self.transition)
+        self.transition = None
+
+    def _notify_status_listeners(self, status):
+        """ passes a snapshot of status to each of self.status_listeners
+            - a snapshot since pychromecast updates its status object in place
+            returns True
+        """
+        if self.status_listeners:
+            snapshot = {'time': time.time(), 'perf_time': time.perf_counter(), 'state': self.state}
+            for field in ('player_state', 'idle_reason', 'content_id', 'artist', 'title', 'album_name',
+                    'current_time', 'duration', 'playback_rate'):
+                snapshot[field] = getattr(status, field, None)
+            for listener in list(self.status_listeners):
+                listener(snapshot)
+        return True
+
     def incr_playlist_index(self):
-        if not self.playlist_index is None:
-            self.playlist_index += 1
-            if self.playlist_index >= len(self.playlist):
-                random.shuffle(self.playlist)
-                self.playlist_index = 0
+        with self.playlist_lock:
+            if not self.playlist_index is None:
+                self.playlist_index += 1
+                if self.playlist_index >= len(self.playlist):
+                    random.shuffle(self.playlist)
+                    self.playlist_index = 0
+                    self.track_history.clear()  # (indexes no longer valid)
 
     def decr_playlist_index(self):
-        if not self.playlist_index is None:
-            self.playlist_index -= 1
-            if self.playlist_index < 0:
-                self.playlist_index = len(self.playlist) - 1
+        with self.playlist_lock:
+            if not self.playlist_index is None:
+                self.playlist_index -= 1
+                if self.playlist_index < 0:
+                    self.playlist_index = len(self.playlist) - 1
+
+    # Up-next queue
+    #
+    # up_next is a deque of (track ID, path) (see theTracks) played, in order,
+    # before the rest of the playlist, so queueing a track is O(1) whatever the
+    # size of the playlist, and leaves the playlist and playlist_index alone.
+    # - the path is kept as queued (theLibrary's form for library tracks), so
+    #   gain, bitrate and history lookups by path work as for playlist tracks
+    # - while a queued track plays, playlist_index stays on the playlist track
+    #   played before it, so the playlist carries on from there
+    # - track_history has (queued_track, playlist_index) per track played, so
+    #   prev_track() goes back through queued tracks too (re-queueing them)
+
+    def enqueue(self, filenames, play_next=False):
+        """ queue tracks, after those already queued or (play_next) before them
+            returns list of their track IDs
+        """
+        for filename in filenames:
+            if not os.path.isfile(filename):
+                raise ValueError("Invalid file: %s" % filename)
+        entries = [(theTracks.register(filename), filename) for filename in filenames]
+        with self.playlist_lock:
+            if play_next:
+                self.up_next.extendleft(reversed(entries))
+            else:
+                self.up_next.extend(entries)
+        return [tid for tid, _ in entries]
+
+    def clear_up_next(self):
+        with self.playlist_lock:
+            self.up_next.clear()
+
+    def get_up_next(self):
+        """ returns list of (track ID, path) of the queued tracks
+        """
+        with self.playlist_lock:
+            return list(self.up_next)
+
+    def next_file(self):
+        """ advance to the next track: from up_next, otherwise the playlist
+            returns its path, None if there's nothing to play
+        """
+        with self.playlist_lock:
+            if not self.up_next and not self.playlist:
+                return None
+            if self.queued_track or self.playlist_index is not None:
+                self.track_history.append((self.queued_track, self.playlist_index))
+            if self.up_next:
+                _, self.queued_track = self.up_next.popleft()
+                return self.queued_track
+            self.queued_track = None
+            self.incr_playlist_index()
+            return self.playlist[self.playlist_index]
+
+    def prev_file(self):
+        """ go back to the previously played track, returns its path, None if there's nothing to play
+        """
+        with self.playlist_lock:
+            if self.track_history:
+                if self.queued_track:
+                    self.up_next.appendleft((theTracks.register(self.queued_track), self.queued_track))
+                self.queued_track, self.playlist_index = self.track_history.pop()
+            elif self.queued_track and self.playlist:
+                self.up_next.appendleft((theTracks.register(self.queued_track), self.queued_track))
+                self.queued_track = None    # to the playlist track played before it
+            elif self.playlist:
+                self.decr_playlist_index()
+            return self.get_playlist_current_file()
 
     def new_media_status(self, status):  # {
         """ status listener/callback implementation
@@ -270,6 +2231,8 @@ class CcAudioStreamer():  # {
             - it is registered via the call: self.mc.register_status_listener(self)
         """
 
+        notified = False
+
         # (status.player_state == 'IDLE' and status.idle_reason == 'FINISHED')
         # - is a normal case indicating the song previously playing has completed
         # - i.e. device is IDLE because it FINISHED
@@ -282,11 +2245,25 @@ class CcAudioStreamer():  # {
                 # typically self.state == 'PLAYING' -- indicating we were playing a song
                 self.verbose_logger("Status: FINISHED")
                 self.state = 'IDLE'
-                # play the next playlist entry if that's what we were doing (indicated by valid playlist)
-                if self.playlist:
-                    self.incr_playlist_index()
-                    logger.info("Advancing PlayList to Track#: %d/%d" % (self.playlist_index, len(self.playlist)))
-                    self.play(self.playlist[self.playlist_index], verbose_listener = self.verbose_listener)
+                self._record_history('end')
+                # before advancing, so listeners see FINISHED before the next track's statuses
+                notified = self._notify_status_listeners(status)
+                # play the next queued/playlist entry if that's what we were doing (indicated by valid playlist)
+                if self.playlist or self.up_next:
+                    arrival_delay = None
+                    if self.expected_end is not None:
+                        arrival_delay = time.perf_counter() - self.expected_end
+                    self.transition = TransitionTimer(arrival_delay)
+                    filename = self.next_file()
+                    self._mark_transition('index_advance')
+                    if filename:
+                        if self.queued_track:
+                            logger.info("Advancing to queued track (%d more queued)" % len(self.up_next))
+                        else:
+                            logger.info("Advancing PlayList to Track#: %d/%d" % (self.playlist_index, len(self.playlist)))
+                        self.play(filename, verbose_listener = self.verbose_listener)
+                    else:
+                        self.transition = None
         elif status.player_state == 'IDLE' and status.idle_reason == 'CANCELLED':
             if self.state != 'IDLE':
                 self.verbose_logger("Status: STOPPED")
@@ -303,7 +2280,7 @@ class CcAudioStreamer():  # {
             if self.state == 'PAUSED':
                 self.verbose_logger("Status: RESUMED")
             elif self.state == 'PLAYING':
-                cur_time = datetime.datetime.now()
+                cur_time = self.status_clock()
                 diff = cur_time - self.prev_playing_interrupted
                 #logger.info(" -- time since previous: %d.%06d" % (diff.seconds, diff.microseconds))
                 if diff.seconds >= 2:
@@ -322,34 +2299,188 @@ class CcAudioStreamer():  # {
             #self.verbose_logger("Status: Spurious event: .player_state = %s, idle_reason = %s" % (status.player_state, status.idle_reason))
             pass
 
+        if status is not None and status.player_state == 'PLAYING':
+            if self.transition:
+                if self.transition.in_play:
+                    # reported while play() still waiting on device, finished when play() returns
+                    self.transition.playing_seen = True
+                else:
+                    self._finish_transition()
+            # for measuring how late the FINISHED status arrives
+            current_time = getattr(status, 'adjusted_current_time', None) or status.current_time
+            if status.duration and current_time is not None:
+                self.expected_end = time.perf_counter() + (status.duration - current_time)
+
+        if not notified:
+            self._notify_status_listeners(status)
+
         # if caller specified a listener/callback, call that
         if self.new_media_status_callback:
             self.new_media_status_callback()
     # }
 
-    def play_folder(self, play_folder):
-        """ Build list of folder contents and play it
+    PLAYLIST_START_BUDGET = 0.5     # seconds of folder walk before play_folder starts playing
+
+    def play_folder(self, play_folder, start_budget=None):
+        """ Play shuffled folder contents, while the folder is still being walked
+            - playback starts on a random one of the tracks found within start_budget seconds
+            - the walk continues in the background, see _walk_folder()
+            - get_playlist().scan reports the walk's progress
         """
-        posixPath_list = list(pathlib.Path(play_folder).rglob("*.[mM][pP]3"))
-        if posixPath_list:
-            filelist = [str(pp) for pp in posixPath_list]
-            random.shuffle(filelist)
-            print("\rPlaying folder (%s) with %d files" % (play_folder, len(filelist)))
+        start_budget = self.PLAYLIST_START_BUDGET if start_budget is None else start_budget
+        playlist = Playlist()
+        playlist.scan = PlaylistScan(str(pathlib.Path(play_folder)))
+        with self.playlist_lock:
+            self.playlist_generation += 1
+        started = threading.Event()
+        walker = threading.Thread(target=self._walk_folder,
+                args=(playlist, self.playlist_generation, start_budget, started))
+        walker.daemon = True
+        walker.start()
+        started.wait()
+
+        with self.playlist_lock:
+            if not playlist:
+                print("No files found under play folder: %s" % (play_folder))
+                return
+            print("\rPlaying folder (%s) with %d files%s" % (play_folder, len(playlist),
+                "" if playlist.scan.done else " (still scanning)"))
+        self.play_list(playlist, source=playlist.scan.folder)
+
+    def _walk_folder(self, playlist, generation, start_budget, started):
+        """ play_folder() background walk: adds the tracks found to the playlist
+            - each track is swapped into a random position of the not-yet-played part
+              (inside-out Fisher-Yates), so the play order stays uniformly random
+              however late the track is found
+            - sets started once start_budget has elapsed (with a track found), or the walk is done
+        """
+        scan = playlist.scan
+        deadline = time.perf_counter() + start_budget
+        for path in find_tracks(scan.folder):
+            with self.playlist_lock:
+                if self.playlist_generation != generation:
+                    return  # another playlist started
+                if path in scan.seen:
+                    continue    # (added by update_playlist)
+                scan.seen.add(path)
+                scan.found += 1
+                target = self.playlist if getattr(self.playlist, 'scan', None) is scan else playlist
+                first = 0
+                if target is self.playlist and self.playlist_index is not None:
+                    first = self.playlist_index + 1
+                target.append(path)
+                j = random.randint(first, len(target) - 1)
+                target[-1], target[j] = target[j], target[-1]
+            if not started.is_set() and time.perf_counter() >= deadline:
+                started.set()
+        with self.playlist_lock:
+            scan.done = True
+            scan.elapsed = time.perf_counter() - scan.start
+        logger.info("Playlist scan done: %d files in %.1fs" % (scan.found, scan.elapsed))
+        started.set()
+
+    def play_album(self, album, artist=None):
+        """ play album's tracks (from theLibrary) in order, with album gain
+        """
+        filelist = sorted(theLibrary.filter(artist=artist, album=album))
+        if filelist:
+            print("\rPlaying album (%s) with %d files" % (album, len(filelist)))
+            self.play_list(filelist, album_mode=True)
+        else:
+            print("No tracks found for album: %s" % album)
 
+    def play_m3u(self, filename):
+        """ play playlist file (.m3u/.m3u8) in its order
+            returns (number of tracks, list of missing entries)
+        """
+        filelist, missing = load_m3u(filename)
+        if filelist:
+            print("\rPlaying playlist (%s) with %d files%s" % (filename, len(filelist),
+                ", %d missing" % len(missing) if missing else ""))
             self.play_list(filelist)
         else:
-            print("No files found under play folder: %s" % (play_folder))
+            print("No tracks found in playlist: %s" % filename)
+        return len(filelist), missing
 
-    def play_list(self, filelist, verbose_listener=False):
+    def export_m3u(self, filename):
+        """ save the current playlist, in play order from the current track, to playlist file
+            returns number of tracks saved
         """
+        with self.playlist_lock:
+            index = self.playlist_index or 0
+            filelist = list(self.playlist[index:]) + list(self.playlist[:index]) if self.playlist else []
+        return save_m3u(filelist, filename)
+
+    def play_list(self, filelist, verbose_listener=False, source=None, album_mode=False):
+        """
+            source - folder that filelist was built from (if any), for live library updates
+            album_mode - filelist is an album, so album gain is applied
         """
-        self.master_playlist = filelist
-        self.playlist = self.master_playlist
-        self.playlist_index = 0
+        with self.playlist_lock:
+            if getattr(filelist, 'scan', None) is None:
+                self.playlist_generation += 1   # stops any play_folder walk
+            self.playlist_album_mode = album_mode
+            self.playlist_source = source
+            self.master_playlist = filelist
+            self.playlist = self.master_playlist
+            self.playlist_index = 0
+            self.queued_track = None
+            self.track_history.clear()
         self.play(self.playlist[self.playlist_index], verbose_listener=verbose_listener)
 
-    def get_playlist(self):
+    def update_playlist(self, added=(), removed=()):
+        """ apply library changes to a playlist built by play_folder
+            - removed tracks are dropped (the current track keeps playing)
+            - added tracks are shuffled into the not-yet-played part of the playlist
         """
+        with self.playlist_lock:
+            if removed:
+                self.track_history.clear()  # (indexes no longer valid)
+            self._update_playlist(added, removed)
+
+    def _update_playlist(self, added, removed):
+        if not self.playlist or self.playlist_source is None:
+            return
+        prefix = os.path.join(self.playlist_source, "")
+        added = [p for p in added if p.startswith(prefix)]
+        removed = set(p for p in removed if p.startswith(prefix))
+
+        scan = getattr(self.playlist, 'scan', None)
+        if scan:
+            scan.seen.update(added)     # so the play_folder walk doesn't add them again
+        playlist = self.playlist
+        index = self.playlist_index
+        if removed:
+            current_removed = playlist[index] in removed
+            index = sum(1 for p in playlist[:index] if p not in removed)
+            if current_removed:
+                index -= 1  # so that advancing plays the track after the removed one
+            playlist = [p for p in playlist if p not in removed]
+        if added:
+            existing = set(playlist)
+            added = [p for p in added if p not in existing]
+            unplayed = playlist[index+1:] + added
+            random.shuffle(unplayed)
+            playlist = playlist[:index+1] + unplayed
+        if len(playlist) == 0:
+            self.playlist = []
+            self.playlist_index = None
+            return
+        if index < 0:
+            # the current track was the first, so none of the others have been played:
+            # stay on the last, advancing then wraps round and reshuffles, which
+            # plays an unplayed track all the same
+            index = len(playlist) - 1
+        logger.info("Playlist updated: %d added, %d removed, %d tracks" % (
+            len(added), len(removed), len(playlist)))
+        playlist = Playlist(playlist)
+        playlist.scan = scan
+        self.master_playlist = playlist
+        self.playlist = playlist
+        self.playlist_index = index
+
+    def get_playlist(self):
+        """ returns Playlist (list of paths), its .scan has progress of a play_folder walk
         """
         return self.playlist
 
@@ -359,23 +2490,47 @@ class CcAudioStreamer():  # {
         return self.playlist_index
 
     def get_playlist_current_file(self):
+        """ path of the playing queued track or playlist entry, None if neither
         """
-        """
+        if self.queued_track:
+            return self.queued_track
+        if not self.playlist or self.playlist_index is None:
+            return None
         return self.playlist[self.playlist_index]
 
     # playback controls
 
-    def play(self, filename, mime_type='audio/mpeg',
-            server='http://' + IP_ADDRESS + ':%d/' % PORT,
-            verbose_listener=True):
+    def play(self, filename, mime_type='audio/mpeg', server=None, verbose_listener=True, start_time=None):
         """
+            server - base url of http server, defaults to this machine's (media) server
+            start_time - position (seconds) to start from, when resuming the current track
         """
+        try:
+            self._play(filename, mime_type, server, verbose_listener, start_time)
+        finally:
+            if self.transition and self.transition.in_play:
+                self.transition = None  # play failed, not to be charged to the next one
+
+    def _play(self, filename, mime_type, server, verbose_listener, start_time):
+        if server is None:
+            server = 'http://%s:%d/' % (IP_ADDRESS, MEDIA_PORT or PORT)
         self.prev_filename = filename
+        if self.transition:
+            self.transition.in_play = True
         assert os.path.isfile(filename), "Invalid file: %s" % (filename)
-        url = server + urllib.request.pathname2url(filename)
+        self._mark_transition('file_check')
+        tid = theTracks.register(filename)
+        url = server + "t/" + tid
         logger.info("Play: %s" % url)
         self._prep_media_controller(verbose_listener=verbose_listener)
-        ez = mutagen.easyid3.EasyID3(filename)
+        is_mp3 = filename.lower().endswith(".mp3")
+        if not is_mp3:
+            # transcoded to mp3 when served, see "Transcoding"
+            mime_type = 'audio/mpeg'
+            ez = mutagen.File(filename, easy=True)
+            ez = ez.tags if ez is not None and ez.tags is not None else {}
+        else:
+            ez = mutagen.easyid3.EasyID3(filename)
         try:
             artist = ez['artist'][0]
         except:
@@ -389,39 +2544,56 @@ class CcAudioStreamer():  # {
         except:
             album = "Unknown album"
         metadata = {'artist': artist, 'title': title, 'albumName': album}
-
-        # extract cover art to 'cover.jpg'
-        assert SERVER_DIRECTORY, "SERVER_DIRECTORY not set properly"
-        assert WEB_PAGE_REL_PATH, "WEB_PAGE_REL_PATH not set properly"
-        pic_filename = os.path.join(SERVER_DIRECTORY, WEB_PAGE_REL_PATH, "cover.jpg")
-        try:
-            os.remove(pic_filename)  # remove old image
-        except OSError:  # in case file doesn't exist
-            pass
-
-        tags = mutagen.id3.ID3(filename)
-        keys = ["APIC:", "APIC:Cover"]  # try these keys
-        for key in keys:
-            pic_tag = tags.get(key)
-            if pic_tag:
-                pic_data = pic_tag.data
-                if len(pic_data) > 0:
-                    with open(pic_filename, "wb") as pic_file:
-                        pic_file.write(pic_data)
-                    break
-
-        self.mc.play_media(url, mime_type, metadata=metadata)
-        self.mc.block_until_active(3) # required to "connect" the media controller to the CC session
+        self._mark_transition('tag_parse')
+
+        # extract cover art to 'cover.jpg' (not for fanout sessions, the web page shows the selected device)
+        pic_data = read_track_art(filename)
+        if self.write_cover:
+            assert SERVER_DIRECTORY, "SERVER_DIRECTORY not set properly"
+            assert WEB_PAGE_REL_PATH, "WEB_PAGE_REL_PATH not set properly"
+            pic_filename = os.path.join(SERVER_DIRECTORY, WEB_PAGE_REL_PATH, "cover.jpg")
+            try:
+                os.remove(pic_filename)  # remove old image
+            except OSError:  # in case file doesn't exist
+                pass
+            if pic_data:
+                with open(pic_filename, "wb") as pic_file:
+                    pic_file.write(pic_data)
+        self._mark_transition('cover_extraction')
+
+        self._apply_gain(filename)
+
+        resuming = start_time and self.history_track and self.history_track[0] == filename
+        if not resuming:
+            # previous track replaced before it finished
+            self._record_history('skip')
+            self.history_track = (filename, artist, title, album)
+            self._record_history('start')
+
+        self.expected_end = None
+        play_media_kwargs = {'current_time': start_time} if start_time else {}
+        if pic_data:
+            play_media_kwargs['thumb'] = server + "a/" + tid
+        with theMetrics.time('s2c_device_call_duration_seconds', (('call', 'play_media'),)):
+            self.mc.play_media(url, mime_type, metadata=metadata, **play_media_kwargs)
+        self._mark_transition('play_media')
+        with theMetrics.time('s2c_device_call_duration_seconds', (('call', 'block_until_active'),)):
+            self.mc.block_until_active(3) # required to "connect" the media controller to the CC session
+        self._mark_transition('block_until_active')
+        if self.transition:
+            self.transition.in_play = False
+            if self.transition.playing_seen:
+                self._finish_transition()
 
     def next_track(self):
-        if self.playlist:
-            self.incr_playlist_index()
-            self.play(self.playlist[self.playlist_index], verbose_listener=False)
+        filename = self.next_file()
+        if filename:
+            self.play(filename, verbose_listener=False)
 
     def prev_track(self):
-        if self.playlist:
-            self.decr_playlist_index()
-            self.play(self.playlist[self.playlist_index], verbose_listener=False)
+        filename = self.prev_file()
+        if filename:
+            self.play(filename, verbose_listener=False)
 
     def pause(self):
         logger.info("Pause: ")
@@ -457,6 +2629,7 @@ class CcAudioStreamer():  # {
 
     def stop(self):
         logger.info("Stop: ")
+        self._record_history('skip')
         self._prep_media_controller()
         self.mc.stop()
 
@@ -466,11 +2639,16 @@ class CcAudioStreamer():  # {
         """
         """
         if self.muted:
-            self.set_vol(self.pre_muted_vol)
+            if self.pre_muted_user_volume is not None:
+                # gain may have changed while muted
+                self.set_vol(min(1.0, self.pre_muted_user_volume * self.gain_factor))
+            else:
+                self.set_vol(self.pre_muted_vol)
             self.muted = False
             logger.info("Vol UNMuted")
         else:
             self.pre_muted_vol = self.get_vol()
+            self.pre_muted_user_volume = self.user_volume
             self.set_vol(0)
             self.muted = True
             logger.info("Vol Muted")
@@ -486,7 +2664,8 @@ class CcAudioStreamer():  # {
             cur_vol = self.get_vol()
             new_vol = min(cur_vol + step, 1.0)
             logger.info("VolUp: Adjusting volume from %.2f -> %.2f" % (cur_vol, new_vol))
-            self.cc.set_volume(new_vol)
+            self._set_volume(new_vol)
+            self._user_volume_changed(new_vol)
         return cur_vol, new_vol
 
     def vol_down(self, step=0.1):
@@ -500,7 +2679,8 @@ class CcAudioStreamer():  # {
             cur_vol = self.get_vol()
             new_vol = max(cur_vol - step, 0)
             logger.info("VolDown: Adjusting volume from %.2f -> %.2f" % (cur_vol, new_vol))
-            self.cc.set_volume(new_vol)
+            self._set_volume(new_vol)
+            self._user_volume_changed(new_vol)
         return cur_vol, new_vol
 
     def get_vol(self):
@@ -520,35 +2700,62 @@ class CcAudioStreamer():  # {
         """
         new_vol = float(new_vol)
         logger.info("SetVol: Setting volume to %.2f" % (new_vol))
-        self.cc.set_volume(new_vol)
+        self._set_volume(new_vol)
+        self._user_volume_changed(new_vol)
+
+    def _user_volume_changed(self, new_vol):
+        if self.gain_factor > 0:
+            self.user_volume = new_vol / self.gain_factor
+
+    def _apply_gain(self, filename):
+        """ set receiver volume for filename's gain, relative to the user's chosen volume
+            - album gain in album mode (gain_mode 'album', or playing an album)
+            - tracks without a known gain play at the user's volume
+        """
+        if self.gain_mode not in ('track', 'album'):
+            return
+        album = self.gain_mode == 'album' or self.playlist_album_mode
+        gain = theLibrary.get_gain(filename, album=album)
+        factor = 10 ** (gain / 20) if gain is not None else 1.0
+        if self.muted:
+            self.gain_factor = factor
+            return
+        if self.user_volume is None:
+            self.user_volume = self.get_vol() / self.gain_factor
+        new_vol = min(1.0, self.user_volume * factor)
+        self.gain_factor = factor
+        if abs(new_vol - self.get_vol()) >= 0.005:
+            logger.info("Gain: %s%.1f dB, volume %.2f -> %.2f" % ("album " if album else "",
+                gain or 0.0, self.get_vol(), new_vol))
+            self._set_volume(new_vol)
+
+    def _set_volume(self, new_vol):
+        with theMetrics.time('s2c_device_call_duration_seconds', (('call', 'set_volume'),)):
+            self.cc.set_volume(new_vol)
 
     def get_track_info(self):  # {
         """
             returns tuple of strings for (artist, title, album, current_time, duration)
-            returns None if loses connection with device
+            - empty strings while disconnected (see is_connected()) from device
         """
+        if not self.supervisor.connected:
+            # no polling while the supervisor reconnects
+            return ("", "", "", "", "")
         self._prep_media_controller()
         track_info = ""
         if self.state == 'PLAYING' or self.state == 'PAUSED':
             try:
-                self.mc.update_status()
+                with theMetrics.time('s2c_device_call_duration_seconds', (('call', 'update_status'),)):
+                    self.mc.update_status()
             except (pychromecast.error.UnsupportedNamespace, 
                     pychromecast.error.NotConnected,
                     pychromecast.error.ControllerNotRegistered) as error:
-                logger.warning("Handled exception from: self.mc.update_status()!: %d" % self.consecutive_update_status_exceptions)
+                theMetrics.inc('s2c_device_exceptions_total',
+                        (('call', 'update_status'), ('error', type(error).__name__)))
+                logger.warning("Handled exception from: self.mc.update_status()!")
                 logger.warning("  %s" % error)
                 track_info = ("", "", "", "", "")  # artist, title, album, cur_time, duration
-                if self.consecutive_update_status_exceptions == 0:
-                    self.update_status_exceptions_start_time = datetime.datetime.now()
-                else:
-                    elapsed = datetime.datetime.now() - self.update_status_exceptions_start_time
-                    MAX_DURATION_EXCEPTIONS = 4
-                    if elapsed.seconds >= MAX_DURATION_EXCEPTIONS:
-                        logger.error("Got %d consecutive update status exceptions over %d seconds, disconnecting.."
-                                % (self.consecutive_update_status_exceptions, elapsed.seconds))
-                        self.state = 'IDLE'
-                        return None
-                self.consecutive_update_status_exceptions += 1
+                self.supervisor.report_failure(error)
             else:
                 artist = self.mc.status.artist
                 artist = "" if artist is None else artist
@@ -559,37 +2766,463 @@ class CcAudioStreamer():  # {
                 track_info = (artist, title, album,
                     to_min_sec(self.mc.status.current_time),
                     to_min_sec(self.mc.status.duration))
-                self.consecutive_update_status_exceptions = 0
+                if self.mc.status.current_time is not None:
+                    self.last_position = (self.mc.status.current_time, time.perf_counter(), self.state)
         return track_info
     # }
 
-    def monitor_status(self):  # {
+    def monitor_status(self, json_lines=False, out=None, stop=None, refresh=0.25):  # {
+        """ prints state changes as status events arrive from the device
+            - each state/track change printed once, in arrival order
+            - position line refreshed every refresh seconds from a clock interpolated
+              from the last status (no device round-trips after the initial one)
+            json_lines - print one JSON object per event instead (no position line)
+            out - file to print to (default stdout)
+            stop - threading.Event, returns when set (default: runs until interrupted)
         """
+        out = out or sys.stdout
+        events = queue.Queue()
+        self.status_listeners.append(events.put)
+        try:
+            self._prep_media_controller()
+            self.mc.update_status()     # initial state
+            prev_state = None
+            prev_track = None
+            clock = None    # (current_time, perf_time, playback_rate), while PLAYING
+            track = {}
+            while not (stop and stop.is_set()):
+                try:
+                    event = events.get(timeout=refresh)
+                except queue.Empty:
+                    event = None
+                if event:
+                    state = event['state']
+                    if state == 'PLAYING' and event['current_time'] is not None:
+                        clock = (event['current_time'], event['perf_time'], event['playback_rate'] or 1)
+                    elif state != 'PLAYING':
+                        clock = None
+                    cur_track = (event['content_id'], event['title'])
+                    if event['content_id'] and state in ('PLAYING', 'BUFFERING', 'PAUSED'):
+                        track = event   # latest, duration may arrive after PLAYING
+                    changed = state != prev_state
+                    new_track = event['content_id'] and cur_track != prev_track and state == 'PLAYING'
+                    if changed or new_track:
+                        if new_track:
+                            prev_track = cur_track
+                        if json_lines:
+                            out.write(json.dumps({
+                                'time': round(event['time'], 3),
+                                'event': 'state' if changed else 'track',
+                                'state': state,
+                                'artist': event['artist'], 'title': event['title'], 'album': event['album_name'],
+                                'position': event['current_time'], 'duration': event['duration'],
+                                'idle_reason': event['idle_reason'],
+                                }) + "\n")
+                        else:
+                            out.write(" " * 120 + "\r")    # clear position line
+                            addtl_info = ": %s - %s (%s)" % (
+                                event['artist'], event['title'], event['album_name']) if state == 'PLAYING' else ""
+                            out.write("%s State change -> %s%s\n" % (
+                                time.strftime("%H:%M:%S", time.localtime(event['time'])), state, addtl_info))
+                        out.flush()
+                        prev_state = state
+                if not json_lines and clock and events.empty():
+                    position = clock[0] + (time.perf_counter() - clock[1]) * clock[2]
+                    if track.get('duration'):
+                        position = min(position, track['duration'])
+                    out.write("%s - %s (%s) %s/%s \r" % (
+                        track.get('artist'), track.get('title'), track.get('album_name'),
+                        to_min_sec(position), to_min_sec(track.get('duration'))))
+                    out.flush()
+        finally:
+            self.status_listeners.remove(events.put)
+    # }
+
+# } ## class CcAudioStreamer():
+
+
+# Fake Chromecast
+#
+# Stand-in for a pychromecast.Chromecast that runs locally, for offline
+# end-to-end tests and benchmarks:
+#   cas = CcAudioStreamer(FakeChromecast("Fake Kitchen", speed=20))
+# - implements the parts of the Chromecast / media-controller API that
+#   CcAudioStreamer uses
+# - actually fetches the media from our http server (so server load is real),
+#   reports BUFFERING then PLAYING once the first bytes arrive, and IDLE/FINISHED
+#   when the track's duration has elapsed
+# - speed scales the playback clock, e.g. speed=60 plays a 3 minute track in 3s
+# - status listeners are called from the fake's playback thread, as pychromecast
+#   calls them from its socket thread
+
+import io
+import urllib.request
+
+class FakeMediaStatus():
+    """ subset of pychromecast.controllers.media.MediaStatus
+    """
+    def __init__(self):
+        self.player_state = 'UNKNOWN'
+        self.idle_reason = None
+        self.content_id = None
+        self.content_type = None
+        self.current_time = 0
+        self.duration = None
+        self.artist = None
+        self.title = None
+        self.album_name = None
+        self.playback_rate = 1
+
+    def copy(self):
+        status = FakeMediaStatus()
+        status.__dict__.update(self.__dict__)
+        return status
+
+
+class FakeCastStatus():
+    """ subset of pychromecast.socket_client.CastStatus
+    """
+    def __init__(self):
+        self.volume_level = 0.5
+        self.volume_muted = False
+
+
+class FakeMediaController():  # {
+    """ subset of pychromecast.controllers.media.MediaController
+    """
+    FETCH_CHUNK = 64 * 1024
+    TICK = 0.01     # playback thread's clock resolution, in (wall-clock) seconds
+
+    def __init__(self, cast):
+        self.cast = cast
+        self.listeners = []
+        self.lock = threading.RLock()
+        self.status = FakeMediaStatus()
+        self.status.playback_rate = cast.speed
+        self.generation = 0         # incremented per load, ends stale playback threads
+        self.position = 0.0         # media seconds played
+        self.position_time = None   # wall-clock time of position, None when not advancing
+        self.active = threading.Event()
+
+    def register_status_listener(self, listener):
+        self.listeners.append(listener)
+
+    def _notify(self):
+        status = self.status.copy()
+        for listener in list(self.listeners):
+            listener.new_media_status(status)
+
+    def _set_state(self, generation, player_state, idle_reason=None):
+        with self.lock:
+            if generation != self.generation:
+                return False
+            self._update_position()
+            self.status.player_state = player_state
+            self.status.idle_reason = idle_reason
+            advancing = player_state == 'PLAYING'
+            self.position_time = time.time() if advancing else None
+            self.status.current_time = self.position
+        self._notify()
+        return True
+
+    def _update_position(self):
+        if self.position_time is not None:
+            now = time.time()
+            self.position += (now - self.position_time) * self.cast.speed
+            self.position_time = now
+
+    def play_media(self, url, content_type, metadata=None, **kwargs):
+        metadata = metadata or {}
+        with self.lock:
+            interrupted = self.status.player_state in ('PLAYING', 'PAUSED', 'BUFFERING')
+            self.generation += 1
+            generation = self.generation
+            self.position = float(kwargs.get('current_time') or 0)
+            self.position_time = None
+            self.status.content_id = url
+            self.status.content_type = content_type
+            self.status.duration = None
+            self.status.artist = metadata.get('artist')
+            self.status.title = metadata.get('title')
+            self.status.album_name = metadata.get('albumName')
+        self.active.set()
+        self.cast.loads.append(url)
+        if interrupted:
+            self._set_state(generation, 'IDLE', 'INTERRUPTED')
+        self._set_state(generation, 'BUFFERING')
+        thread = threading.Thread(target=self._playback, args=(generation, url))
+        thread.daemon = True
+        thread.start()
+
+    def _playback(self, generation, url):
+        """ fetch url and advance the playback clock until the track is finished
         """
-        self._prep_media_controller()
-        prev_state = None
+        data = io.BytesIO()
+        try:
+            with urllib.request.urlopen(url, timeout=10) as response:
+                while True:
+                    chunk = response.read(self.FETCH_CHUNK)
+                    if not chunk:
+                        break
+                    data.write(chunk)
+                    self.cast.bytes_fetched += len(chunk)
+                    if data.tell() == len(chunk):
+                        # start playing once the first bytes are buffered
+                        self._set_state(generation, 'PLAYING')
+                    if generation != self.generation:
+                        return
+        except OSError as error:
+            logger.warning("FakeChromecast: failed to fetch %s: %s" % (url, error))
+            self._set_state(generation, 'IDLE', 'ERROR')
+            return
+
+        try:
+            data.seek(0)
+            duration = mutagen.mp3.MP3(data).info.length
+        except mutagen.MutagenError:
+            duration = 0.0
+        with self.lock:
+            if generation != self.generation:
+                return
+            self._update_position()
+            self.status.duration = duration
+            self.status.current_time = self.position
+        self._notify()  # receivers report duration once known
+
         while True:
-            if self.state == 'PLAYING':
-                self.mc.update_status()
-                artist = self.mc.status.artist
-                title = self.mc.status.title
-                album = self.mc.status.album_name
-                track_info = "%s - %s (%s)" % (artist, title, album)
-            if self.state != prev_state:    # TODO: doesn't always catch a change...
-                _clear_line()
-                addtl_info = ": " + track_info if self.state == 'PLAYING' else ""
-                logger.info("State change -> %s%s" % (self.state, addtl_info))
-                prev_state = self.state
-            if self.state == 'PLAYING':
-                print("%s %s/%s \r" % (
-                    track_info,
-                    to_min_sec(self.mc.status.current_time),
-                    to_min_sec(self.mc.status.duration)), end='')
+            time.sleep(self.TICK)
+            with self.lock:
+                if generation != self.generation:
+                    return
+                self._update_position()
+                finished = self.position >= duration
+            if finished:
+                with self.lock:
+                    self.position = duration
+                self._set_state(generation, 'IDLE', 'FINISHED')
+                return
 
-            time.sleep(0.25)
-    # }
+    def block_until_active(self, timeout=None):
+        self.active.wait(timeout)
 
-# } ## class CcAudioStreamer():
+    def update_status(self, callback_function_param=False):
+        if self.cast.offline:
+            raise pychromecast.error.NotConnected("Chromecast %s is connecting..." % self.cast.name)
+        self.cast.update_status_calls += 1
+        with self.lock:
+            self._update_position()
+            self.status.current_time = self.position
+        self._notify()
+
+    def pause(self):
+        with self.lock:
+            generation = self.generation
+        self._set_state(generation, 'PAUSED')
+
+    def play(self):
+        with self.lock:
+            generation = self.generation
+            state = self.status.player_state
+        if state == 'PAUSED':
+            self._set_state(generation, 'PLAYING')
+
+    def stop(self):
+        with self.lock:
+            self.generation += 1
+            generation = self.generation
+            self.position = 0.0
+        self._set_state(generation, 'IDLE', 'CANCELLED')
+# } ## class FakeMediaController():
+
+
+class FakeChromecast():  # {
+    """ subset of pychromecast.Chromecast, see "Fake Chromecast" above
+    """
+    def __init__(self, name="Fake Chromecast", cast_type='audio', speed=1.0, latency=0.0):
+        self.name = name
+        self.latency = latency  # seconds, simulated network round-trip for connect/volume
+        self.model_name = "Fake Chromecast Audio"
+        self.cast_type = cast_type
+        self.speed = speed
+        self.status = FakeCastStatus()
+        self.loads = []         # urls passed to play_media
+        self.bytes_fetched = 0
+        self.offline = False    # set to simulate device dropping off the network
+        self.update_status_calls = 0
+        self.media_controller = FakeMediaController(self)
+
+    def wait(self, timeout=None):
+        time.sleep(self.latency)
+
+    def disconnect(self, timeout=None):
+        self.media_controller.generation += 1   # stop playback thread
+
+    def set_volume(self, volume):
+        time.sleep(self.latency)
+        self.status.volume_level = max(0.0, min(1.0, volume))
+        return self.status.volume_level
+# } ## class FakeChromecast():
+
+
+def get_fake_devices(n, speed=1.0):
+    """ n fake audio devices, for use in place of CcAudioStreamer.get_devices()
+    """
+    return [FakeChromecast("Fake Audio %d" % (i + 1), speed=speed) for i in range(n)], []
+
+
+# Status recording
+#
+# new_media_status() can only be driven by a real device, so the statuses it
+# gets are recorded (with the state it arrived at) and replayed offline:
+#   stream2cca.py --record kitchen.s2s.gz playfolder
+#   stream2cca.py replay kitchen.s2s.gz
+# - a recording is JSON lines, gzipped if the name ends .gz: a header object
+#   then [seconds, state, player_state, idle_reason, ..] per status
+# - replay_status_recording() feeds the statuses through a CcAudioStreamer on
+#   a ReplayChromecast (which plays nothing) as fast as possible, with
+#   status_clock following the recorded times (for the 2 second heuristic),
+#   and checks each resulting state against the recorded one
+# - the time each new_media_status() call takes is reported (including any
+#   play() of the next track, which runs in pychromecast's callback thread)
+
+import gzip
+
+STATUS_RECORDING_FORMAT = "stream2cca-status"
+STATUS_RECORD_FIELDS = ('state', 'player_state', 'idle_reason', 'current_time', 'duration',
+        'playback_rate', 'content_id', 'artist', 'title', 'album_name')
+
+def _open_status_recording(filename, mode):
+    if filename.endswith(".gz"):
+        return gzip.open(filename, mode + 't', encoding='utf-8')
+    return open(filename, mode, encoding='utf-8')
+
+class StatusRecorder():  # {
+    """ status listener (see CcAudioStreamer.status_listeners) writing a recording file
+            recorder = StatusRecorder(filename, cas.get_name(), cas.state)
+            cas.status_listeners.append(recorder)
+    """
+    def __init__(self, filename, device_name="", state=None):
+        self.lock = threading.Lock()
+        self.f = _open_status_recording(filename, 'w')
+        self.start = time.perf_counter()
+        self.events = 0
+        self._write({'format': STATUS_RECORDING_FORMAT, 'version': 1, 'device': device_name,
+            'start': time.time(), 'state': state, 'fields': STATUS_RECORD_FIELDS})
+
+    def _write(self, obj):
+        self.f.write(json.dumps(obj, separators=(',', ':')) + "\n")
+
+    def __call__(self, snapshot):
+        row = [round(snapshot['perf_time'] - self.start, 3)]
+        for field in STATUS_RECORD_FIELDS:
+            value = snapshot.get(field)
+            row.append(round(value, 3) if isinstance(value, float) else value)
+        with self.lock:
+            if self.f:
+                self._write(row)
+                self.events += 1
+
+    def close(self):
+        with self.lock:
+            if self.f:
+                self.f.close()
+                self.f = None
+# } ## class StatusRecorder():
+
+def load_status_recording(filename):
+    """ returns (header, list of rows) of recording file
+        - raises ValueError if it isn't a recording
+    """
+    with _open_status_recording(filename, 'r') as f:
+        header = json.loads(f.readline() or "null")
+        if not isinstance(header, dict) or header.get('format') != STATUS_RECORDING_FORMAT:
+            raise ValueError("Not a status recording: %s" % filename)
+        return header, [json.loads(line) for line in f if line.strip()]
+
+class ReplayMediaController(FakeMediaController):
+    """ FakeMediaController that doesn't play: loads are recorded, statuses come from the replay
+    """
+    def play_media(self, url, content_type, metadata=None, **kwargs):
+        self.cast.loads.append(url)
+        self.active.set()
+
+class ReplayChromecast(FakeChromecast):
+    def __init__(self, name="Replay"):
+        super().__init__(name)
+        self.media_controller = ReplayMediaController(self)
+
+def replay_status_recording(filename, playlist, slow_ms=5.0):
+    """ feeds recorded statuses through CcAudioStreamer.new_media_status(), as fast as possible
+        - playlist: tracks for the replay's playlist (played as the recording advances)
+        - slow_ms: statuses taking longer than this to process are reported
+        returns report dict: events, mismatches (recorded state differs), transitions (as logged),
+          advances (tracks played), processing times, slow events
+    """
+    header, rows = load_status_recording(filename)
+    fields = header['fields']
+    cas = CcAudioStreamer(ReplayChromecast(header.get('device') or "Replay"))
+    cas.play_list(list(playlist))
+    loads_before = len(cas.cc.loads)
+    cas.state = header.get('state') or cas.state
+
+    clock = [0.0]   # recorded time of the status being replayed
+    start = datetime.datetime.now()
+    cas.status_clock = lambda: start + datetime.timedelta(seconds=clock[0])
+    cas.prev_playing_interrupted = start
+    transitions = []
+    cas.verbose_logger = lambda msg: transitions.append((clock[0], msg))
+    states = []
+    cas.status_listeners.append(lambda snapshot: states.append(snapshot['state']))
+
+    mismatches = []
+    times = []
+    slow = []
+    for i, row in enumerate(rows):
+        clock[0] = row[0]
+        values = dict(zip(fields, row[1:]))
+        status = None
+        if values.get('player_state') is not None:
+            status = FakeMediaStatus()
+            for field, value in values.items():
+                if field != 'state':
+                    setattr(status, field, value)
+        begin = time.perf_counter()
+        cas.new_media_status(status)
+        seconds = time.perf_counter() - begin
+        times.append(seconds)
+        if seconds * 1000 > slow_ms:
+            slow.append((i, row[0], round(seconds * 1000, 3)))
+        if states and states[-1] != values.get('state'):
+            mismatches.append((i, row[0], values.get('state'), states[-1]))
+    cas.stop()
+
+    times.sort()
+    def percentile(p):
+        return round(times[min(len(times) - 1, int(p * len(times)))] * 1e6, 1) if times else None
+    return {
+            'device': header.get('device'),
+            'events': len(rows),
+            'duration': rows[-1][0] if rows else 0.0,
+            'mismatches': mismatches,
+            'transitions': transitions,
+            'advances': len(cas.cc.loads) - loads_before,
+            'us_p50': percentile(0.5),
+            'us_p99': percentile(0.99),
+            'us_max': round(times[-1] * 1e6, 1) if times else None,
+            'slow': slow,
+            }
+
+def print_replay_report(report, out=print):
+    out("Replayed %d statuses (%.1fs recorded on '%s'): %d tracks advanced, %d state mismatches" % (
+        report['events'], report['duration'], report['device'], report['advances'], len(report['mismatches'])))
+    for t, msg in report['transitions']:
+        out("  %8.3fs  %s" % (t, msg))
+    for i, t, expected, got in report['mismatches']:
+        out("  MISMATCH status %d at %.3fs: recorded %s, replayed %s" % (i, t, expected, got))
+    out("new_media_status(): p50 %sus, p99 %sus, max %sus, %d slow" % (
+        report['us_p50'], report['us_p99'], report['us_max'], len(report['slow'])))
+    for i, t, ms in report['slow']:
+        out("  SLOW status %d at %.3fs: %.3fms" % (i, t, ms))
 
 
 def list_devices(cc_audios, cc_groups):
@@ -620,13 +3253,24 @@ class NonBlockingConsole():
           - pynput run locally on Mac grabs ALL keypresses, even those intended for different window/app
     """
 
+    saved_settings = None   # terminal settings while a console is active, see restore_terminal()
+
     def __enter__(self):
         self.old_settings = termios.tcgetattr(sys.stdin)
+        NonBlockingConsole.saved_settings = self.old_settings
         tty.setcbreak(sys.stdin.fileno())
         return self
 
     def __exit__(self, type, value, traceback):
         termios.tcsetattr(sys.stdin, termios.TCSADRAIN, self.old_settings)
+        NonBlockingConsole.saved_settings = None
+
+    @staticmethod
+    def restore_terminal():
+        """ restore the terminal settings of an active console (before exec, where __exit__ won't run)
+        """
+        if NonBlockingConsole.saved_settings is not None:
+            termios.tcsetattr(sys.stdin, termios.TCSADRAIN, NonBlockingConsole.saved_settings)
 
     def get_data(self):
         if select.select([sys.stdin], [], [], 0) == ([sys.stdin], [], []):
@@ -643,21 +3287,606 @@ class NonBlockingConsole():
 # - interprets POST requests as commands to the interactive-player
 # - supports serving both the player-controller web-page content (.html, .jpgs,
 # .css, .js files) and the user-specified playlist files (.mp3)
-#   - this adds complications because want to allow user to specify
-#   arbitrary folder for the playlist
-#   - thus, we'll need to set the root directory for the http server to the
-#   commonpath of the playlist-folder and the web-page-folder
-#   - additionally, we'll need to intercept and translate the paths of the
-#   web-page file requests to incorporate the relative path from
-#   server-root-directory to the web-page folder
+#   - the server root is the web-page folder; media files are served by track
+#   ID (/t/<id>, see "Media files" below) so the playlist folders can be
+#   anywhere without widening the server root
+#   - web-page file requests are translated to incorporate the relative path
+#   from server-root-directory to the web-page folder
+
+
+# Static web-page assets
+#
+# The player-controller web-page files (html, js, css, button icons) don't change
+# while we're running, so they're read once at startup and served from memory:
+# - with ETag and Last-Modified, so revalidation gets a 304 with no body
+# - text assets also kept gzip-compressed, sent when the client accepts gzip
+# - the html is rewritten so its asset references carry a "?v=<etag>" query;
+#   those versioned requests are cacheable forever, since a changed asset gets
+#   a new URL
+# Dynamic resources (cover.jpg, ip_address.js, media files) aren't cached and
+# keep the no-store policy.
+
+import email.utils
+import gzip
+import hashlib
+import mimetypes
+
+StaticAsset = collections.namedtuple('StaticAsset',
+        'body gzip_body etag last_modified content_type')
+
+class StaticAssetCache():  # {
+    """ In-memory cache of the web-page assets under folder
+        - keys are paths relative to folder, e.g. 'web_page.js', 'imgs/noise.jpg'
+    """
+    ASSET_SUFFIXES = ('.html', '.js', '.css', '.png', '.jpg', '.ico')
+    COMPRESSIBLE_SUFFIXES = ('.html', '.js', '.css')
+    DYNAMIC = ('cover.jpg', 'ip_address.js')    # regenerated while running, never cached
+    HTML_ASSET_REF = re.compile(r'(href|src)="([^"#?]+)"')
+
+    # Cache-Control policies
+    VERSIONED_POLICY = "public, max-age=31536000, immutable"
+    ASSET_POLICY = "public, max-age=86400"
+    HTML_POLICY = "no-cache"    # always revalidate (cheap 304 via ETag)
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.assets = {}
+        paths = [name for name in os.listdir(folder) if os.path.isfile(os.path.join(folder, name))]
+        imgs = os.path.join(folder, "imgs")
+        if os.path.isdir(imgs):
+            paths += ["imgs/" + name for name in os.listdir(imgs)]
+        html_paths = []
+        for rel_path in paths:
+            if rel_path in self.DYNAMIC or not rel_path.lower().endswith(self.ASSET_SUFFIXES):
+                continue
+            if rel_path.endswith(".html"):
+                html_paths.append(rel_path)     # after the assets they reference
+                continue
+            with open(os.path.join(folder, rel_path), "rb") as f:
+                self._add(rel_path, f.read())
+        for rel_path in html_paths:
+            with open(os.path.join(folder, rel_path), "rb") as f:
+                self._add(rel_path, self._version_asset_refs(f.read().decode()).encode())
+        logger.info("StaticAssetCache: %d assets, %d bytes (%d gzipped)" % (len(self.assets),
+            sum(len(a.body) for a in self.assets.values()),
+            sum(len(a.gzip_body or a.body) for a in self.assets.values())))
+
+    def _add(self, rel_path, body):
+        full_path = os.path.join(self.folder, rel_path)
+        gzip_body = None
+        if rel_path.endswith(self.COMPRESSIBLE_SUFFIXES):
+            gzip_body = gzip.compress(body, 9)
+            if len(gzip_body) >= len(body):
+                gzip_body = None
+        content_type = mimetypes.guess_type(rel_path)[0] or 'application/octet-stream'
+        if content_type.startswith("text/") or content_type.endswith("javascript"):
+            content_type += "; charset=utf-8"
+        self.assets[rel_path] = StaticAsset(body, gzip_body,
+                '"%s"' % hashlib.sha1(body).hexdigest()[:16],
+                email.utils.formatdate(os.path.getmtime(full_path), usegmt=True),
+                content_type)
+
+    def _version_asset_refs(self, html):
+        def versioned(match):
+            attr, ref = match.groups()
+            asset = self.assets.get(ref)
+            if asset is None:
+                return match.group(0)
+            return '%s="%s?v=%s"' % (attr, ref, asset.etag.strip('"'))
+        return self.HTML_ASSET_REF.sub(versioned, html)
+
+    def get(self, rel_path):
+        return self.assets.get(rel_path)
+
+    def cache_control(self, rel_path, query):
+        if rel_path.endswith(".html"):
+            return self.HTML_POLICY
+        if query.startswith("v="):
+            return self.VERSIONED_POLICY
+        return self.ASSET_POLICY
+# } ## class StaticAssetCache():
+
+
+theStaticAssets = None      # global singleton, set up when server started
+
+
+# Media files
+#
+# Media is served at /t/<track_id> rather than by file path:
+# - a track ID is the hash of the file's real path, so it's stable across
+#   restarts, and resolved through theTracks (an in-memory ID -> path table)
+#   filled in by the library scan and by play()
+# - only files under the library roots can be registered (no roots = any file)
+# - CLI commands (playfile, playfolder, ..) play through the interactive/serve
+#   instance on this machine: their ServerTrackTable registers each track
+#   played with it (POST /tracks); registrations from this machine may be of
+#   any track file, the CLI plays the files it's told to wherever they are
+# - open files are kept in a small LRU, so the device's repeated range
+#   requests for a track don't reopen the file; reads use os.pread() so
+#   concurrent requests can share a file descriptor
+
+def track_id(path):
+    return hashlib.sha1(os.path.realpath(path).encode()).hexdigest()[:16]
+
+class TrackTable():  # {
+    """ track ID -> path table, for the /t/<track_id> media URLs
+    """
+    def __init__(self, roots=()):
+        self.lock = threading.Lock()
+        self.paths = {}     # track_id -> real path
+        self.set_roots(roots)
+
+    def set_roots(self, roots):
+        with self.lock:
+            self.roots = [os.path.realpath(root) for root in roots]
+
+    def servable(self, path):
+        """ True if path is under one of the roots (so it can be registered)
+        """
+        real_path = os.path.realpath(path)
+        with self.lock:
+            return not self.roots or any(os.path.commonpath([root, real_path]) == root for root in self.roots)
+
+    def register(self, path, check_roots=True):
+        """ returns track ID for path
+            - raises ValueError if path not under one of the roots (with check_roots)
+        """
+        if check_roots and not self.servable(path):
+            raise ValueError("Not under a library root: %s" % path)
+        real_path = os.path.realpath(path)
+        with self.lock:
+            tid = track_id(real_path)
+            self.paths[tid] = real_path
+        return tid
+
+    def get_path(self, tid):
+        with self.lock:
+            return self.paths.get(tid)
+
+    def __len__(self):
+        return len(self.paths)
+# }
+
+class ServerTrackTable(TrackTable):  # {
+    """ TrackTable of a CLI command: tracks are also registered with the server on this
+        machine that serves them (an interactive/serve instance, see MyHTTPRequestHandler.register_tracks())
+    """
+    def __init__(self, server):
+        super().__init__()      # (the server checks the paths)
+        self.server = server    # base url, e.g. "http://127.0.0.1:9812"
+
+    def register(self, path, check_roots=True):
+        tid = super().register(path)
+        request = urllib.request.Request(self.server + "/tracks", data=json.dumps([path]).encode(),
+                headers={'Content-type': 'application/json'}, method='POST')
+        try:
+            with urllib.request.urlopen(request, timeout=5) as response:
+                result = json.load(response)[0]
+        except (OSError, ValueError) as error:
+            logger.warning("Unable to register track with the server at %s (not running?): %s" % (self.server, error))
+            return tid
+        if 'error' in result:
+            raise ValueError("Not served by the server at %s: %s" % (self.server, result['error']))
+        return tid
+# } ## class ServerTrackTable():
+
+class OpenFileCache():  # {
+    """ LRU of open (read-only) file descriptors
+            with cache.open(path) as (fd, size):
+                data = os.pread(fd, n, offset)
+        - files in use are never closed, the cache may exceed max_open while they are
+        - a file that's changed (e.g. retagged or replaced) since it was opened is reopened,
+          the old descriptor is closed once its users are done
+        - files are stat'ed and opened outside the lock, so a slow (network) drive
+          doesn't hold up requests for other files
+    """
+    def __init__(self, max_open=8):
+        self.max_open = max_open
+        self.lock = threading.Lock()
+        self.files = collections.OrderedDict()     # path -> [fd, size, users, (ino, size, mtime)], oldest first
+        self.hits = 0
+        self.opens = 0
+
+    @staticmethod
+    def _identity(st):
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    @contextlib.contextmanager
+    def open(self, path):
+        identity = self._identity(os.stat(path))
+        with self.lock:
+            entry = self.files.get(path)
+            if entry is not None and entry[3] == identity:
+                self.files.move_to_end(path)
+                entry[2] += 1
+                self.hits += 1
+            else:
+                entry = None
+        if entry is None:
+            fd = os.open(path, os.O_RDONLY)
+            st = os.fstat(fd)
+            entry = [fd, st.st_size, 1, self._identity(st)]
+            with self.lock:
+                self.opens += 1
+                old = self.files.pop(path, None)
+                if old is not None and old[2] == 0:
+                    os.close(old[0])    # (else closed by its last user, below)
+                self.files[path] = entry
+                self._evict()
+        try:
+            yield entry[0], entry[1]
+        finally:
+            with self.lock:
+                entry[2] -= 1
+                if entry[2] == 0 and self.files.get(path) is not entry:
+                    os.close(entry[0])  # replaced while in use
+                self._evict()
+
+    def _evict(self):
+        excess = len(self.files) - self.max_open
+        for path, entry in list(self.files.items()):
+            if excess <= 0:
+                break
+            if entry[2] == 0:
+                os.close(entry[0])
+                del self.files[path]
+                excess -= 1
+
+    def close(self):
+        with self.lock:
+            for fd, size, users, identity in self.files.values():
+                os.close(fd)
+            self.files.clear()
+# }
+
+theTracks = TrackTable()            # global singleton, roots set in main() (a ServerTrackTable for CLI commands)
+theOpenFiles = OpenFileCache()      # global singleton
+
+
+# Stream pacing
+#
+# Without pacing each handler thread sends its file as fast as the socket
+# allows, so one receiver buffering a whole track can starve the others (and the
+# web-page POSTs) on a slow link. Instead, each media stream:
+# - gets an initial burst (burst_seconds of audio) so playback starts quickly
+# - is then paced (token bucket) to rate_multiple times the track's bitrate
+# - if max_bandwidth is set, shares it equally with the other active streams
+#   (each stream's rate is re-evaluated per chunk as streams come and go)
+
+DEFAULT_STREAM_BITRATE = 192000     # bits/s, when a track's bitrate isn't known (e.g. transcoding)
+
+class StreamPacer():  # {
+    """ Paces media streams, see "Stream pacing"
+            with thePacer.stream(bitrate) as pace:
+                ...
+                pace(len(data))     # before sending data, sleeps as needed
+        rate_multiple - 0 to disable pacing
+        max_bandwidth - total bytes/s for all streams, 0 for unlimited
+    """
+    PACED_CHUNK_SIZE = 16 * 1024    # smaller chunks when paced, for a smoother pace
+
+    def __init__(self, rate_multiple=2.0, burst_seconds=10, max_bandwidth=0):
+        self.rate_multiple = rate_multiple
+        self.burst_seconds = burst_seconds
+        self.max_bandwidth = max_bandwidth
+        self.lock = threading.Lock()
+        self.active = 0
+        self.bitrates = {}  # path -> bits/s, for files not in theLibrary
+
+    def get_bitrate(self, path):
+        info = theLibrary.get(path)
+        if info and info.bitrate:
+            return info.bitrate
+        with self.lock:
+            bitrate = self.bitrates.get(path)
+        if bitrate is None:
+            try:
+                bitrate = mutagen.mp3.MP3(path).info.bitrate or DEFAULT_STREAM_BITRATE
+            except (OSError, mutagen.MutagenError):
+                bitrate = DEFAULT_STREAM_BITRATE
+            with self.lock:
+                self.bitrates[path] = bitrate
+        return bitrate
+
+    @property
+    def chunk_size(self):
+        """ chunk size for paced streams, None when unpaced
+        """
+        return self.PACED_CHUNK_SIZE if self.rate_multiple else None
+
+    def rate(self, bitrate):
+        """ current bytes/s for a stream of bitrate (bits/s)
+        """
+        rate = self.rate_multiple * bitrate / 8
+        if self.max_bandwidth:
+            rate = min(rate, self.max_bandwidth / max(1, self.active))
+        return rate
+
+    @contextlib.contextmanager
+    def stream(self, bitrate):
+        with self.lock:
+            self.active += 1
+        theMetrics.inc('s2c_media_streams_active', value=1)
+        try:
+            if not self.rate_multiple:
+                yield lambda n: None
+                return
+            burst = self.burst_seconds * self.rate_multiple * bitrate / 8
+            bucket = {'tokens': burst, 'time': time.perf_counter()}
+
+            def pace(n):
+                now = time.perf_counter()
+                rate = self.rate(bitrate)
+                tokens = min(burst, bucket['tokens'] + rate * (now - bucket['time'])) - n
+                bucket['time'] = now
+                bucket['tokens'] = tokens
+                if tokens < 0:
+                    delay = -tokens / rate
+                    theMetrics.inc('s2c_media_pacing_seconds_total', value=delay)
+                    time.sleep(delay)
+            yield pace
+        finally:
+            with self.lock:
+                self.active -= 1
+            theMetrics.inc('s2c_media_streams_active', value=-1)
+# }
+
+thePacer = StreamPacer()            # global singleton, configured in main()
+theMetrics.describe('s2c_media_streams_active', 'gauge', "Media streams being sent")
+theMetrics.describe('s2c_media_pacing_seconds_total', 'counter', "Time media streams spent waiting for their pace")
+
+def parse_range(range_header, size):
+    """ returns (start, end) (inclusive) for a single "bytes=" range,
+        None if no (or an unsupported multi-) range, so whole file is sent
+        - raises ValueError if unsatisfiable
+    """
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        return None
+    first, _, last = range_header[len("bytes="):].strip().partition("-")
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    else:
+        start = max(0, size - int(last))  # suffix: last N bytes
+        end = size - 1
+    if start > end or start >= size:
+        raise ValueError("Unsatisfiable range: %s" % range_header)
+    return start, end
+
+
+# Transcoding
+#
+# Tracks in formats other than mp3 (flac, m4a, ..) are transcoded to mp3 by an
+# external encoder command (ffmpeg by default) when the device requests them:
+# - the encoder's output is streamed to the device as it's produced (chunked
+#   transfer), so playback starts without waiting for the whole file
+# - the output is also written to an on-disk cache, bounded in size with the
+#   least-recently-used files evicted, so replays are served like any mp3
+#   (with range requests)
+# - concurrent requests for a track being transcoded share the one encoder,
+#   each following the growing cache file
+
+DEFAULT_TRANSCODE_COMMAND = "ffmpeg -v error -i {input} -vn -map_metadata -1 -f mp3 -b:a 192k -"
+
+class TranscodeError(Exception):
+    pass
+
+class TranscodeJob():  # {
+    """ one run of the encoder, writing its output to part_path
+        - on_done(job) is called when it's finished, Transcoder._job_done() renames
+          the part file to cache_path (or removes it if the encoder failed)
+    """
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, command, part_path, cache_path, on_done):
+        self.command = command
+        self.part_path = part_path
+        self.cache_path = cache_path
+        self.on_done = on_done
+        self.cond = threading.Condition()
+        self.size = 0       # bytes written so far
+        self.done = False
+        self.error = None   # set if the encoder failed
+        self.part_file = open(part_path, "wb")  # before any reader opens it
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            with self.part_file:
+                proc = subprocess.Popen(self.command, stdout=subprocess.PIPE,
+                        stdin=subprocess.DEVNULL, stderr=subprocess.PIPE)
+                while True:
+                    data = proc.stdout.read1(self.CHUNK_SIZE)
+                    if not data:
+                        break
+                    self.part_file.write(data)
+                    self.part_file.flush()
+                    with self.cond:
+                        self.size += len(data)
+                        self.cond.notify_all()
+                stderr = proc.stderr.read()
+                if proc.wait() != 0:
+                    raise TranscodeError("Encoder exited with %d: %s" % (
+                        proc.returncode, stderr.decode(errors='replace').strip()[-200:]))
+        except (OSError, TranscodeError) as error:
+            logger.error("Transcode failed: %s" % error)
+            self.error = error
+        with self.cond:
+            self.done = True
+            self.cond.notify_all()
+        self.on_done(self)
+
+    def stream(self, f):
+        """ generator of the output chunks, read from f (the part file opened for reading)
+            - raises TranscodeError if the encoder fails
+        """
+        offset = 0
+        with f:
+            while True:
+                with self.cond:
+                    while offset >= self.size and not self.done:
+                        self.cond.wait()
+                    size, done, error = self.size, self.done, self.error
+                if error:
+                    raise TranscodeError(str(error))
+                if offset >= size and done:
+                    return
+                data = f.read(min(self.CHUNK_SIZE, size - offset))
+                offset += len(data)
+                yield data
+# }
+
+def _part_pid(name):
+    """ pid of the process writing part file name ("<cache file>.<pid>.part"), None if not known
+    """
+    try:
+        return int(name[:-len(".part")].rsplit(".", 1)[1])
+    except (IndexError, ValueError):
+        return None
+
+def _pid_alive(pid):
+    """ True if process pid is running
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass    # (another user's)
+    return True
+
+class Transcoder():  # {
+    """ Transcodes tracks to mp3 via an external encoder command, with an on-disk LRU cache
+        command - encoder command line writing mp3 to stdout, with {input} for the track path
+    """
+    def __init__(self, cache_dir, command=DEFAULT_TRANSCODE_COMMAND, max_cache_bytes=1 << 30):
+        self.cache_dir = cache_dir
+        self.command = shlex.split(command)
+        self.max_cache_bytes = max_cache_bytes
+        self.lock = threading.Lock()
+        self.jobs = {}      # cache key -> TranscodeJob in progress
+        self.runs = 0       # encoder runs started
+        os.makedirs(cache_dir, exist_ok=True)
+        for name in os.listdir(cache_dir):
+            if not name.endswith(".part"):
+                continue
+            # left from a previous run, unless being written by a live media process
+            # (one with this process's pid is from an earlier process, this one has no jobs yet)
+            pid = _part_pid(name)
+            if pid is None or pid == os.getpid() or not _pid_alive(pid):
+                try:
+                    os.remove(os.path.join(cache_dir, name))
+                except OSError:
+                    pass    # (removed by another process starting up)
+
+    @staticmethod
+    def available(command=DEFAULT_TRANSCODE_COMMAND):
+        return shutil.which(shlex.split(command)[0]) is not None
+
+    @staticmethod
+    def needs_transcoding(path):
+        return path.lower().endswith(TRANSCODE_SUFFIXES)
+
+    def is_cached(self, path):
+        return os.path.exists(self.cache_path(path))
+
+    def cache_path(self, path):
+        """ cache file for path, named for the path, its size/mtime and the encoder command
+        """
+        st = os.stat(path)
+        key = "%s %d %d %s" % (os.path.realpath(path), st.st_size, st.st_mtime_ns, self.command)
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest()[:24] + ".mp3")
+
+    def open(self, path):
+        """ returns either
+            - ('file', cache file path) when already transcoded
+            - ('stream', generator of mp3 chunks) while transcoding (starting the encoder if needed)
+        """
+        cache_path = self.cache_path(path)
+        with self.lock:
+            job = self.jobs.get(cache_path)
+            if job is None:
+                if os.path.exists(cache_path):
+                    os.utime(cache_path)    # most recently used
+                    return 'file', cache_path
+                command = [path if arg == "{input}" else arg for arg in self.command]
+                logger.info("Transcoding: %s" % path)
+                # (part file per process, the media processes share the cache)
+                job = TranscodeJob(command, "%s.%d.part" % (cache_path, os.getpid()), cache_path, self._job_done)
+                self.jobs[cache_path] = job
+                self.runs += 1
+                theMetrics.inc('s2c_transcodes_total')
+            # opened under the lock, so the part file hasn't been renamed yet (see _job_done())
+            return 'stream', job.stream(open(job.part_path, "rb"))
+
+    def _job_done(self, job):
+        """ (from the job's thread) the part file becomes the cache file, or is removed if
+            the encoder failed -- under the lock, with the job removed from jobs
+        """
+        with self.lock:
+            try:
+                try:
+                    if job.error is None:
+                        os.replace(job.part_path, job.cache_path)
+                    else:
+                        os.remove(job.part_path)
+                except OSError as error:
+                    logger.error("Transcode of %s not cached: %s" % (job.cache_path, error))
+                self._evict()
+            finally:
+                self.jobs.pop(job.cache_path, None)     # last, so no job means it's all done
+
+    def _evict(self):
+        """ remove least-recently-used cache files beyond max_cache_bytes
+            - files may be evicted by another (media) process sharing the cache at the same time
+        """
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".mp3"):
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((st.st_mtime, st.st_size, entry.path))
+        total = sum(size for mtime, size, path in files)
+        for mtime, size, path in sorted(files):
+            if total <= self.max_cache_bytes:
+                break
+            try:
+                os.remove(path)     # (any open fd, e.g. in theOpenFiles, stays valid)
+            except FileNotFoundError:
+                pass
+            total -= size
+# }
+
+theTranscoder = None        # global singleton, set in main() if an encoder is available
+theMetrics.describe('s2c_transcodes_total', 'counter', "Encoder runs started for non-mp3 tracks")
 
 
 import http.server
 import socketserver
+
+class CountingWriter():
+    """ wraps a handler's wfile to count the bytes written
+    """
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.n_bytes = 0
+
+    def write(self, b):
+        n = self.wfile.write(b)
+        self.n_bytes += len(b)
+        return n
+
+    def __getattr__(self, name):
+        return getattr(self.wfile, name)
+
 class MyHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):  # {
     """ Subclass to:
         - serve files from specific directory
         - redirect log_message to logger (rather than screen)
+        - serve web-page assets from theStaticAssets cache
         NOTE:
         - this class is passed to the HTTP server which will instantiate this class for each
           HTTP request received
@@ -703,10 +3932,53 @@ class MyHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):  # {
             """
 
 
+    metrics_path = 'other'  # path/command label for metrics
+
+    def setup(self):
+        super().setup()
+        self.wfile = CountingWriter(self.wfile)
+        theMetrics.inc('s2c_http_active_connections', value=1)
+
+    def finish(self):
+        try:
+            super().finish()
+        finally:
+            theMetrics.inc('s2c_http_active_connections', value=-1)
+
+    def _record_request_metrics(self, method, start, bytes_start):
+        labels = (('method', method), ('path', self.metrics_path))
+        theMetrics.inc('s2c_http_requests_total', labels)
+        theMetrics.observe('s2c_http_request_duration_seconds', labels, time.perf_counter() - start)
+        theMetrics.inc('s2c_http_bytes_served_total', labels, self.wfile.n_bytes - bytes_start)
+
+    def _get_metrics_path(self):
+        """ low-cardinality label for GET path
+        """
+        path = self.path.partition('?')[0]
+        if path.startswith('/t/'):
+            return 'media'
+        if path.startswith('/a/'):
+            return 'art'
+        if path in ('/', '/stats', '/metrics', '/cover.jpg', '/ip_address.js'):
+            return path
+        if theStaticAssets and theStaticAssets.get(urllib.parse.unquote(path.lstrip('/'))):
+            return 'static'
+        return 'other'
+
+    def send_metrics(self):
+        body = theMetrics.render().encode()
+        self.send_response(200)  # 200 OK
+        self.send_header('Content-type', 'text/plain; version=0.0.4')
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
     def log_message(self, format, *args):
         #logger.info(format % args)
         pass
 
+    cache_control = None    # Cache-Control for this response, None for the no-store default
+
     def end_headers(self):
         """ HACKISH override so that I can insert my own headers
         """
@@ -721,16 +3993,176 @@ class MyHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):  # {
     def send_my_headers(self):
         """ my specific headers
         """
-        # these to force image files to refresh (avoid cached versions) since we
-        # always use the same filename ('cover.jpg') for cover art
-        self.send_header("Cache-Control", "max-age=0, must-revalidate, no-store")
+        if self.cache_control:
+            self.send_header("Cache-Control", self.cache_control)
+        else:
+            # these to force image files to refresh (avoid cached versions) since we
+            # always use the same filename ('cover.jpg') for cover art
+            self.send_header("Cache-Control", "max-age=0, must-revalidate, no-store")
+
 
+    def send_json(self, obj):
+        """ sends complete 200 response with obj JSON-encoded as the body
+        """
+        body = json.dumps(obj).encode()
+        self.send_response(200)  # 200 OK
+        self.send_header('Content-type', 'application/json')
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.wfile.flush()
+
+    def send_api_response(self, content):
+        """ JSON control API (POST API_PATH), runs several commands in one request, e.g.:
+                {"commands": [{"cmd": "select_device", "args": ["2"]}, {"cmd": "set_volume", "args": [0.2]}]}
+            response:
+                {"api": 1, "results": [{"cmd", "ok", "result"/"error"}, ..],
+                 "version": status version, "status": [fields as for get_status]}
+            - see InteractivePlayer.run_commands()
+        """
+        try:
+            request = json.loads(content)
+            commands = request['commands']
+            if not isinstance(commands, list):
+                raise ValueError("commands must be a list")
+        except (ValueError, KeyError, TypeError) as error:
+            body = json.dumps({'api': API_VERSION, 'error': "Bad request: %s" % error}).encode()
+            self.send_response(400)  # 400 Bad Request
+            self.send_header('Content-type', 'application/json')
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        logger.info("Got API commands: %s" % ", ".join(str(c.get('cmd')) for c in commands if isinstance(c, dict)))
+        results, version, statuses = thePlayer.run_commands(commands)
+        self.send_json({'api': API_VERSION, 'results': results, 'version': version, 'status': list(statuses)})
+
+    def register_tracks(self, content):
+        """ POST /tracks with a JSON list of paths, for CLI commands playing through this server
+            (see ServerTrackTable), response is a list of {"id": track ID} or {"error": ..} per path
+            - from this machine any track file is accepted, otherwise only those under the library roots
+        """
+        local = self.client_address[0] in ('127.0.0.1', '::1', IP_ADDRESS)
+        try:
+            paths = json.loads(content)
+            if not isinstance(paths, list) or not all(isinstance(path, str) for path in paths):
+                raise ValueError("expected a list of paths")
+        except ValueError as error:
+            self.send_error(400, "Bad request: %s" % error)
+            return
+        results = []
+        for path in paths:
+            if not (is_track_file(path) and os.path.isfile(path)):
+                results.append({'error': "Not a track file: %s" % path})
+                continue
+            try:
+                results.append({'id': theTracks.register(path, check_roots=not local)})
+            except ValueError as error:
+                results.append({'error': str(error)})
+        self.send_json(results)
+
+    def send_history_stats(self):
+        """ play-history statistics, e.g.:
+                /stats                      -- last 30 days
+                /stats?days=365&limit=20
+                /stats?since=1600000000&until=1700000000    -- unix timestamps
+        """
+        if thePlayHistory is None:
+            self.send_error(404, "Play history not enabled")
+            return
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        try:
+            until = float(query['until'][0]) if 'until' in query else time.time()
+            if 'since' in query:
+                since = float(query['since'][0])
+            else:
+                since = until - 24 * 60 * 60 * float(query.get('days', ['30'])[0])
+            limit = int(query.get('limit', ['10'])[0])
+        except ValueError:
+            self.send_error(400, "Invalid stats query: %s" % self.path)
+            return
+        self.send_json(thePlayHistory.get_stats(since, until, limit))
+
+    def send_static_asset(self):
+        """ serve request from theStaticAssets cache
+            returns False if the path isn't a cached asset
+        """
+        if theStaticAssets is None:
+            return False
+        path, _, query = self.path.partition('?')
+        rel_path = 'web_page.html' if path == '/' else urllib.parse.unquote(path.lstrip('/'))
+        asset = theStaticAssets.get(rel_path)
+        if asset is None:
+            return False
+
+        self.cache_control = theStaticAssets.cache_control(rel_path, query)
+        not_modified = False
+        if 'If-None-Match' in self.headers:
+            not_modified = asset.etag in [t.strip() for t in self.headers['If-None-Match'].split(',')]
+        elif 'If-Modified-Since' in self.headers:
+            not_modified = self.headers['If-Modified-Since'] == asset.last_modified
+        if not_modified:
+            self.send_response(304)  # 304 Not Modified
+            self.send_header("ETag", asset.etag)
+            self.end_headers()
+            return True
+
+        body = asset.body
+        use_gzip = asset.gzip_body is not None and 'gzip' in self.headers.get('Accept-Encoding', '')
+        self.send_response(200)  # 200 OK
+        self.send_header('Content-type', asset.content_type)
+        if use_gzip:
+            body = asset.gzip_body
+            self.send_header("Content-Encoding", "gzip")
+        if asset.gzip_body is not None:
+            self.send_header("Vary", "Accept-Encoding")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", asset.etag)
+        self.send_header("Last-Modified", asset.last_modified)
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (ConnectionResetError, BrokenPipeError, TimeoutError) as error:
+            logger.warning("Handled exception sending: %s" % rel_path)
+            logger.warning("  %s" % error)
+        return True
 
     def do_GET(self):
+        start = time.perf_counter()
+        bytes_start = self.wfile.n_bytes
+        self.metrics_path = self._get_metrics_path()
+        try:
+            self._do_GET()
+        finally:
+            self._record_request_metrics('GET', start, bytes_start)
+
+    def _do_GET(self):
+        # media files, and their cover art
+        if self.path.startswith('/t/'):
+            self.send_track()
+            return
+        if self.path.startswith('/a/'):
+            self.send_art()
+            return
+
+        # web-page assets
+        if self.send_static_asset():
+            return
+
+        # metrics, Prometheus text format
+        if self.path == '/metrics':
+            self.send_metrics()
+            return
+
+        # play-history statistics
+        if self.path == '/stats' or self.path.startswith('/stats?'):
+            self.send_history_stats()
+            return
+
         # redirect landing page (IP_ADDRESS:PORT or localhost:PORT)
         if self.path == '/':
             self.path = os.path.join('/', WEB_PAGE_REL_PATH, 'web_page.html')
-        elif not '.mp3' in self.path:
+        else:
             # since the path starts with '/', need to use raw string concat methods
             # rather than os.path.join()
             self.path = '/' + WEB_PAGE_REL_PATH + self.path
@@ -769,13 +4201,171 @@ class MyHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):  # {
             logger.warning("Handled exception from: super().do_GET()!")
             logger.warning("  %s" % error)
 
-    def do_POST(self):  # {
+    def do_HEAD(self):
+        if self.path.startswith('/t/'):
+            self.metrics_path = 'media'
+            self.send_track(head=True)
+        else:
+            super().do_HEAD()
+
+    def send_art(self):
+        """ cover art of the track for /a/<track_id>
+        """
+        path = theTracks.get_path(self.path[len('/a/'):].partition('?')[0])
+        data = read_track_art(path) if path else None
+        if data is None:
+            self.send_error(404, "No cover art")
+            return
+        self.send_response(200)  # 200 OK
+        self.send_header('Content-type', 'image/png' if data.startswith(b"\x89PNG") else 'image/jpeg')
+        self.send_header("Content-Length", str(len(data)))
+        self.cache_control = "max-age=3600"
+        self.end_headers()
+        self.wfile.write(data)
+
+    def list_directory(self, path):
+        # no directory listings
+        self.send_error(404, "File not found")
+        return None
+
+    CHUNK_SIZE = 64 * 1024
+
+    def send_track(self, head=False):
+        """ media file for /t/<track_id>, with support for single byte-range requests
+        """
+        tid = self.path[len('/t/'):].partition('?')[0]
+        path = theTracks.get_path(tid)
+        if path is None:
+            self.send_error(404, "Unknown track")
+            return
+        if theTranscoder and theTranscoder.needs_transcoding(path):
+            try:
+                if head and not theTranscoder.is_cached(path):
+                    self.send_chunked_headers()     # (no encoder started just for a HEAD)
+                    return
+                kind, path = theTranscoder.open(path)
+            except OSError:
+                self.send_error(404, "File not found")
+                return
+            if kind == 'stream':
+                self.send_chunked(path)
+                return
+        try:
+            with theOpenFiles.open(path) as (fd, size):
+                try:
+                    byte_range = parse_range(self.headers.get('Range'), size)
+                except ValueError:
+                    self.send_response(416)  # 416 Range Not Satisfiable
+                    self.send_header("Content-Range", "bytes */%d" % size)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                if byte_range:
+                    start, end = byte_range
+                    self.send_response(206)  # 206 Partial Content
+                    self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, size))
+                else:
+                    start, end = 0, size - 1
+                    self.send_response(200)  # 200 OK
+                self.send_header('Content-type', mimetypes.guess_type(path)[0] or 'application/octet-stream')
+                self.send_header("Accept-Ranges", "bytes")
+                self.send_header("Content-Length", str(end + 1 - start))
+                self.end_headers()
+                if head:
+                    return
+                offset = start
+                chunk_size = thePacer.chunk_size or self.CHUNK_SIZE
+                with thePacer.stream(thePacer.get_bitrate(path)) as pace:
+                    while offset <= end:
+                        data = os.pread(fd, min(chunk_size, end + 1 - offset), offset)
+                        if not data:
+                            break   # file truncated since opened
+                        pace(len(data))
+                        self.wfile.write(data)
+                        offset += len(data)
+        except FileNotFoundError:
+            self.send_error(404, "File not found")
+        except (ConnectionResetError, BrokenPipeError, TimeoutError) as error:
+            logger.warning("Handled exception from: send_track()!")
+            logger.warning("  %s" % error)
+
+    def send_chunked_headers(self):
+        self.protocol_version = "HTTP/1.1"    # chunked transfer needs HTTP/1.1
+        self.send_response(200)  # 200 OK
+        self.send_header('Content-type', 'audio/mpeg')
+        self.send_header("Transfer-Encoding", "chunked")
+        self.send_header("Connection", "close")
+        self.end_headers()
+
+    def send_chunked(self, chunks):
+        """ streams mp3 chunks (from a transcode in progress) with chunked transfer-encoding
+        """
+        self.send_chunked_headers()
+        try:
+            with thePacer.stream(DEFAULT_STREAM_BITRATE) as pace:
+                for data in chunks:
+                    pace(len(data))
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.write(b"0\r\n\r\n")
+        except TranscodeError:
+            pass    # logged by the job, connection closed without the final chunk
+        except (ConnectionResetError, BrokenPipeError, TimeoutError) as error:
+            logger.warning("Handled exception from: send_chunked()!")
+            logger.warning("  %s" % error)
+        finally:
+            chunks.close()
+
+    def do_POST(self):
+        start = time.perf_counter()
+        bytes_start = self.wfile.n_bytes
+        try:
+            self._do_POST()
+        finally:
+            self._record_request_metrics('POST', start, bytes_start)
+
+    def _do_POST(self):  # {
         content_len = self.headers['Content-Length']
         content = self.rfile.read(int(content_len)).decode('utf-8') if content_len else ""
 
+        if urllib.parse.urlsplit(self.path).path == API_PATH:
+            self.metrics_path = API_PATH
+            self.send_api_response(content)
+            return
+        if urllib.parse.urlsplit(self.path).path == '/tracks':
+            self.metrics_path = '/tracks'
+            self.register_tracks(content)
+            return
+
+        def get_status_since(since_version):  # {
+            """
+                conditional get_status: "get_status <version>" where version is from a previous response
+                - 304 (Not Modified, no body) if status unchanged since version
+                - otherwise 200 with body composed of lines, separated by "\n":
+                  - current version
+                  - "D" (delta) followed by "index=value" line per changed status field
+                  - or "F" (full) followed by all status fields (as for get_status)
+            """
+            version, statuses, delta = thePlayer.get_status_since(since_version)
+            if delta == {}:
+                self.send_response(304)  # 304 Not Modified
+                self.end_headers()
+                return
+            self.send_response(200)  # 200 OK
+            self.send_header('Content-type', 'text/plain')
+            if delta is None:
+                lines = [version, "F"] + list(statuses)
+            else:
+                lines = [version, "D"] + ["%d=%s" % (i, v) for i, v in sorted(delta.items())]
+            bstatus = "\n".join(lines).encode()
+            self.send_header("Content-Length", str(len(bstatus)))
+            self.end_headers()
+            self.wfile.write(bstatus)
+            self.wfile.flush()
+        # }
+
         def get_status():  # {
             """
-                sends response with status information composed of 8 elements, separated by "\n"
+                sends response with status information composed of 10 elements, separated by "\n"
                 - connected ("0"|"1")
                 - device ("device name")
                 - volume (000-100)
@@ -785,6 +4375,7 @@ class MyHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):  # {
                 - current_time ("-- --")
                 - duration ("-- --")
                 - paused ("1")
+                - transitions (track-transition gap summary, see TransitionStats.status_text())
             """
             statuses = thePlayer.get_status()
             try:
@@ -818,6 +4409,38 @@ class MyHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):  # {
             self.wfile.flush()
         # }
 
+        def get_transitions():  # {
+            """
+                sends response with track-transition timing summary (JSON), see TransitionStats.summary()
+            """
+            body = json.dumps(thePlayer.get_transitions()).encode()
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            self.wfile.flush()
+        # }
+
+        def fanout():  # {
+            """
+                "fanout <keys> <command> [args..]", e.g.: "fanout 1,2,3 set_volume 0.3"
+                - see InteractivePlayer.fanout() for the commands
+                - play_list's argument is a JSON list: "fanout 1,2 play_list ["/music/a.mp3", ..]"
+                - sends response with per-device results (JSON)
+            """
+            try:
+                _, keys, command, *args = content.split(" ")
+                if command == 'play_list':
+                    args = content.split(" ", 3)[3:]   # (the JSON list may contain spaces)
+                body = json.dumps(thePlayer.fanout(keys.split(","), command, *args))
+            except ValueError as error:
+                body = json.dumps({'error': str(error)})
+            body = body.encode()
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            self.wfile.flush()
+        # }
+
         # dictionary of commands and their respective handlers
         commands = {
                 "volume_toggle_mute": thePlayer.volume_toggle_mute,
@@ -828,17 +4451,31 @@ class MyHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):  # {
                 "play_pause_resume": thePlayer.play_pause_resume,
                 "scan_devices": scan_devices,
                 "get_status": get_status,
+                "get_transitions": get_transitions,
+                "fanout": fanout,
                 }
-        if (content in commands) or content.startswith("select_device"):
-            # Log incoming commands except for get_status (since they come in every second or so)
-            if not (content == "get_status"):
+        command = content.split(" ", 1)[0]
+        self.metrics_path = command if command in commands or command == "select_device" else 'unknown'
+
+        if content.startswith("get_status "):
+            get_status_since(content.split(" ", 1)[1])
+
+        elif command == "fanout":
+            logger.info("Got POST command: %s" % content)
+            self.send_response(200)  # 200 OK
+            self.send_header('Content-type', 'application/json')
+            fanout()
+
+        elif (content in commands) or content.startswith("select_device"):
+            # Log incoming commands except for status queries (since they come in every second or so)
+            if not (content in ("get_status", "get_transitions")):
                 logger.info("Got POST command: %s" % content)
 
             self.send_response(200)  # 200 OK
             self.send_header('Content-type', 'text/plain')
 
-            # special handling for 'get_status' and 'scan_devices' since they send data back to web page
-            if not (content == "get_status" or content == "scan_devices"):
+            # special handling for commands that send data back to web page
+            if not (content in ("get_status", "scan_devices", "get_transitions")):
                 self.end_headers()
 
             # special handling for "select_device X"
@@ -853,7 +4490,7 @@ class MyHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):  # {
             self.send_response(400)  # 400 Bad Request
             self.end_headers()
             logger.error("Unknown POST command: %s" % content)
-    # } def do_POST(self):
+    # } def _do_POST(self):
 # } ## class MyHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
 
 
@@ -878,11 +4515,220 @@ class MyThreadingTCPServer(socketserver.ThreadingTCPServer):  # {
     def server_bind(self):
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.socket.bind(self.server_address)
+        self.server_address = self.socket.getsockname()   # actual port if bound to port 0
 # }
 
 
+# Media processes
+#
+# With --media_processes N, the media URLs the devices fetch (/t/<track_id>
+# and /a/<track_id>) are served by N separate processes on MEDIA_PORT, so that
+# media delivery and the control side (API and status requests, the console
+# UI, pychromecast's threads, cover extraction in play()) don't stall each
+# other on one GIL.
+# - a media process is this script run as "mediaserver"; they share the port
+#   (SO_REUSEPORT) so the kernel spreads the connections between them
+# - track IDs are registered by the control process (theTracks); a media
+#   process looks up IDs it hasn't seen from the control process's
+#   TrackResolver, over a Unix socket, and remembers them
+# - MediaProcesses restarts a media process that dies, and media processes
+#   exit when the control process does
+# - each media process paces its own streams, so --max_bandwidth is divided
+#   between them
+
+MEDIA_PORT = None   # port of the media processes, None when media is served on PORT
+
+class TrackResolver():  # {
+    """ answers media processes' track ID lookups from theTracks:
+        "<track_id>\n" -> "<path>\n" (empty if unknown), any number per connection
+    """
+    def __init__(self, socket_path):
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    path = theTracks.get_path(line.strip().decode('ascii', 'replace')) or ""
+                    self.wfile.write(path.encode('utf-8', 'surrogateescape') + b"\n")
+        self.socket_path = socket_path
+        self.server = socketserver.ThreadingUnixStreamServer(socket_path, Handler)
+        self.server.daemon_threads = True
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        try:
+            os.remove(self.socket_path)
+        except OSError:
+            pass
+# } ## class TrackResolver():
+
+class RemoteTrackTable(TrackTable):  # {
+    """ TrackTable of a media process: IDs it doesn't know are looked up from the control process
+    """
+    def __init__(self, socket_path):
+        super().__init__()
+        self.socket_path = socket_path
+        self.remote_lock = threading.Lock()
+        self.remote = None      # file of connection to the TrackResolver
+        self.lookups = 0
+
+    def get_path(self, tid):
+        path = super().get_path(tid)
+        if path is None and re.fullmatch(r'[0-9a-f]{16}', tid):
+            path = self._lookup(tid)
+            if path:
+                with self.lock:
+                    self.paths[tid] = path
+        return path
+
+    def _lookup(self, tid):
+        with self.remote_lock:
+            for attempt in range(2):    # (reconnecting once)
+                try:
+                    if self.remote is None:
+                        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                        sock.connect(self.socket_path)
+                        self.remote = sock.makefile('rwb')
+                        sock.close()    # (the file keeps the connection open)
+                    self.remote.write(tid.encode('ascii') + b"\n")
+                    self.remote.flush()
+                    line = self.remote.readline()
+                    if not line:
+                        raise OSError("connection closed")
+                    self.lookups += 1
+                    return line.rstrip(b"\n").decode('utf-8', 'surrogateescape') or None
+                except OSError as error:
+                    logger.warning("Track lookup from control process failed: %s" % error)
+                    if self.remote:
+                        self.remote.close()
+                    self.remote = None
+            return None
+# } ## class RemoteTrackTable():
+
+class MediaHTTPRequestHandler(MyHTTPRequestHandler):
+    """ request handler of the media processes: media and cover art only
+    """
+    def _do_GET(self):
+        if self.path.startswith(('/t/', '/a/')):
+            super()._do_GET()
+        else:
+            self.send_error(404, "File not found")
+
+    def do_HEAD(self):
+        if self.path.startswith('/t/'):
+            super().do_HEAD()
+        else:
+            self.send_error(404, "File not found")
+
+    def _do_POST(self):
+        self.send_error(404, "File not found")
+
+class MediaTCPServer(MyThreadingTCPServer):
+    """ server of the media processes, which share its port
+    """
+    daemon_threads = True
+
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+def run_media_server(socket_path, port, stop):
+    """ media process: serves media on port, until stop is set or the control process exits
+    """
+    global theTracks
+    theTracks = RemoteTrackTable(socket_path)
+    server = MediaTCPServer(("", port), MediaHTTPRequestHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    logger.info("Media process (pid %d) serving on port %d" % (os.getpid(), server.server_address[1]))
+    parent = os.getppid()
+    while not stop.wait(1):
+        if os.getppid() != parent:
+            logger.warning("Media process (pid %d): control process gone, exiting" % os.getpid())
+            break
+    server.shutdown()
+    server.server_close()
+
+class MediaProcesses():  # {
+    """ starts the media processes, and restarts any that die
+        - child_args: options for the media processes' command lines
+    """
+    CHECK_INTERVAL = 1.0    # seconds
+
+    def __init__(self, n, port, child_args=()):
+        self.n = n
+        self.port = port
+        self.child_args = list(child_args)
+        self.socket_dir = tempfile.mkdtemp(prefix="s2c_media_")
+        self.resolver = TrackResolver(os.path.join(self.socket_dir, "tracks.sock"))
+        self.processes = []
+        self.restarts = 0
+        self.stopped = threading.Event()
+
+    def _spawn(self, i):
+        argv = [sys.executable, os.path.realpath(__file__), 'mediaserver', self.resolver.socket_path,
+                '--media_port', str(self.port)] + self.child_args
+        env = dict(os.environ, **{LOG_FILE_ENV: "s2c.media%d.log" % i})
+        return subprocess.Popen(argv, stdin=subprocess.DEVNULL, env=env)
+
+    def start(self):
+        self.resolver.start()
+        self.processes = [self._spawn(i) for i in range(self.n)]
+        thread = threading.Thread(target=self._supervise)
+        thread.daemon = True
+        thread.start()
+        logger.info("Started %d media processes on port %d" % (self.n, self.port))
+        return self
+
+    def wait_ready(self, timeout=10):
+        """ returns True once the port accepts connections
+        """
+        end = time.time() + timeout
+        while time.time() < end:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=1).close()
+                return True
+            except OSError:
+                time.sleep(0.05)
+        return False
+
+    def _supervise(self):
+        while not self.stopped.wait(self.CHECK_INTERVAL):
+            for i, process in enumerate(self.processes):
+                if process.poll() is not None and not self.stopped.is_set():
+                    logger.warning("Media process (pid %d) exited (%s), restarting" % (process.pid, process.returncode))
+                    self.processes[i] = self._spawn(i)
+                    self.restarts += 1
+
+    def stop(self):
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        self.resolver.stop()
+        shutil.rmtree(self.socket_dir, ignore_errors=True)
+# } ## class MediaProcesses():
+
+theMediaProcesses = None    # global singleton, set in main() with --media_processes
+
+
 thePlayer = None            # global singleton
 
+API_VERSION = 1
+API_PATH = "/api/v%d" % API_VERSION     # JSON control API, see MyHTTPRequestHandler.send_api_response()
+
 class InteractivePlayer():  # {
     """ Interactive Playlist player
 
@@ -890,17 +4736,84 @@ class InteractivePlayer():  # {
         - HTTP server for servicing music-file GET requests (from Chromecast) and player-command POST requests (from player-controller web page)
         - console-based key-char-based player-controller
     """
-    def __init__(self, playlist_folder):
+    FANOUT_WORKERS = 8      # max devices commanded concurrently by fanout()
+    FANOUT_TIMEOUT = 10     # seconds
+
+    # run_commands() commands: name -> fcn(player, *args), returning a JSON-able result
+    API_COMMANDS = {
+            'volume_toggle_mute': lambda player: player.volume_toggle_mute(),
+            'volume_up': lambda player: player.volume_up(),
+            'volume_down': lambda player: player.volume_down(),
+            'set_volume': lambda player, volume: player.set_volume(volume),
+            'prev_track': lambda player: player.prev_track(),
+            'next_track': lambda player: player.next_track(),
+            'play_pause_resume': lambda player: player.play_pause_resume(),
+            'play_folder': lambda player: player.play_folder(),
+            'play_album': lambda player, album, artist=None: player.play_album(album, artist),
+            'play_m3u': lambda player, name: player.play_m3u(name),
+            'save_m3u': lambda player, name: player.save_m3u(name),
+            'enqueue': lambda player, *tracks: player.enqueue(tracks),
+            'play_next': lambda player, *tracks: player.enqueue(tracks, play_next=True),
+            'enqueue_album': lambda player, album, artist=None: player.enqueue_album(album, artist),
+            'get_up_next': lambda player: player.get_up_next(),
+            'clear_up_next': lambda player: player.clear_up_next(),
+            'select_device': lambda player, device_key: player.set_device(str(device_key)),
+            'scan_devices': lambda player: {k: cc.name for k, cc in player.scan_devices().items()},
+            'get_transitions': lambda player: player.get_transitions(),
+            'fanout': lambda player, keys, command, *args: player.fanout(keys, command, *args),
+            }
+
+    # fanout() commands: name -> fcn(cas, *args)
+    FANOUT_COMMANDS = {
+            'set_volume': lambda cas, vol: cas.set_vol(float(vol)),
+            'volume_up': lambda cas, step=0.05: cas.vol_up(float(step))[1],
+            'volume_down': lambda cas, step=0.05: cas.vol_down(float(step))[1],
+            'toggle_mute': lambda cas: cas.vol_toggle_mute(),
+            'pause': lambda cas: cas.pause(),
+            'resume': lambda cas: cas.resume(),
+            'stop': lambda cas: cas.stop(),
+            'play_list': lambda cas, filelist: cas.play_list(list(filelist)),
+            }
+
+    @staticmethod
+    def _fanout_filelist(args):
+        """ play_list's argument: a list of files, or a JSON list (http POST arguments are strings)
+        """
+        if len(args) != 1:
+            raise ValueError("play_list takes one argument, a list of files")
+        filelist = args[0]
+        if isinstance(filelist, str):
+            try:
+                filelist = json.loads(filelist)
+            except ValueError:
+                raise ValueError("play_list takes a JSON list of files, not: %.100s" % filelist)
+        if not isinstance(filelist, list) or not all(isinstance(f, str) for f in filelist):
+            raise ValueError("play_list takes a list of files")
+        return filelist
+    def __init__(self, playlist_folder, scan_workers=None, watch_library=True):
         self.playlist_folder = playlist_folder
+        self.scan_workers = scan_workers
+        self.library_scanner = None
+        self.watch_library = watch_library
+        self.library_watcher = None
         self.cas = None     # CC Audio Streamer
         self.connected = False
+        self.fanout_sessions = {}   # device name -> CcAudioStreamer, for devices other than self.cas
+        self.fanout_device_locks = {}   # device name -> lock held while getting its fanout session
+        self.fanout_lock = threading.Lock()     # for fanout_device_locks
+        self.fanout_pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.FANOUT_WORKERS)
         self.vol_step = 0.05
-        self.lock = threading.RLock()  # mutex for thread-safety
+        self.lock = TimedRLock('InteractivePlayer')  # mutex for thread-safety
         self._get_devices()
         self.scroll_index = 0
         self.scroll_timestamp = 0   # previous scroll time
         self.scroll_result = ""
         self.prev_scroll_text = None
+        # versioned status, for conditional get_status requests
+        # - version is "<epoch>.<n>" so that versions from before a restart never match
+        self.status_epoch = "%x" % int(time.time())
+        self.status_version = 0
+        self.status_history = collections.deque(maxlen=32)  # (version, statuses)
 
     def _get_devices(self):
         """ Gets chromecast audio devices and groups
@@ -940,13 +4853,14 @@ class InteractivePlayer():  # {
         with self.lock:
             cc  = self.cc_key_mapping[device_key]
             # TODO: maybe remove this already connected check? and instead do a disconnect and connect??
-            if self.cas and (self.cas.get_name() == cc.name):
+            if self.cas and (self.cas.get_name() == cc.name) and self.cas.is_connected():
                 print("Already connected to:", cc.name, "(%s)"%cc.model_name)
                 return
             print("Selected:", cc.name, "(%s)"%cc.model_name)
             self.disconnect()
             logger.info("Instantiating self.cas w/ CcAudioStreamer instance -- should get callback..")
-            self.cas = CcAudioStreamer(cc, new_media_status_callback=self._new_media_status_callback)
+            self.cas = CcAudioStreamer(cc, new_media_status_callback=self._new_media_status_callback,
+                    session_lock=self.lock)
 # TODO: should be OK to remove this since self.connected is set True in the callback
             # TODO: Operation should account for both connection-state and playing-state
             # if we set .connected = True here, we can monitor anything that is already playing on the device
@@ -962,16 +4876,105 @@ class InteractivePlayer():  # {
                 logger.warning("InteractivePlayer Disconnecting...")
                 self.cas.disconnect()
 
-    def start(self):
+    def start(self, handoff=None):
         self._start_server()
+        self._start_library_scan()
         self._show_key_mappings(self.cc_key_mapping)
+        if handoff:
+            self.restore_handoff(handoff)
         self._main_loop()
         logger.warning("Exitted _main_loop")    # Debugging slow quitting
 
+    def serve(self, devicename=None, handoff=None):
+        """ headless alternative to start(): server only (controlled via web page), no console UI
+            - runs until interrupted (Ctrl-C or SIGTERM)
+            - handoff: session to resume, see "Memory watchdog"
+        """
+        self._start_server()
+        self._start_library_scan()
+        if handoff:
+            self.restore_handoff(handoff)
+        elif devicename:
+            for k, cc in self.cc_key_mapping.items():
+                if cc.name == devicename:
+                    self.set_device(k)
+                    break
+            else:
+                print("Unable to locate specified device ('%s')" % devicename)
+        stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+        try:
+            while not stop.wait(1):
+                pass
+        except KeyboardInterrupt:
+            pass
+        self.my_server.shutdown()
+        if theMediaProcesses:
+            theMediaProcesses.stop()
+        self.library_scanner.cancel()
+        if self.library_watcher:
+            self.library_watcher.stop()
+        self.disconnect()
+
+    def get_handoff_state(self):
+        """ session state for restart_with_handoff(), {} if no device selected
+        """
+        with self.lock:
+            return self.cas.get_handoff_state() if self.cas else {}
+
+    def restore_handoff(self, handoff):
+        """ select the handoff's device and resume its session
+        """
+        for k, cc in self.cc_key_mapping.items():
+            if cc.name == handoff.get('device'):
+                self.set_device(k)
+                with self.lock:
+                    self.cas.restore_handoff_state(handoff)
+                return
+        logger.error("Unable to locate handed-off device ('%s')" % handoff.get('device'))
+
+    def _start_library_scan(self):
+        """ index the playlist folder in the background
+        """
+        def progress(scanned, found):
+            if scanned % 1000 < self.library_scanner.chunk_size:
+                logger.info("Library scan: %d/%d files" % (scanned, found))
+
+        def scan():
+            start = time.time()
+            n = theLibrary.scan(self.playlist_folder, self.library_scanner)
+            logger.info("Library scan %s: %d tracks (%d unreadable) in %.1fs" % (
+                "cancelled" if self.library_scanner.cancelled.is_set() else "done",
+                n, self.library_scanner.errors, time.time() - start))
+            if theLoudness:
+                theLoudness.analyze(theLibrary.paths())
+
+        self.library_scanner = LibraryScanner(workers=self.scan_workers, progress_callback=progress)
+        scan_thread = threading.Thread(target=scan)
+        scan_thread.daemon = True
+        scan_thread.start()
+
+        if self.watch_library:
+            self.library_watcher = LibraryWatcher(self.playlist_folder, theLibrary,
+                    on_change=self._library_changed).start()
+
+    def _library_changed(self, added, removed):
+        """ LibraryWatcher callback: apply changes to current playlist
+        """
+        with self.lock:
+            if self.cas:
+                self.cas.update_playlist(added, removed)
+        if theLoudness and added:
+            theLoudness.analyze(added)
+
     def _start_server(self):
         with self.lock:
+            global theStaticAssets
+            theStaticAssets = StaticAssetCache(os.path.join(SERVER_DIRECTORY, WEB_PAGE_REL_PATH))
             self.my_server = MyThreadingTCPServer(("", PORT), MyHTTPRequestHandler)
             simple_threaded_server(self.my_server)
+            if theMediaProcesses:
+                theMediaProcesses.start()
             logger.info("Server started")
             print("Server started")
 
@@ -1027,7 +5030,7 @@ class InteractivePlayer():  # {
                 _clear_line2()
 
                 statuses = self.get_status()
-                connected, device, volume, artist, title, album, current_time, duration, paused = statuses
+                connected, device, volume, artist, title, album, current_time, duration, paused, transitions = statuses
                 if device == "":
                     # This branch taken at startup when no device or group is selected
                     status = "Select device or group:"
@@ -1120,6 +5123,9 @@ class InteractivePlayer():  # {
                 if k == 'q':
                     # TODO: this should probably tell CC to stop
                     self.my_server.shutdown()
+                    self.library_scanner.cancel()
+                    if self.library_watcher:
+                        self.library_watcher.stop()
                     self.disconnect()   # TODO: not sure if this needed or if it will cause problems
                     interactive_print("Quitting")
                     break
@@ -1151,6 +5157,8 @@ class InteractivePlayer():  # {
                 elif k == '?':
                     print("Help")
                     self.scan_devices()
+                    for line in self.get_transition_lines():
+                        print(line)
 
                 # unused:
                 else:
@@ -1195,6 +5203,12 @@ class InteractivePlayer():  # {
                 self._update_vol_step(new)
                 #interactive_print("Vol: %.2f -> %.2f" % (prev, new), clear_line=True)
 
+    def set_volume(self, volume):
+        with self.lock:
+            if self.cas:
+                self.cas.set_vol(min(max(float(volume), 0.0), 1.0))
+                self._update_vol_step(self.cas.get_vol())
+
     def play_pause_resume(self):
         with self.lock:
             if self.cas:
@@ -1206,6 +5220,76 @@ class InteractivePlayer():  # {
             if self.cas:
                 self.cas.play_folder(self.playlist_folder)
 
+    def play_album(self, album, artist=None):
+        with self.lock:
+            if self.cas:
+                self.cas.play_album(album, artist)
+
+    def _playlist_file(self, name):
+        """ path of playlist file name, which must be in the playlist folder
+        """
+        folder = os.path.abspath(self.playlist_folder)
+        filename = os.path.normpath(os.path.join(folder, name))
+        if not filename.lower().endswith(M3U_SUFFIXES) or not filename.startswith(os.path.join(folder, "")):
+            raise ValueError("Invalid playlist name: %s" % name)
+        return filename
+
+    def play_m3u(self, name):
+        """ play playlist file name (relative to the playlist folder)
+            returns {"tracks": n, "missing": [entries..]}
+        """
+        filename = self._playlist_file(name)
+        with self.lock:
+            if self.cas:
+                n, missing = self.cas.play_m3u(filename)
+                return {'tracks': n, 'missing': missing}
+
+    def save_m3u(self, name):
+        """ save the current playlist as playlist file name (relative to the playlist folder)
+            returns number of tracks saved
+        """
+        filename = self._playlist_file(name)
+        with self.lock:
+            if self.cas:
+                return self.cas.export_m3u(filename)
+
+    def enqueue(self, tracks, play_next=False):
+        """ queue tracks (track IDs or paths) to play next, see CcAudioStreamer.enqueue()
+            returns number of tracks queued
+        """
+        filenames = []
+        for track in tracks:
+            path = theTracks.get_path(track) or track
+            filenames.append(theLibrary.locate(os.path.abspath(path)) or path)   # library form, as in playlists
+        with self.lock:
+            if self.cas:
+                return len(self.cas.enqueue(filenames, play_next))
+
+    def enqueue_album(self, album, artist=None):
+        """ queue album's tracks (from theLibrary) in order
+        """
+        filenames = sorted(theLibrary.filter(artist=artist, album=album))
+        if not filenames:
+            raise ValueError("No tracks found for album: %s" % album)
+        return self.enqueue(filenames)
+
+    def clear_up_next(self):
+        with self.lock:
+            if self.cas:
+                self.cas.clear_up_next()
+
+    def get_up_next(self):
+        """ returns list of {"id", "artist", "title", "album"} per queued track
+        """
+        with self.lock:
+            queued = self.cas.get_up_next() if self.cas else []
+        tracks = []
+        for tid, path in queued:
+            info = theLibrary.get(path)
+            tracks.append({'id': tid, 'artist': info.artist if info else "",
+                'title': info.title if info else os.path.basename(path), 'album': info.album if info else ""})
+        return tracks
+
     def next_track(self):
         with self.lock:
             if self.cas:
@@ -1218,9 +5302,110 @@ class InteractivePlayer():  # {
                 self.cas.prev_track()
                 #interactive_print("Prev track")
 
+    def _get_fanout_session(self, device_key):
+        """ CcAudioStreamer for device_key (not the selected device), kept in self.fanout_sessions
+            (created on first use)
+        """
+        cc = self.cc_key_mapping[device_key]
+        with self.fanout_lock:
+            device_lock = self.fanout_device_locks.setdefault(cc.name, threading.Lock())
+        # per-device lock: concurrent fanouts share one session, other devices connect meanwhile
+        with device_lock:
+            cas = self.fanout_sessions.get(cc.name)
+            if not (cas and cas.is_connected()):
+                cas = CcAudioStreamer(cc, write_cover=False)
+                self.fanout_sessions[cc.name] = cas
+            return cas
+
+    def _fanout_one(self, device_key, command, args):
+        """ (on fanout_pool) command on a device other than the selected one
+        """
+        start = time.perf_counter()
+        cas = self._get_fanout_session(device_key)
+        result = self.FANOUT_COMMANDS[command](cas, *args)
+        return result, time.perf_counter() - start
+
+    def _fanout_selected(self, device_key, command, args):
+        """ command on the selected device, under self.lock as the other commands on it
+            - in the calling thread, which may be a run_commands() caller already holding self.lock
+        """
+        start = time.perf_counter()
+        with self.lock:
+            if self.cas and self.cas.get_name() == self.cc_key_mapping[device_key].name:
+                return self.FANOUT_COMMANDS[command](self.cas, *args), time.perf_counter() - start
+        return self._fanout_one(device_key, command, args)  # (no longer selected)
+
+    def fanout(self, device_keys, command, *args, timeout=None):
+        """ run command on several devices concurrently
+            - device_keys: keys from cc_key_mapping
+            - command: name from FANOUT_COMMANDS, with args
+              (for 'play_folder' the same shuffled playlist is started on every device)
+            - the selected device runs the command in the calling thread (under self.lock),
+              the others concurrently on fanout_pool
+            returns {device_key: {'device', 'ok', 'result' or 'error', 'seconds'}}
+        """
+        timeout = self.FANOUT_TIMEOUT if timeout is None else timeout
+        if command == 'play_folder':
+            filelist = list(find_tracks(self.playlist_folder))
+            random.shuffle(filelist)
+            command, args = 'play_list', (filelist,)
+        if command not in self.FANOUT_COMMANDS:
+            raise ValueError("Unknown fanout command: %s" % command)
+        if command == 'play_list':
+            args = (self._fanout_filelist(args),)
+        logger.info("Fanout: %s%s -> %s" % (command, "" if command == 'play_list' else args, ",".join(device_keys)))
+
+        start = time.perf_counter()
+        futures = {}
+        results = {}
+        selected = []
+        cas = self.cas
+        for key in device_keys:
+            if key not in self.cc_key_mapping:
+                results[key] = {'device': None, 'ok': False, 'error': "unknown device", 'seconds': 0}
+            elif cas and cas.get_name() == self.cc_key_mapping[key].name:
+                selected.append(key)
+            else:
+                futures[key] = self.fanout_pool.submit(self._fanout_one, key, command, args)
+        for key in selected:    # while the other devices run
+            futures[key] = concurrent.futures.Future()
+            try:
+                futures[key].set_result(self._fanout_selected(key, command, args))
+            except Exception as error:
+                futures[key].set_exception(error)
+        done, not_done = concurrent.futures.wait(futures.values(),
+                timeout=max(0, timeout - (time.perf_counter() - start)))
+        for key, future in futures.items():
+            result = {'device': self.cc_key_mapping[key].name}
+            if future in not_done:
+                future.cancel()
+                result.update(ok=False, error="timeout", seconds=timeout)
+            elif future.exception() is not None:
+                result.update(ok=False, error=str(future.exception()) or type(future.exception()).__name__,
+                        seconds=time.perf_counter() - start)
+            else:
+                value, seconds = future.result()
+                result.update(ok=True, result=value, seconds=seconds)
+            results[key] = result
+        logger.info("Fanout: %s done in %.2fs, %d/%d ok" % (command, time.perf_counter() - start,
+            sum(1 for r in results.values() if r['ok']), len(results)))
+        return results
+
+    def get_transitions(self):
+        """ track-transition timing summary for current device, see TransitionStats.summary()
+        """
+        with self.lock:
+            transitions = self.cas.transitions if self.cas else TransitionStats()
+        return transitions.summary()
+
+    def get_transition_lines(self):
+        with self.lock:
+            transitions = self.cas.transitions if self.cas else TransitionStats()
+        return transitions.format_summary()
+
     def get_status(self):  # {
-        """ returns status as 8-element tuple
-            - connected, device, volume, artist, title, album, current_time, duration
+        """ returns status as 10-element tuple
+            - connected, device, volume, artist, title, album, current_time, duration, paused, transitions
         """
         device = ""
         volume = ""
@@ -1230,9 +5415,11 @@ class InteractivePlayer():  # {
         current_time = ""
         duration = ""
         paused = ""
+        transitions = ""
         with self.lock:  # {
             if self.cas:  # {
                 device = self.cas.get_name()
+                transitions = self.cas.transitions.status_text()
                 if self.connected:  # {
                     muted, pre_muted_vol = self.cas.get_muted()
                     # unicode speaker characters
@@ -1246,14 +5433,12 @@ class InteractivePlayer():  # {
                         volume = SPEAKER_3 + "%03d" % int(100 * self.cas.get_vol() + 0.5)
 
                     track_info = self.cas.get_track_info()
-                    if track_info is None:
-                        print("Disconnected from device:")
-                        self.disconnect()
-                        self.cas = None
+                    if not self.cas.is_connected():
+                        # device lost, session kept while cas reconnects in background
+                        # - set back to connected by the status callback
                         self.connected = False
-                    else:
-                        if track_info != "":
-                            artist, title, album, current_time, duration = track_info
+                    elif track_info != "":
+                        artist, title, album, current_time, duration = track_info
         #                   track_status = "%s - %s (%s)" % (artist, title, album)
         #                   playback_status = "%s/%s " % (current_time, duration)
 
@@ -1269,10 +5454,63 @@ class InteractivePlayer():  # {
             # }
 
             connected = "1" if self.connected else "0"
+            statuses = connected, device, volume, artist, title, album, current_time, duration, paused, transitions
+            if not self.status_history or self.status_history[-1][1] != statuses:
+                self.status_version += 1
+                self.status_history.append((self._status_version_str(self.status_version), statuses))
         # }
-        return connected, device, volume, artist, title, album, current_time, duration, paused
+        return statuses
     # }
 
+    def _status_version_str(self, n):
+        return "%s.%d" % (self.status_epoch, n)
+
+    def get_status_since(self, since_version):
+        """ returns (version, statuses, delta) where delta is
+            - {} if not modified since since_version
+            - {field_index: value} for fields changed since since_version
+            - None if since_version is unknown (too old, or from before restart)
+        """
+        with self.lock:
+            statuses = self.get_status()
+            version = self.status_history[-1][0]
+            if since_version == version:
+                return version, statuses, {}
+            for old_version, old_statuses in self.status_history:
+                if old_version == since_version:
+                    delta = {i: new for i, (old, new) in enumerate(zip(old_statuses, statuses)) if old != new}
+                    return version, statuses, delta
+        return version, statuses, None
+
+    def run_commands(self, commands):
+        """ runs commands in order, as one atomic step w.r.t. other requests
+            - commands: list of {"cmd": name from API_COMMANDS, "args": [..]}
+            - stops at the first command that fails, the rest are reported as skipped
+            returns (results, version, statuses) with status after the commands
+              - results: {"cmd", "ok", "result" or "error"} per command
+        """
+        results = []
+        with self.lock:
+            failed = False
+            for command in commands:
+                name = command.get('cmd') if isinstance(command, dict) else None
+                result = {'cmd': name}
+                if failed:
+                    result.update(ok=False, error="skipped")
+                elif name not in self.API_COMMANDS:
+                    result.update(ok=False, error="unknown command")
+                else:
+                    try:
+                        result.update(ok=True, result=self.API_COMMANDS[name](self, *command.get('args', [])))
+                    except Exception as error:
+                        logger.warning("API command %s failed: %s" % (name, error))
+                        result.update(ok=False, error=str(error) or type(error).__name__)
+                failed = failed or not result['ok']
+                results.append(result)
+            statuses = self.get_status()
+            version = self.status_history[-1][0]
+        return results, version, statuses
+
     @staticmethod
     def _show_key_mappings(cc_key_mapping):  # {
         """
@@ -1314,19 +5552,392 @@ def interactive_print(*args, **kwargs):
     print(" ".join(map(str, args)), **kwargs)
 
 
+# Server load benchmark
+#
+#   stream2cca.py benchserver [n_receivers [n_clients [seconds]]]
+#
+# Runs a headless server (stream2cca.py serve) in a subprocess against a
+# synthetic library, playing on a fake device, then drives it with:
+# - n_receivers simulated receivers, each repeatedly fetching whole mp3 files
+# - n_clients simulated web pages, each polling get_status (and fetching the
+#   cover art and a web-page asset every few polls)
+# Reports per-endpoint request counts and p50/p99 latencies, media throughput,
+# server CPU per stream and peak server threads/RSS, and saves the results to
+# bench_server_<git hash>.json (next to this file) for comparison between commits.
+# - the server runs from a copy of this file and its web page in a temporary
+#   folder, so it doesn't overwrite the ip_address.js or cover.jpg of a server
+#   running from this checkout; it logs to s2c.bench.log
+
+import platform
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def _copy_web_page(folder):
+    """ copies this file and its web page (see StaticAssetCache) to folder, returns the copy of this file
+        - a server run from the copy writes its cover.jpg in folder
+    """
+    src = os.path.dirname(os.path.realpath(__file__))
+    os.makedirs(folder, exist_ok=True)
+    for name in os.listdir(src):
+        if (name.lower().endswith(StaticAssetCache.ASSET_SUFFIXES) and name not in StaticAssetCache.DYNAMIC
+                and os.path.isfile(os.path.join(src, name))):
+            shutil.copy(os.path.join(src, name), folder)
+    if os.path.isdir(os.path.join(src, "imgs")):
+        shutil.copytree(os.path.join(src, "imgs"), os.path.join(folder, "imgs"))
+    return shutil.copy(os.path.realpath(__file__), folder)
+
+def _proc_stats(pid):
+    """ returns (cpu_seconds, threads, rss_kb, peak_rss_kb) for process pid (Linux /proc)
+    """
+    with open("/proc/%d/stat" % pid) as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")  # utime + stime
+    status = {}
+    with open("/proc/%d/status" % pid) as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            status[key] = value.split()
+    return cpu, int(status["Threads"][0]), int(status["VmRSS"][0]), int(status["VmHWM"][0])
+
+def bench_server(n_receivers=4, n_clients=8, seconds=20, n_tracks=40, poll_interval=0.25,
+        output=None):
+    """ see "Server load benchmark" above, returns results dictionary
+    """
+    import http.client
+
+    latencies = collections.defaultdict(list)   # endpoint -> [seconds]
+    errors = collections.Counter()
+    media_bytes = [0] * n_receivers
+    stop = threading.Event()
+    results_lock = threading.Lock()
+
+    def record(endpoint, elapsed):
+        with results_lock:
+            latencies[endpoint].append(elapsed)
+
+    def request(port, method, path, body=None, endpoint=None, sink=None):
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        start = time.perf_counter()
+        try:
+            conn.request(method, path, body=body)
+            response = conn.getresponse()
+            record((endpoint or path) + " (first byte)", time.perf_counter() - start)
+            n = 0
+            first_chunk = b""
+            while True:
+                chunk = response.read(64 * 1024)
+                if not chunk:
+                    break
+                first_chunk = first_chunk or chunk
+                n += len(chunk)
+            record(endpoint or path, time.perf_counter() - start)
+            if sink is not None:
+                sink(n)
+            return response.status, first_chunk
+        except OSError as error:
+            with results_lock:
+                errors[endpoint or path] += 1
+            return None, b""
+        finally:
+            conn.close()
+
+    def receiver(i, port, tracks):
+        rng = random.Random(i)
+        def add_bytes(n):
+            media_bytes[i] += n
+        while not stop.is_set():
+            request(port, "GET", "/t/" + track_id(rng.choice(tracks)), endpoint="GET media",
+                    sink=add_bytes)
+
+    def web_client(port):
+        version = ""
+        polls = 0
+        while not stop.is_set():
+            status, body = request(port, "POST", "/", body=("get_status " + version).encode(),
+                    endpoint="POST get_status")
+            if status == 200:
+                version = body.decode().split("\n", 1)[0]
+            polls += 1
+            if polls % 4 == 0:
+                request(port, "GET", "/cover.jpg", endpoint="GET cover.jpg")
+                request(port, "GET", "/web_page.js", endpoint="GET static")
+            stop.wait(poll_interval)
+
+    with tempfile.TemporaryDirectory() as folder:
+        library = os.path.join(folder, "library")
+        tracks = make_synthetic_library(library, n_tracks, seconds=30)
+        script = _copy_web_page(os.path.join(folder, "web"))
+        with socket.socket() as s:     # pick a free port
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        server = subprocess.Popen([sys.executable, script, "serve",
+            "-f", library, "--port", str(port), "--fake_devices", "1", "-d", "Fake Audio 1",
+            "--no_history", "--no_watch",
+            "--stream_rate", "0"],     # unpaced, so results compare with earlier runs
+            stdout=subprocess.DEVNULL, stdin=subprocess.DEVNULL, cwd=folder,
+            env=dict(os.environ, **{LOG_FILE_ENV: os.path.abspath("s2c.bench.log")}))
+        try:
+            end = time.time() + 30
+            while True:
+                try:
+                    socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                    break
+                except OSError:
+                    if time.time() > end or server.poll() is not None:
+                        raise RuntimeError("benchmark server failed to start")
+                    time.sleep(0.1)
+            request(port, "POST", "/", body=b"play_pause_resume", endpoint="setup")
+
+            threads = [threading.Thread(target=receiver, args=(i, port, tracks)) for i in range(n_receivers)]
+            threads += [threading.Thread(target=web_client, args=(port,)) for i in range(n_clients)]
+            cpu_start = _proc_stats(server.pid)[0]
+            start = time.time()
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            peak_threads = 0
+            while time.time() - start < seconds:
+                cpu, n_threads, rss_kb, peak_rss_kb = _proc_stats(server.pid)
+                peak_threads = max(peak_threads, n_threads)
+                time.sleep(0.2)
+            cpu, n_threads, rss_kb, peak_rss_kb = _proc_stats(server.pid)
+            elapsed = time.time() - start
+            stop.set()
+            for thread in threads:
+                thread.join(timeout=35)
+        finally:
+            server.terminate()
+            server.wait()
+
+    server_cpu = cpu - cpu_start
+    endpoints = {}
+    for endpoint, values in sorted(latencies.items()):
+        if endpoint.startswith("setup"):
+            continue
+        values.sort()
+        endpoints[endpoint] = {
+                'requests': len(values),
+                'requests_per_s': len(values) / elapsed,
+                'errors': errors[endpoint],
+                'p50_ms': 1000 * _percentile(values, 50),
+                'p99_ms': 1000 * _percentile(values, 99),
+                'max_ms': 1000 * values[-1],
+                }
+    git_hash = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.realpath(__file__))).decode().strip()
+    results = {
+            'git_hash': git_hash,
+            'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+            'host': "%s %s, python %s, %d cores" % (platform.node(), platform.machine(),
+                platform.python_version(), os.cpu_count() or 1),
+            'params': {'n_receivers': n_receivers, 'n_clients': n_clients, 'seconds': seconds,
+                'n_tracks': n_tracks, 'poll_interval': poll_interval},
+            'elapsed_s': elapsed,
+            'media_mb_per_s': sum(media_bytes) / elapsed / 1e6,
+            'server_cpu_s': server_cpu,
+            'server_cpu_pct': 100 * server_cpu / elapsed,
+            'server_cpu_pct_per_stream': 100 * server_cpu / elapsed / max(1, n_receivers),
+            'server_peak_threads': peak_threads,
+            'server_peak_rss_mb': peak_rss_kb / 1024,
+            'endpoints': endpoints,
+            }
+
+    print("Server benchmark (%s): %d receivers, %d web clients, %.0fs" % (
+        git_hash, n_receivers, n_clients, elapsed))
+    print("  media: %.1f MB/s, server CPU: %.0f%% (%.1f%% per stream), peak threads: %d, peak RSS: %.1f MB" % (
+        results['media_mb_per_s'], results['server_cpu_pct'], results['server_cpu_pct_per_stream'],
+        peak_threads, results['server_peak_rss_mb']))
+    for endpoint, r in endpoints.items():
+        print("  %-30s %6d req %8.1f/s  p50 %8.2f ms  p99 %8.2f ms  errors %d" % (
+            endpoint, r['requests'], r['requests_per_s'], r['p50_ms'], r['p99_ms'], r['errors']))
+
+    output = output or os.path.join(os.path.dirname(os.path.realpath(__file__)),
+            "bench_server_%s.json" % git_hash)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print("Saved results to: %s" % output)
+    return results
+
+
+# Batch mode
+#
+# Runs a sequence of CLI commands over one CcAudioStreamer session, so that
+# discovery and connection are paid once, e.g.:
+#   stream2cca.py batch "setvol 0.1; playfolder; sleep 5; volup; status"
+#   stream2cca.py batch alarm.s2c
+#   echo "pause" | stream2cca.py batch -
+# - commands separated by ';' or newlines, '#' starts a comment, quote
+#   filenames containing spaces
+# - the time taken by each command is reported
+# - a playlist started by playfolder/playm3u keeps playing after the last command
+#   (as for the playfolder command), unless stopped
+
+BATCH_COMMANDS = {  # name -> (min args, max args)
+        'setvol': (1, 1),
+        'volup': (0, 1),
+        'voldown': (0, 1),
+        'mute': (0, 0),
+        'pause': (0, 0),
+        'resume': (0, 0),
+        'stop': (0, 0),
+        'next': (0, 0),
+        'prev': (0, 0),
+        'playfile': (1, 1),
+        'playfolder': (0, 1),
+        'playm3u': (1, 1),
+        'savem3u': (1, 1),
+        'sleep': (1, 1),
+        'status': (0, 0),
+        }
+
+def parse_batch_script(text):
+    """ returns list of [command, args..] from batch script text
+        - raises ValueError for unknown commands or wrong number of args (before anything is run)
+    """
+    commands = []
+    for line in text.splitlines():
+        lexer = shlex.shlex(line, posix=True, punctuation_chars=';')    # allows quoted filenames
+        lexer.whitespace_split = True
+        words = []
+        for word in list(lexer) + [';']:
+            if word != ';':
+                words.append(word)
+                continue
+            if not words:
+                continue
+            command, cmd_args = words[0].lower(), words[1:]
+            if command not in BATCH_COMMANDS:
+                raise ValueError("Unknown batch command: %s" % command)
+            min_args, max_args = BATCH_COMMANDS[command]
+            if not min_args <= len(cmd_args) <= max_args:
+                raise ValueError("Wrong number of arguments for batch command: %s" % " ".join(words))
+            commands.append([command] + cmd_args)
+            words = []
+    return commands
+
+def run_batch(cas, commands, folder, out=print):
+    """ runs commands (from parse_batch_script()) on cas
+        returns (list of (command line, seconds, result), playlist_running)
+        - stops at the first command that fails, re-raising its exception
+    """
+    def status():
+        artist, title, album, current_time, duration = cas.get_track_info() or ("", "", "", "", "")
+        return "%s vol=%.2f %s - %s (%s) %s/%s" % (
+            cas.state, cas.get_vol(), artist, title, album, current_time, duration)
+
+    def playfile(filename):
+        if not os.path.isfile(filename):
+            raise ValueError("Invalid file: %s" % filename)
+        cas.play(filename)
+
+    def playm3u(filename):
+        n, missing = cas.play_m3u(filename)
+        return "%d tracks, %d missing" % (n, len(missing))
+
+    actions = {
+            'setvol': lambda v: cas.set_vol(float(v)),
+            'volup': lambda step=0.1: "%.2f -> %.2f" % cas.vol_up(float(step)),
+            'voldown': lambda step=0.1: "%.2f -> %.2f" % cas.vol_down(float(step)),
+            'mute': cas.vol_toggle_mute,
+            'pause': cas.pause,
+            'resume': cas.resume,
+            'stop': cas.stop,
+            'next': cas.next_track,
+            'prev': cas.prev_track,
+            'playfile': playfile,
+            'playfolder': lambda play_folder=folder: cas.play_folder(play_folder),
+            'playm3u': playm3u,
+            'savem3u': lambda filename: "%d tracks" % cas.export_m3u(filename),
+            'sleep': lambda seconds: time.sleep(float(seconds)),
+            'status': status,
+            }
+
+    timings = []
+    playlist_running = False
+    for command, *cmd_args in commands:
+        line = " ".join([command] + cmd_args)
+        start = time.perf_counter()
+        try:
+            result = actions[command](*cmd_args)
+        except Exception as error:
+            out("%8.3fs  %s  FAILED: %s" % (time.perf_counter() - start, line, error))
+            raise
+        seconds = time.perf_counter() - start
+        timings.append((line, seconds, result))
+        out("%8.3fs  %s%s" % (seconds, line, "" if result is None else "  " + str(result)))
+        if command in ('playfolder', 'playm3u'):
+            playlist_running = bool(cas.get_playlist())
+        elif command in ('stop', 'playfile'):
+            playlist_running = False
+    return timings, playlist_running
+
+def read_batch_script(batch_args):
+    """ batch script text from: '-' (stdin), a script filename, or the args themselves
+    """
+    if batch_args == ['-']:
+        return sys.stdin.read()
+    if len(batch_args) == 1 and os.path.isfile(batch_args[0]):
+        with open(batch_args[0]) as f:
+            return f.read()
+    return " ".join(batch_args)
+
+
 def main(args):  # {
     """
     """
+    logger.info("===== %s started (pid %d): %s" % (os.path.basename(__file__), os.getpid(), " ".join(sys.argv[1:])))
+
     global PLAYLIST_FOLDER
     PLAYLIST_FOLDER = args.folder
 
-    # set server directory to common folder of this file and the specified PLAYLIST_FOLDER
-    cwd = os.getcwd()
+    global FAKE_DEVICES, FAKE_DEVICE_SPEED
+    FAKE_DEVICES = args.fake_devices
+    FAKE_DEVICE_SPEED = args.fake_speed
+
+    # set server directory to the folder of this file (the web_page resources)
+    # - media is served by track ID from the library roots, see "Media files"
     path_of_this_file = os.path.dirname(os.path.realpath(__file__))
     global SERVER_DIRECTORY
-    SERVER_DIRECTORY = os.path.commonpath([path_of_this_file,
-        os.path.normpath(os.path.join(cwd, PLAYLIST_FOLDER))])
+    SERVER_DIRECTORY = path_of_this_file
 #   print("SERVER_DIRECTORY:", SERVER_DIRECTORY)
+    global theTracks
+    theTracks.set_roots([PLAYLIST_FOLDER] + args.root)
+
+    # media stream pacing
+    thePacer.rate_multiple = args.stream_rate
+    thePacer.burst_seconds = args.stream_burst
+    thePacer.max_bandwidth = args.max_bandwidth * 1e6 / 8
+
+    # play-history (kept next to this file so it persists across runs)
+    # - not for replay, its synthetic plays aren't history
+    global thePlayHistory
+    if not args.no_history and args.command_args[:1] != ['replay']:
+        thePlayHistory = PlayHistory(os.path.join(path_of_this_file, 's2c_history.db'))
+        atexit.register(thePlayHistory.close)  # write out queued events
+
+    # loudness: gain mode, and analysis of tracks without ReplayGain tags
+    global GAIN_MODE, theLoudness
+    GAIN_MODE = args.gain
+    if GAIN_MODE != 'off':
+        if LoudnessAnalyzer.available(args.analysis_cmd):
+            theLoudness = LoudnessAnalyzer(theLibrary, args.analysis_cmd, workers=args.analysis_workers,
+                    store=thePlayHistory)
+            atexit.register(theLoudness.stop)
+        else:
+            logger.warning("Decoder not found (%s), only using ReplayGain tags" % args.analysis_cmd.split()[0])
+
+    # transcoding of non-mp3 tracks (cache kept next to this file so it persists across runs)
+    global theTranscoder
+    if not args.no_transcode:
+        if Transcoder.available(args.transcode_cmd):
+            theTranscoder = Transcoder(os.path.join(path_of_this_file, 'transcode_cache'),
+                    args.transcode_cmd, args.transcode_cache_mb << 20)
+        else:
+            logger.warning("Encoder not found (%s), only playing mp3 files" % args.transcode_cmd.split()[0])
 
     # relative path from server directory to this file (and the web_page
     # resources)
@@ -1334,16 +5945,122 @@ def main(args):  # {
     WEB_PAGE_REL_PATH = os.path.relpath(path_of_this_file, SERVER_DIRECTORY)
 #   print("WEB_PAGE_REL_PATH:", WEB_PAGE_REL_PATH)
 
-    if len(args.command_args) == 0:
+    global PORT
+    if args.port != PORT:
+        PORT = args.port
+        write_ip_address_js()
+
+    # separate media processes, see "Media processes"
+    # - started by the serving instance, CLI commands only need the port (for the media URLs)
+    global MEDIA_PORT, theMediaProcesses
+    serving = len(args.command_args) == 0 or args.command_args[0].lower() == 'serve'
+    if args.media_processes and args.command_args[:1] != ['mediaserver']:
+        MEDIA_PORT = args.media_port or PORT + 1
+    if args.media_processes and serving:
+        child_args = ['--folder', args.folder, '--port', str(PORT), '--gain', 'off', '--no_history',
+                '--stream_rate', str(args.stream_rate), '--stream_burst', str(args.stream_burst),
+                '--max_bandwidth', str(args.max_bandwidth / args.media_processes),
+                '--transcode_cmd', args.transcode_cmd, '--transcode_cache_mb', str(args.transcode_cache_mb)]
+        if args.no_transcode:
+            child_args.append('--no_transcode')
+        theMediaProcesses = MediaProcesses(args.media_processes, MEDIA_PORT, child_args)
+        atexit.register(theMediaProcesses.stop)
+
+    handoff = read_handoff()    # restarted by the memory watchdog
+
+    if serving:
         global thePlayer
-        thePlayer = InteractivePlayer(PLAYLIST_FOLDER)
-        thePlayer.start()
+        thePlayer = InteractivePlayer(PLAYLIST_FOLDER, scan_workers=args.scan_workers,
+                watch_library=not args.no_watch)
+        if args.max_rss_mb:
+            MemoryWatchdog(args.max_rss_mb, lambda rss: restart_with_handoff(thePlayer.get_handoff_state())).start()
+        if args.command_args:
+            thePlayer.serve(args.devicename, handoff=handoff)
+        else:
+            thePlayer.start(handoff=handoff)
 
     else:  # {
         # CLI commands
 
         command = args.command_args[0].lower()
 
+        # library commands (no device needed)
+        if command == 'scan':
+            def progress(scanned, found):
+                print("\rScanned %d/%d files" % (scanned, found), end='')
+            scanner = LibraryScanner(workers=args.scan_workers, progress_callback=progress)
+            start = time.time()
+            n = theLibrary.scan(PLAYLIST_FOLDER, scanner)
+            print("\nIndexed %d tracks (%d unreadable) under %s in %.2fs" % (
+                n, scanner.errors, PLAYLIST_FOLDER, time.time() - start))
+            exit()
+
+        if command == 'savem3u':
+            # savem3u file  -- save the playlist folder, shuffled as by playfolder, as playlist file
+            assert len(args.command_args) == 2, "Need to specify playlist filename"
+            filelist = list(find_tracks(PLAYLIST_FOLDER))
+            random.shuffle(filelist)
+            print("Saved %d tracks to %s" % (save_m3u(filelist, args.command_args[1]), args.command_args[1]))
+            exit()
+
+        if command == 'playm3u':
+            assert len(args.command_args) == 2, "Need to specify playlist filename"
+            assert os.path.isfile(args.command_args[1])
+
+        if command == 'mediaserver':
+            # mediaserver socket  -- media process, started by the control process (see "Media processes")
+            stop = threading.Event()
+            signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+            try:
+                run_media_server(args.command_args[1], args.media_port, stop)
+            except KeyboardInterrupt:
+                pass
+            exit()
+
+        if command == 'replay':
+            # replay recording  -- feed a status recording (see --record) through new_media_status
+            assert len(args.command_args) == 2, "Need to specify recording filename"
+            with tempfile.TemporaryDirectory() as folder:
+                playlist = make_synthetic_library(folder, 3, seconds=1, cover=False)  # (replayed repeatedly)
+                theTracks.set_roots(theTracks.roots + [folder])
+                report = replay_status_recording(args.command_args[1], playlist)
+            print_replay_report(report)
+            exit(1 if report['mismatches'] else 0)
+
+        if command == 'benchserver':
+            # benchserver [n_receivers [n_clients [seconds]]]
+            params = [int(a) for a in args.command_args[1:4]]
+            bench_server(*params)
+            exit()
+
+        if command == 'benchscan':
+            # benchscan     -- benchmark scan of the playlist folder
+            # benchscan N   -- benchmark scan of a synthetic library of N tracks
+            if len(args.command_args) == 2:
+                with tempfile.TemporaryDirectory() as folder:
+                    make_synthetic_library(folder, int(args.command_args[1]))
+                    bench_library_scan(folder)
+            else:
+                bench_library_scan(PLAYLIST_FOLDER)
+            exit()
+
+        if command == 'batch':
+            # parse the script before paying for discovery/connection
+            try:
+                batch_commands = parse_batch_script(read_batch_script(args.command_args[1:]))
+            except ValueError as error:
+                print(error)
+                exit(1)
+            if not batch_commands:
+                print("Empty batch script")
+                exit(1)
+
+        # the tracks played are served by the interactive/serve instance on this machine
+        theTracks = ServerTrackTable("http://127.0.0.1:%d" % PORT)
+
+        start = time.perf_counter()
+        if handoff:
+            args.devicename = handoff.get('device') or args.devicename
         cc_audios, cc_groups = CcAudioStreamer.get_devices()
 
         if command == 'list':
@@ -1374,6 +6091,22 @@ def main(args):  # {
             exit()
 
         cas = CcAudioStreamer(cc)
+        if args.record:
+            recorder = StatusRecorder(args.record, cc.name, cas.state)
+            cas.status_listeners.append(recorder)
+            atexit.register(recorder.close)
+
+        if command == 'batch':
+            print("%8.3fs  (discovery and connection to '%s')" % (time.perf_counter() - start, cc.name))
+            try:
+                timings, playlist_running = run_batch(cas, batch_commands, PLAYLIST_FOLDER)
+            except Exception:
+                logger.exception("Batch command failed")
+                exit(1)
+            print("%8.3fs  total" % (time.perf_counter() - start))
+            while playlist_running and cas.get_playlist():
+                time.sleep(20)  # keep the playlist going, as for the playfolder command
+            exit()
 
         # volume commands
         if command == 'volup':
@@ -1393,27 +6126,38 @@ def main(args):  # {
 
         # monitor status
         if command == 'status':
-            cas.monitor_status()
+            try:
+                cas.monitor_status(json_lines=args.json)
+            except KeyboardInterrupt:
+                pass
             exit()
 
 
         # playback controls
 
-        # play folder
-        if command == 'playfolder':
+        # play folder, or playlist file
+        if command in ('playfolder', 'playm3u'):
 #           posixPath_list = list(pathlib.Path(PLAYLIST_FOLDER).rglob("*.[mM][pP]3"))
 #           filelist = [str(pp) for pp in posixPath_list]
 #           random.shuffle(filelist)
 #           print("Playing playlist with %d files:" % len(filelist), filelist)
 #           cas.play_list(filelist)
-            cas.play_folder(PLAYLIST_FOLDER)
+            if handoff:
+                cas.restore_handoff_state(handoff)
+            elif command == 'playm3u':
+                cas.play_m3u(args.command_args[1])
+            else:
+                cas.play_folder(PLAYLIST_FOLDER)
+            if args.max_rss_mb:
+                MemoryWatchdog(args.max_rss_mb, lambda rss: restart_with_handoff(cas.get_handoff_state())).start()
 
             prev_len_playlist = 0
             cur_playlist = cas.get_playlist()
             while cur_playlist:
                 len_playlist = len(cur_playlist)
                 if len_playlist != prev_len_playlist:
-                    logger.info("Remaining files in playlist: %d" % len_playlist)
+                    logger.info("Remaining files in playlist: %d%s" % (len_playlist,
+                        " (%r)" % cur_playlist.scan if getattr(cur_playlist, 'scan', None) else ""))
                     prev_len_playlist = len_playlist
                 time.sleep(20)
                 cur_playlist = cas.get_playlist()
@@ -1449,7 +6193,7 @@ def main(args):  # {
 if __name__ == '__main__': #{
     parser = argparse.ArgumentParser(description='Stream Audio to Chromecast (Audio)')
 
-    parser.add_argument( "command_args", help="[list|status|playfile file|playfolder|pause|resume|stop|volup|voldown|setvol v]", nargs="*" )
+    parser.add_argument( "command_args", help="[list|status|playfile file|playfolder|playm3u file|savem3u file|replay file|pause|resume|stop|volup|voldown|setvol v|scan|benchscan [n]|serve|benchserver [r [c [s]]]|batch 'cmd; cmd; ..'|batch file|batch -]", nargs="*" )
 #   parser.add_argument( '-l', '--list_devices', action="store_true", dest='list_devices',
 #                   default=False, help='list CC audio and group devices' )
     parser.add_argument( '-d', '--devicename',
@@ -1457,6 +6201,49 @@ if __name__ == '__main__': #{
     DEFAULT_FOLDER = 'ZPL'
     parser.add_argument( '-f', '--folder',
                     help='specify folder path to play (default="%s")' % DEFAULT_FOLDER, default=DEFAULT_FOLDER )
+    parser.add_argument( '--root', action="append", default=[],
+                    help='additional library folder whose tracks may be served (e.g. from playlists), can be repeated' )
+    parser.add_argument( '--stream_rate', type=float, default=2.0,
+                    help='pace media streams to this multiple of the track bitrate, 0 for unpaced (default=2.0)' )
+    parser.add_argument( '--stream_burst', type=float, default=10,
+                    help='seconds of audio sent unpaced at the start of a media stream (default=10)' )
+    parser.add_argument( '--max_bandwidth', type=float, default=0,
+                    help='total Mbit/s for media streams, shared equally between them, 0 for unlimited (default=0)' )
+    parser.add_argument( '--gain', choices=GAIN_MODES, default='track',
+                    help='loudness levelling between tracks (default=track, album gain is used when playing an album)' )
+    parser.add_argument( '--analysis_cmd', default=DEFAULT_ANALYSIS_COMMAND,
+                    help='decoder command for loudness analysis, writing mono s16le %d Hz PCM to stdout (default="%s")' % (
+                        ANALYSIS_RATE, DEFAULT_ANALYSIS_COMMAND) )
+    parser.add_argument( '--analysis_workers', type=int, default=1,
+                    help='number of (low priority) processes for loudness analysis (default=1)' )
+    parser.add_argument( '--transcode_cmd', default=DEFAULT_TRANSCODE_COMMAND,
+                    help='encoder command for non-mp3 tracks, writing mp3 to stdout (default="%s")' % DEFAULT_TRANSCODE_COMMAND )
+    parser.add_argument( '--transcode_cache_mb', type=int, default=1024,
+                    help='size limit of the transcode cache (default=1024)' )
+    parser.add_argument( '--no_transcode', action="store_true",
+                    default=False, help='only play mp3 files' )
+    parser.add_argument( '--media_processes', type=int, default=0,
+                    help='serve media from this many separate processes, 0 to serve it from the control process (default=0)' )
+    parser.add_argument( '--media_port', type=int, default=0,
+                    help='port of the media processes (default=port+1)' )
+    parser.add_argument( '--scan_workers', type=int,
+                    help='number of processes for library scanning (default=number of cores)' )
+    parser.add_argument( '--no_watch', action="store_true",
+                    default=False, help='disable live updates of the library when files are added/removed' )
+    parser.add_argument( '--fake_devices', type=int, default=0,
+                    help='use N local fake devices instead of discovering Chromecasts (for testing)' )
+    parser.add_argument( '--fake_speed', type=float, default=1.0,
+                    help='playback speed multiplier for fake devices (default=1.0)' )
+    parser.add_argument( '--port', type=int, default=PORT,
+                    help='http server port (default=%d)' % PORT )
+    parser.add_argument( '--record',
+                    help='record the device\'s media statuses to this file (.gz for gzipped), for the replay command' )
+    parser.add_argument( '--json', action="store_true",
+                    default=False, help='status command prints JSON lines (one object per event)' )
+    parser.add_argument( '--max_rss_mb', type=int, default=0,
+                    help='restart (resuming the session) before memory use reaches this many MB, 0 for no limit (default=0)' )
+    parser.add_argument( '--no_history', action="store_true",
+                    default=False, help='disable recording of play-history and analyzed gains (s2c_history.db)' )
 #   parser.add_argument( '-p', '--perception_only', action="store_false", dest='pnnf_input_files',
 #                   default=True, help='skip generation of #pnnf_input.dat files' )
 
@@ -1568,6 +6355,1351 @@ def test4():
         cas.play_list(["StayHigh.mp3", "ShortAndSweet.mp3", "Baby.mp3"])
         time.sleep(600)
 
+def test5(tmp_path):
+    """
+        Play history store and statistics (no device needed)
+    """
+    history = PlayHistory(str(tmp_path / "history.db"))
+    t0 = 1000.0
+    for i, (artist, title, ended) in enumerate([
+            ("A", "a1", True), ("A", "a2", False), ("B", "b1", True),
+            ("A", "a1", True), ("C", "c1", False)]):
+        history.record('start', "%s.mp3" % title, artist, title, ts=t0 + 10*i)
+        history.record('end' if ended else 'skip', "%s.mp3" % title, artist, title, ts=t0 + 10*i + 5)
+    history.record('start', "old.mp3", "Z", "z1", ts=1.0)   # outside range
+    assert history.flush() == 11
+
+    stats = history.get_stats(since=t0, until=t0 + 100)
+    assert stats['plays'] == 5
+    assert stats['ends'] == 3
+    assert stats['skips'] == 2
+    assert stats['skip_rate'] == 2 / 5
+    assert stats['top_artists'][0] == ("A", 3)
+    assert stats['top_tracks'][0] == ("A", "a1", 2)
+    assert ("A", "a2", 1, 1) in stats['most_skipped']
+    history.close()
+
+def test6(tmp_path):
+    """
+        Parallel library scan: ordering, index filtering, cancellation (no device needed)
+    """
+    make_synthetic_library(str(tmp_path), 40, seconds=1, n_artists=4)
+    (tmp_path / "bad.mp3").write_bytes(b"not an mp3")
+    walk_order = [p for p in find_tracks(str(tmp_path)) if not p.endswith("bad.mp3")]
+
+    progress = []
+    scanner = LibraryScanner(workers=2, chunk_size=3, progress_callback=lambda s, f: progress.append(s))
+    infos = list(scanner.scan(str(tmp_path)))
+    assert [info.path for info in infos] == walk_order
+    assert scanner.errors == 1
+    assert progress[-1] == 41
+    assert all(info.has_cover and info.duration > 0.5 for info in infos)
+
+    index = LibraryIndex()
+    for info in infos:
+        index.add(info)
+    assert len(index.filter(artist="artist 01")) == 10
+    expected = sorted(info.path for info in infos if info.artist == "Artist 01" and info.album == "Album 01")
+    assert expected and index.filter(artist="Artist 01", album="album 01") == expected
+    assert index.filter(artist="nobody") == []
+
+    scanner = LibraryScanner(workers=2, chunk_size=2)
+    n = 0
+    for info in scanner.scan(str(tmp_path)):
+        n += 1
+        scanner.cancel()
+    assert n < 40
+
+def test7(tmp_path):
+    """
+        Live library updates via inotify and mtime sweeps, playlist update (no device needed)
+    """
+    def wait_for(condition, timeout=5):
+        end = time.time() + timeout
+        while not condition() and time.time() < end:
+            time.sleep(0.05)
+        return condition()
+
+    for use_inotify in (True, False):
+        folder = tmp_path / ("inotify" if use_inotify else "sweep")
+        make_synthetic_library(str(folder / "old"), 4, seconds=0.1)
+        library = LibraryIndex()
+        library.scan(str(folder), LibraryScanner(workers=1))
+        changes = []
+        watcher = LibraryWatcher(str(folder), library, on_change=lambda a, r: changes.append((a, r)),
+                debounce=0.2, sweep_interval=0.2, use_inotify=use_inotify).start()
+        try:
+            make_synthetic_library(str(folder / "new"), 3, seconds=0.1)
+            os.rename(str(folder / "old"), str(tmp_path / ("moved_out_%d" % use_inotify)))
+            assert wait_for(lambda: sum(len(a) + len(r) for a, r in changes) == 7)
+            assert len(library) == 3
+            assert all(p.startswith(str(folder / "new")) for p in library.paths())
+            added = sum(len(a) for a, r in changes)
+            removed = sum(len(r) for a, r in changes)
+            assert (added, removed) == (3, 4)
+            if use_inotify:
+                # no watches left on the moved out folder
+                assert not any("old" in f for f in watcher.wds.values())
+                make_synthetic_library(str(tmp_path / "moved_out_1" / "more"), 1, seconds=0.1)
+                time.sleep(0.5)
+                assert len(library) == 3
+        finally:
+            watcher.stop()
+
+    class FakeStreamer():
+        playlist_source = "lib"
+        playlist_lock = threading.RLock()
+        track_history = collections.deque()
+        _update_playlist = CcAudioStreamer._update_playlist
+    fake = FakeStreamer()
+    fake.playlist = ["lib/%d.mp3" % i for i in range(10)]
+    fake.master_playlist = fake.playlist
+    fake.playlist_index = 5
+    CcAudioStreamer.update_playlist(fake, added=["lib/new.mp3", "elsewhere/x.mp3"],
+            removed=["lib/1.mp3", "lib/5.mp3", "lib/8.mp3"])
+    assert fake.playlist[:4] == ["lib/0.mp3", "lib/2.mp3", "lib/3.mp3", "lib/4.mp3"]
+    assert fake.playlist_index == 3  # next track is the one after removed lib/5.mp3
+    assert sorted(fake.playlist[4:]) == ["lib/6.mp3", "lib/7.mp3", "lib/9.mp3", "lib/new.mp3"]
+    fake.playlist_index = 0     # current track is the first
+    CcAudioStreamer.update_playlist(fake, added=[], removed=["lib/0.mp3"])
+    assert fake.playlist_index == len(fake.playlist) - 1 == 6
+    assert "lib/0.mp3" not in fake.playlist
+
+def test8():
+    """
+        Versioned status with not-modified and delta responses (no device needed)
+    """
+    player = InteractivePlayer.__new__(InteractivePlayer)   # skip device discovery
+    player.lock = threading.RLock()
+    player.cas = None
+    player.connected = False
+    player.status_epoch = "e"
+    player.status_version = 0
+    player.status_history = collections.deque(maxlen=32)
+
+    version, statuses, delta = player.get_status_since("")
+    assert delta is None and len(statuses) == 10
+    assert player.get_status_since(version) == (version, statuses, {})
+
+    player.connected = True
+    version2, statuses2, delta = player.get_status_since(version)
+    assert version2 != version
+    assert delta == {0: "1"}
+    assert player.get_status_since("stale.1")[2] is None
+
+def _start_test_server(monkeypatch, server_directory, web_folder):
+    """
+        starts http server on an ephemeral port, with module globals patched to match
+    """
+    module = sys.modules[__name__]
+    monkeypatch.setattr(module, 'SERVER_DIRECTORY', server_directory)
+    monkeypatch.setattr(module, 'WEB_PAGE_REL_PATH', os.path.relpath(web_folder, server_directory))
+    monkeypatch.setattr(module, 'theStaticAssets', StaticAssetCache(web_folder))
+    server = MyThreadingTCPServer(("127.0.0.1", 0), MyHTTPRequestHandler)
+    monkeypatch.setattr(module, 'IP_ADDRESS', "127.0.0.1")
+    monkeypatch.setattr(module, 'PORT', server.server_address[1])
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def test9(monkeypatch):
+    """
+        Static web-page assets: cache headers, ETag revalidation, gzip (no device needed)
+    """
+    import http.client
+    web_folder = os.path.dirname(os.path.realpath(__file__))
+    server = _start_test_server(monkeypatch, web_folder, web_folder)
+
+    def get(path, headers={}):
+        conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1])
+        conn.request("GET", path, headers=headers)
+        response = conn.getresponse()
+        body = response.read()
+        conn.close()
+        return response, body
+
+    try:
+        response, body = get("/", {'Accept-Encoding': 'gzip'})
+        assert response.status == 200
+        assert response.getheader("Content-Encoding") == "gzip"
+        assert response.getheader("Cache-Control") == StaticAssetCache.HTML_POLICY
+        html = gzip.decompress(body).decode()
+        js_ref = re.search(r'src="(web_page\.js\?v=[0-9a-f]+)"', html).group(1)
+        assert 'src="ip_address.js"' in html    # dynamic, not versioned
+
+        response, body = get("/" + js_ref)
+        assert response.status == 200 and response.getheader("Content-Encoding") is None
+        assert response.getheader("Cache-Control") == StaticAssetCache.VERSIONED_POLICY
+        with open(os.path.join(web_folder, "web_page.js"), "rb") as f:
+            assert body == f.read()
+
+        response, body = get("/imgs/noise.jpg", {'If-None-Match': response.getheader("ETag")})
+        assert response.status == 200   # different asset, different etag
+        response, body = get("/imgs/noise.jpg", {'If-None-Match': response.getheader("ETag")})
+        assert response.status == 304 and body == b""
+        assert response.getheader("Cache-Control") == StaticAssetCache.ASSET_POLICY
+
+        response, body = get("/cover.jpg")
+        assert "no-store" in response.getheader("Cache-Control")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test10(tmp_path, monkeypatch):
+    """
+        End-to-end playlist playback on a FakeChromecast (no device needed)
+    """
+    paths = make_synthetic_library(str(tmp_path / "lib"), 3, seconds=2)
+    web_folder = tmp_path / "web"
+    web_folder.mkdir()
+    server = _start_test_server(monkeypatch, "/", str(web_folder))
+    try:
+        fake = FakeChromecast(speed=20)     # 2s tracks play in 0.1s
+        states = []
+        cas = CcAudioStreamer(fake, new_media_status_callback=lambda: states.append(cas.state))
+        cas.set_vol(0.3)
+        assert cas.get_vol() == 0.3
+
+        cas.play_list(list(paths))
+        end = time.time() + 10
+        while len(fake.loads) < 4 and time.time() < end:
+            time.sleep(0.05)
+        # played all 3 tracks in order, then reshuffled and started again
+        assert [url.split(":%d" % PORT)[1] for url in fake.loads[:3]] == ["/t/" + track_id(p) for p in paths]
+        assert fake.bytes_fetched >= sum(os.path.getsize(p) for p in paths)
+        assert (web_folder / "cover.jpg").exists()
+        assert 'PLAYING' in states and 'BUFFERING' in states
+
+        summary = cas.transitions.summary()
+        assert summary['count'] >= 2
+        assert set(summary['phases']) == set(TransitionStats.PHASES)
+        assert summary['dominant'] in TransitionStats.PHASES
+        assert cas.transitions.format_summary()[0].startswith("Track transitions")
+
+        cas.pause()
+        assert cas.get_paused()
+        artist, title, album, current_time, duration = cas.get_track_info()
+        assert artist.startswith("Artist") and duration == "00:02"
+        cas.resume()
+        assert cas.state == 'PLAYING'
+        cas.stop()
+        assert cas.state == 'IDLE'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test11(tmp_path, monkeypatch):
+    """
+        Metrics recording and /metrics endpoint (no device needed)
+    """
+    import http.client
+    metrics = Metrics()
+    metrics.describe('x_seconds', 'histogram', "test histogram")
+    metrics.inc('x_total', (('a', '1'),))
+    metrics.inc('x_total', (('a', '1'),), 2)
+    metrics.observe('x_seconds', (), 0.003)
+    metrics.observe('x_seconds', (), 100)
+    text = metrics.render()
+    assert 'x_total{a="1"} 3' in text
+    assert '# TYPE x_seconds histogram' in text
+    assert 'x_seconds_bucket{le="0.0025"} 0' in text
+    assert 'x_seconds_bucket{le="0.005"} 1' in text
+    assert 'x_seconds_bucket{le="+Inf"} 2' in text
+    assert 'x_seconds_count 2' in text
+
+    lock = TimedRLock('test')
+    with lock:
+        with lock:  # re-entrant
+            pass
+
+    web_folder = os.path.dirname(os.path.realpath(__file__))
+    server = _start_test_server(monkeypatch, web_folder, web_folder)
+    try:
+        for path in ("/web_page.js", "/metrics"):
+            conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1])
+            conn.request("GET", path)
+            response = conn.getresponse()
+            body = response.read().decode()
+            conn.close()
+        assert response.status == 200
+        assert 's2c_http_requests_total{method="GET",path="static"}' in body
+        served = re.search(r's2c_http_bytes_served_total{method="GET",path="static"} (\d+)', body)
+        assert int(served.group(1)) > os.path.getsize(os.path.join(web_folder, "web_page.js"))  # + headers
+        assert 's2c_http_active_connections 1' in body
+        assert 's2c_lock_wait_seconds_count{lock="test"} 2' in body
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test12():
+    """
+        Rate limiting of repeated warnings (no device needed)
+    """
+    records = []
+    test_logger = logging.getLogger(__name__ + ".test12")
+    test_logger.propagate = False
+    handler = logging.Handler()
+    handler.emit = records.append
+    handler.addFilter(RepeatedMessageFilter(burst=3, period=0.2))
+    test_logger.addHandler(handler)
+
+    for i in range(20):
+        test_logger.warning("Handled exception from: self.mc.update_status()!: %d" % i)
+        test_logger.info("info %d" % i)    # never limited
+    assert len([r for r in records if r.levelno == logging.WARNING]) == 3
+    assert len([r for r in records if r.levelno == logging.INFO]) == 20
+
+    time.sleep(0.25)
+    test_logger.warning("Handled exception from: self.mc.update_status()!: 99")
+    assert records[-1].getMessage().endswith("[17 similar messages suppressed]")
+
+def test13(tmp_path, monkeypatch):
+    """
+        Background reconnect with backoff, session restore (no device needed)
+    """
+    paths = make_synthetic_library(str(tmp_path / "lib"), 2, seconds=30)
+    web_folder = tmp_path / "web"
+    web_folder.mkdir()
+    server = _start_test_server(monkeypatch, "/", str(web_folder))
+    try:
+        fake = FakeChromecast(speed=10)
+        session_lock = threading.RLock()    # (as the InteractivePlayer's lock)
+        cas = CcAudioStreamer(fake, find_device=lambda name: None if fake.offline else fake,
+                session_lock=session_lock, supervisor_args={'backoff_base': 0.01, 'backoff_max': 0.05})
+        assert all(cas.supervisor.backoff(n) <= 0.05 for n in range(10))
+        cas.play_list(list(paths))
+        end = time.time() + 5
+        while (cas.last_position is None or cas.last_position[0] < 2) and time.time() < end:
+            cas.get_track_info()
+            time.sleep(0.05)
+        playing_url = fake.loads[-1]
+
+        fake.offline = True
+        assert cas.get_track_info() == ("", "", "", "", "")
+        assert not cas.is_connected()
+        calls = fake.update_status_calls
+        for i in range(10):
+            cas.get_track_info()    # no polling while disconnected
+        assert fake.update_status_calls == calls
+        time.sleep(0.2)             # reconnect attempts fail while offline
+        assert not cas.is_connected() and cas.supervisor.attempts >= 2
+
+        with session_lock:
+            fake.offline = False
+            end = time.time() + 5
+            while not cas.is_connected() and time.time() < end:
+                time.sleep(0.01)
+            assert cas.is_connected()
+            time.sleep(0.1)
+            assert len(fake.loads) == 1     # not restored while the lock's held
+        while len(fake.loads) < 2 and time.time() < end:
+            time.sleep(0.01)
+        assert fake.loads[-1] == playing_url                # same track..
+        assert fake.media_controller.position >= 2          # ..resumed from where it was
+        cas.disconnect()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test14(monkeypatch):
+    """
+        Concurrent fan-out of commands to several devices (no device needed)
+    """
+    import pytest
+    monkeypatch.setattr(sys.modules[__name__], 'FAKE_DEVICES', 6)
+    player = InteractivePlayer("nonexistent_folder")
+    latency = 0.2
+    for cc in player.cc_audios:
+        cc.latency = latency
+    keys = [k for k, cc in player.cc_key_mapping.items()]
+    assert len(keys) == 6
+
+    start = time.perf_counter()
+    results = player.fanout(keys, 'set_volume', '0.3')
+    elapsed = time.perf_counter() - start
+    assert all(r['ok'] for r in results.values())
+    assert all(cc.status.volume_level == 0.3 for cc in player.cc_audios)
+    assert elapsed < 4 * latency    # connect + set_volume ~ 2 * latency, not 12 * latency
+
+    player.cc_audios[0].latency = 5     # one slow device
+    results = player.fanout(keys + ["x"], 'volume_up', timeout=1)
+    assert results[keys[0]]['error'] == "timeout"
+    assert results["x"]['error'] == "unknown device"
+    assert sum(1 for r in results.values() if r['ok']) == 5
+    assert abs(results[keys[1]]['result'] - 0.35) < 1e-6
+
+    with pytest.raises(ValueError):
+        player.fanout(keys, 'reboot')
+    with pytest.raises(ValueError, match="JSON list"):
+        player.fanout(keys[:2], 'play_list', "/music/a.mp3")   # (a string, as from http POST)
+    results = player.fanout(keys[:2], 'play_list', '["/nonexistent/a b.mp3"]')
+    assert all("Invalid file: /nonexistent/a b.mp3" in r['error'] for r in results.values())
+
+    # the selected device is commanded through its own session, under the player's lock
+    # (also from run_commands(), which holds it), other devices through fanout sessions
+    for cc in player.cc_audios:
+        cc.latency = 0
+    player.set_device(keys[2])
+    calls = []
+    player.cas.set_vol = lambda vol: calls.append(vol)
+    results = player.run_commands([{'cmd': 'fanout', 'args': [keys[1:4], 'set_volume', '0.6']}])[0]
+    assert results[0]['ok'] and all(r['ok'] for r in results[0]['result'].values())
+    assert calls == [0.6]
+    assert not any(cas.write_cover for cas in player.fanout_sessions.values())
+
+    # concurrent fanouts to a new device share one session
+    player.cc_audios[5].latency = 0.2
+    new_key = [k for k, cc in player.cc_key_mapping.items() if cc is player.cc_audios[5]][0]
+    player.fanout_sessions.pop(player.cc_audios[5].name, None)
+    sessions = list(player.fanout_pool.map(lambda _: player._get_fanout_session(new_key), range(3)))
+    assert sessions[0] is sessions[1] is sessions[2] is player.fanout_sessions[player.cc_audios[5].name]
+
+def test15(tmp_path, monkeypatch):
+    """
+        Batch mode: several commands over one session (no device needed)
+    """
+    import pytest
+    paths = make_synthetic_library(str(tmp_path / "lib"), 2, seconds=2)
+    web_folder = tmp_path / "web"
+    web_folder.mkdir()
+    server = _start_test_server(monkeypatch, "/", str(web_folder))
+    try:
+        with pytest.raises(ValueError, match="reboot"):
+            parse_batch_script("setvol 0.1; reboot")
+        with pytest.raises(ValueError):
+            parse_batch_script("setvol")
+
+        commands = parse_batch_script("""
+            # morning alarm
+            setvol 0.1; playfolder
+            sleep 0.1; volup 0.05
+            status ; pause
+            """)
+        assert commands == [['setvol', '0.1'], ['playfolder'], ['sleep', '0.1'], ['volup', '0.05'],
+                ['status'], ['pause']]
+
+        fake = FakeChromecast()
+        cas = CcAudioStreamer(fake)
+        lines = []
+        timings, playlist_running = run_batch(cas, commands, str(tmp_path / "lib"), out=lines.append)
+        assert [t[0] for t in timings] == [" ".join(c) for c in commands]
+        assert len(lines) == len(commands)
+        assert playlist_running and len(fake.loads) == 1
+        assert abs(fake.status.volume_level - 0.15) < 1e-6
+        assert timings[2][1] >= 0.1
+        assert timings[4][2].startswith("PLAYING vol=0.15 Artist")
+        assert cas.get_paused()
+
+        timings, playlist_running = run_batch(cas, parse_batch_script("playfile '%s'; stop" % paths[0]),
+                str(tmp_path / "lib"), out=lines.append)
+        assert not playlist_running and cas.state == 'IDLE'
+
+        with pytest.raises(ValueError):
+            run_batch(cas, parse_batch_script("playfile nonexistent.mp3"), "", out=lines.append)
+        assert "FAILED" in lines[-1]
+    finally:
+        server.shutdown()
+
+def test16(tmp_path, monkeypatch):
+    """
+        Event-driven status monitor, text and JSON-lines output (no device needed)
+    """
+    paths = make_synthetic_library(str(tmp_path / "lib"), 2, seconds=2)
+    web_folder = tmp_path / "web"
+    web_folder.mkdir()
+    server = _start_test_server(monkeypatch, "/", str(web_folder))
+    try:
+        fake = FakeChromecast(speed=10)     # 2s tracks play in 0.2s
+        cas = CcAudioStreamer(fake)
+        outputs = {}
+        stop = threading.Event()
+        monitors = []
+        for json_lines in (True, False):
+            outputs[json_lines] = io.StringIO()
+            monitor = threading.Thread(target=cas.monitor_status, daemon=True,
+                    kwargs=dict(json_lines=json_lines, out=outputs[json_lines], stop=stop, refresh=0.02))
+            monitor.start()
+            monitors.append(monitor)
+        time.sleep(0.1)
+        calls = fake.update_status_calls
+
+        cas.play_list(list(paths))
+        end = time.time() + 10
+        while len(fake.loads) < 3 and time.time() < end:
+            time.sleep(0.02)
+        cas.stop()
+        time.sleep(0.1)
+        stop.set()
+        for monitor in monitors:
+            monitor.join(1)
+        assert not cas.status_listeners
+        assert fake.update_status_calls == calls    # no polling
+
+        events = [json.loads(line) for line in outputs[True].getvalue().splitlines()]
+        states = [e['state'] for e in events if e['event'] == 'state']
+        assert all(a != b for a, b in zip(states, states[1:]))     # each change once
+        assert states[-1] == 'IDLE' and events[-1]['idle_reason'] == 'CANCELLED'
+        playing = [e for e in events if e['state'] == 'PLAYING']
+        assert [e['album'] for e in playing[:2]] == [read_track_info(p).album for p in paths]
+        assert all(e['time'] <= f['time'] for e, f in zip(events, events[1:]))
+
+        text = outputs[False].getvalue()
+        assert text.count("State change -> PLAYING") >= 2
+        assert "/00:02 \r" in text      # interpolated position line
+    finally:
+        server.shutdown()
+
+def test17(tmp_path, monkeypatch):
+    """
+        JSON control API: several commands per request, with the resulting status (no device needed)
+    """
+    import http.client
+    module = sys.modules[__name__]
+    monkeypatch.setattr(module, 'FAKE_DEVICES', 2)
+    monkeypatch.setattr(module, 'thePlayer', InteractivePlayer(str(tmp_path)))
+    server = _start_test_server(monkeypatch, str(tmp_path), str(tmp_path))
+
+    def post(path, body):
+        conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1])
+        conn.request("POST", path, body=body)
+        response = conn.getresponse()
+        body = response.read()
+        conn.close()
+        return response.status, body
+
+    try:
+        status, body = post(API_PATH, json.dumps({'commands': [
+            {'cmd': 'select_device', 'args': ['1']},
+            {'cmd': 'set_volume', 'args': [0.2]},
+            {'cmd': 'volume_up'},
+            {'cmd': 'scan_devices'},
+            ]}))
+        assert status == 200
+        response = json.loads(body)
+        assert response['api'] == API_VERSION
+        assert [r['ok'] for r in response['results']] == [True] * 4
+        assert response['results'][3]['result'] == {'1': "Fake Audio 1", '2': "Fake Audio 2"}
+        connected, device, volume = response['status'][:3]
+        assert connected == "1" and device == "Fake Audio 1" and volume.endswith("023")    # (smaller steps at low volume)
+        assert thePlayer.get_status_since(response['version'])[2] == {}
+
+        # first failure skips the rest
+        status, body = post(API_PATH, json.dumps({'commands': [
+            {'cmd': 'volume_down'}, {'cmd': 'reboot'}, {'cmd': 'volume_down'}]}))
+        results = json.loads(body)['results']
+        assert [r.get('error') for r in results] == [None, "unknown command", "skipped"]
+        assert json.loads(body)['status'][2].endswith("020")
+
+        status, body = post(API_PATH, "volume_up")
+        assert status == 400 and "error" in json.loads(body)
+        status, body = post("/", "volume_up")      # original command protocol still works
+        assert status == 200
+    finally:
+        server.shutdown()
+        thePlayer.fanout_pool.shutdown()
+
+def test18(tmp_path, monkeypatch):
+    """
+        Media served by track ID: range requests, open-file LRU, library roots (no device needed)
+    """
+    import http.client
+    import pytest
+    paths = make_synthetic_library(str(tmp_path / "lib"), 3, seconds=2)
+    other = tmp_path / "other.mp3"
+    other.write_bytes(open(paths[0], "rb").read())
+    module = sys.modules[__name__]
+    monkeypatch.setattr(module, 'theTracks', TrackTable([str(tmp_path / "lib")]))
+    monkeypatch.setattr(module, 'theOpenFiles', OpenFileCache(max_open=2))
+    server = _start_test_server(monkeypatch, str(tmp_path), str(tmp_path))
+
+    def get(path, headers={}, method="GET"):
+        conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1])
+        conn.request(method, path, headers=headers)
+        response = conn.getresponse()
+        body = response.read()
+        conn.close()
+        return response, body
+
+    try:
+        with pytest.raises(ValueError):
+            theTracks.register(str(other))
+        ids = [theTracks.register(p) for p in paths]
+        assert ids[0] == track_id(paths[0]) and len(theTracks) == 3
+        data = open(paths[0], "rb").read()
+
+        response, body = get("/t/" + ids[0])
+        assert response.status == 200 and body == data
+        assert response.getheader("Content-Type") == "audio/mpeg"
+        assert response.getheader("Accept-Ranges") == "bytes"
+        response, body = get("/t/" + ids[0], {'Range': "bytes=100-199"})
+        assert response.status == 206 and body == data[100:200]
+        assert response.getheader("Content-Range") == "bytes 100-199/%d" % len(data)
+        response, body = get("/t/" + ids[0], {'Range': "bytes=-50"})
+        assert body == data[-50:]
+        response, body = get("/t/" + ids[0], {'Range': "bytes=%d-" % len(data)})
+        assert response.status == 416
+        response, body = get("/t/" + ids[0], method="HEAD")
+        assert response.status == 200 and body == b"" and response.getheader("Content-Length") == str(len(data))
+        assert theOpenFiles.opens == 1 and theOpenFiles.hits == 4  # file opened once
+
+        # retagged/replaced: reopened, with the new size
+        with open(paths[0], "ab") as f:
+            f.write(b"\0" * 128)
+        response, body = get("/t/" + ids[0])
+        assert body == data + b"\0" * 128 and response.getheader("Content-Length") == str(len(data) + 128)
+        os.replace(str(other), paths[0])
+        assert get("/t/" + ids[0])[1] == data and theOpenFiles.opens == 3
+
+        for tid in ids:
+            get("/t/" + tid, {'Range': "bytes=0-9"})
+        assert len(theOpenFiles.files) == 2     # LRU limit
+        assert get("/t/0123456789abcdef")[0].status == 404
+        assert get("/t/" + track_id(str(other)))[0].status == 404
+        assert get("/lib/")[0].status == 404    # no directory listings
+    finally:
+        server.shutdown()
+        theOpenFiles.close()
+
+def test19(tmp_path, monkeypatch):
+    """
+        Transcoding of non-mp3 tracks: streamed while encoding, then served from the LRU cache
+        (stand-in encoder, no device needed)
+    """
+    import pytest
+    import http.client
+    import types
+    module = sys.modules[__name__]
+    # stand-in encoder: copies the input to stdout in small, slow chunks
+    encoder = tmp_path / "encoder.py"
+    encoder.write_text("import sys, time\n"
+            "data = open(sys.argv[1], 'rb').read()\n"
+            "if sys.argv[2] == 'fail': sys.exit(3)\n"
+            "for i in range(0, len(data), 1024):\n"
+            "    sys.stdout.buffer.write(data[i:i + 1024]); sys.stdout.buffer.flush(); time.sleep(0.005)\n")
+    # part files left from a previous run are removed, those of live (media) processes are kept
+    cache = tmp_path / "cache"
+    cache.mkdir()
+    dead = subprocess.Popen([sys.executable, "-c", ""])
+    dead.wait()
+    for pid in (dead.pid, os.getpid(), os.getppid()):
+        (cache / ("0123.mp3.%d.part" % pid)).write_bytes(b"x")
+    transcoder = Transcoder(str(cache), "%s %s {input} ok" % (sys.executable, encoder),
+            max_cache_bytes=12000)
+    assert os.listdir(str(cache)) == ["0123.mp3.%d.part" % os.getppid()]
+    monkeypatch.setattr(module, 'theTranscoder', transcoder)
+    monkeypatch.setattr(module, 'theTracks', TrackTable())
+    lib = tmp_path / "lib"
+    flacs = [make_synthetic_flac(str(lib / ("%d.flac" % i)), 2, "Artist", "Title %d" % i, "Album")
+            for i in range(2)]
+    make_synthetic_library(str(lib), 1)
+    server = _start_test_server(monkeypatch, str(tmp_path), str(tmp_path))
+
+    def get(path, headers={}):
+        conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1])
+        conn.request("GET", path, headers=headers)
+        response = conn.getresponse()
+        first = response.read(1)
+        transcoding = bool(transcoder.jobs)
+        body = first + response.read()
+        conn.close()
+        return response, body, transcoding
+
+    try:
+        assert sorted(p for p in find_tracks(str(lib)) if not p.endswith(".mp3")) == flacs
+        assert is_track_file(flacs[0])
+        info = read_track_info(flacs[0])
+        assert (info.artist, info.title, info.album, info.duration, info.has_cover) == (
+                "Artist", "Title 0", "Album", 2.0, True)
+
+        data = open(flacs[0], "rb").read()
+        tid = theTracks.register(flacs[0])
+        # HEAD: headers only, without starting the encoder
+        with socket.create_connection(("127.0.0.1", server.server_address[1])) as sock:
+            sock.sendall(b"HEAD /t/%s HTTP/1.1\r\nHost: test\r\n\r\n" % tid.encode())
+            reply = b""
+            while True:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                reply += chunk
+        headers, _, rest = reply.partition(b"\r\n\r\n")
+        assert headers.startswith(b"HTTP/1.1 200") and b"Transfer-Encoding: chunked" in headers
+        assert rest == b"" and transcoder.runs == 0
+
+        response, body, transcoding = get("/t/" + tid)
+        assert response.getheader("Transfer-Encoding") == "chunked"
+        assert transcoding      # first bytes arrived while the encoder was still running
+        assert body == data and transcoder.runs == 1
+
+        end = time.time() + 5
+        while transcoder.jobs and time.time() < end:
+            time.sleep(0.01)
+        response, body, transcoding = get("/t/" + tid, {'Range': "bytes=10-19"})
+        assert response.status == 206 and body == data[10:20]
+        assert transcoder.runs == 1     # replay from the cache
+
+        # second track evicts the first from the (12000 byte) cache
+        cached = transcoder.cache_path(flacs[0])
+        get("/t/" + theTracks.register(flacs[1]))
+        end = time.time() + 5
+        while transcoder.jobs and time.time() < end:
+            time.sleep(0.01)
+        assert not os.path.exists(cached) and os.path.exists(transcoder.cache_path(flacs[1]))
+
+        # encoder failure: stream ends without the final chunk, nothing cached
+        transcoder.command[-1] = "fail"
+        os.utime(flacs[0], (1, 1))      # changes the cache key
+        with pytest.raises(http.client.IncompleteRead):
+            get("/t/" + tid)
+        assert not os.path.exists(transcoder.cache_path(flacs[0]))
+
+        # played on a device as mp3
+        fake = FakeChromecast(speed=20)
+        cas = CcAudioStreamer(fake)
+        transcoder.command[-1] = "ok"
+        cas.play(flacs[1])
+        assert fake.media_controller.status.content_type == 'audio/mpeg'
+        assert fake.media_controller.status.title == "Title 1"
+        assert (tmp_path / "cover.jpg").exists()
+        cas.stop()
+
+        # cache files evicted first by another process sharing the cache: the job is still done
+        job = types.SimpleNamespace(error=None, part_path=str(cache / "evict.mp3.1.part"),
+                cache_path=str(cache / "evict.mp3"))
+        with open(job.part_path, "wb") as f:
+            f.write(b"mp3")
+        transcoder.jobs[job.cache_path] = job
+        def evicted_first(path):
+            os.unlink(path)
+            raise FileNotFoundError(path)
+        transcoder.max_cache_bytes = 0
+        with monkeypatch.context() as m:
+            m.setattr(os, 'remove', evicted_first)
+            transcoder._job_done(job)
+        assert not transcoder.jobs and not [n for n in os.listdir(str(cache)) if n.endswith(".mp3")]
+    finally:
+        server.shutdown()
+
+def test20(tmp_path, monkeypatch):
+    """
+        Loudness: ReplayGain tags, background analysis, gain applied on play (stand-in decoder, no device needed)
+    """
+    module = sys.modules[__name__]
+    library = LibraryIndex()
+    monkeypatch.setattr(module, 'theLibrary', library)
+    paths = make_synthetic_library(str(tmp_path / "lib"), 3, n_artists=1)
+    tags = mutagen.id3.ID3(paths[0])
+    tags.add(mutagen.id3.TXXX(encoding=3, desc="replaygain_track_gain", text="-6.00 dB"))
+    tags.save(paths[0])
+    # stand-in decoder: square wave, amplitude 4000 for Track 0001, 16000 for Track 0002
+    decoder = tmp_path / "decoder.py"
+    decoder.write_text("import sys, array\n"
+            "amp = 4000 if sys.argv[1].endswith('0001.mp3') else 16000\n"
+            "sys.stdout.buffer.write(array.array('h', [amp, -amp] * 11025).tobytes())\n")
+    def expected_gain(amp):
+        return round(LOUDNESS_REFERENCE_DB - 20 * math.log10(amp / 32768), 2)
+
+    assert parse_gain(" +1.5 dB") == 1.5 and parse_gain("") is None
+    library.scan(str(tmp_path / "lib"), LibraryScanner(workers=1))
+    assert library.get(paths[0]).track_gain == -6.0 and library.get(paths[1]).track_gain is None
+
+    history = PlayHistory(str(tmp_path / "history.db"))
+    analyzer = LoudnessAnalyzer(library, "%s %s {input}" % (sys.executable, decoder), chunk_size=1,
+            store=history)
+    try:
+        assert analyzer.analyze(library.paths()) == 2     # tagged track not analyzed
+        assert analyzer.idle.wait(30)
+        assert analyzer.analyzed == 2
+    finally:
+        analyzer.stop()
+    assert library.get_gain(paths[1]) == expected_gain(4000)
+    assert library.get_gain(paths[2]) == expected_gain(16000)
+
+    # next start: gains come from the store, only the changed track is analyzed again
+    os.utime(paths[2], (time.time(), time.time() + 10))
+    library.scan(str(tmp_path / "lib"), LibraryScanner(workers=1))
+    analyzer = LoudnessAnalyzer(library, "%s %s {input}" % (sys.executable, decoder), chunk_size=1,
+            store=history)
+    try:
+        assert analyzer.analyze(library.paths()) == 1
+        assert library.get_gain(paths[1]) == expected_gain(4000)
+        assert analyzer.idle.wait(30)
+    finally:
+        analyzer.stop()
+        history.close()
+    assert library.get_gain(paths[2]) == expected_gain(16000)
+    # album gain: power average of the tracks' loudness
+    gains = [-6.0, expected_gain(4000), expected_gain(16000)]
+    album_gain = library.get_gain(paths[0], album=True)
+    assert min(gains) < album_gain < max(gains)
+
+    web_folder = tmp_path / "web"
+    web_folder.mkdir()
+    server = _start_test_server(monkeypatch, "/", str(web_folder))
+    try:
+        fake = FakeChromecast(speed=20)
+        cas = CcAudioStreamer(fake)
+        cas.set_vol(0.5)
+        cas.play(paths[0])
+        assert abs(cas.get_vol() - 0.5 * 10 ** (-6 / 20)) < 1e-6
+        cas.play(paths[1])
+        assert abs(cas.get_vol() - min(1.0, 0.5 * 10 ** (expected_gain(4000) / 20))) < 1e-6
+
+        cas.play(paths[0])
+        cas.set_vol(0.2)        # user's level now 0.2 / factor
+        cas.play(paths[2])
+        assert abs(cas.get_vol() - 0.2 * 10 ** ((expected_gain(16000) + 6) / 20)) < 1e-6
+
+        cas.vol_toggle_mute()
+        cas.play(paths[0])
+        assert cas.get_vol() == 0       # stays muted
+        cas.vol_toggle_mute()
+        assert abs(cas.get_vol() - 0.2) < 1e-6
+
+        cas.play_album("Album 00")
+        assert cas.playlist_album_mode
+        assert abs(cas.get_vol() - min(1.0, 0.2 * 10 ** ((album_gain + 6) / 20))) < 1e-6
+        cas.stop()
+    finally:
+        server.shutdown()
+
+def test21(tmp_path, monkeypatch):
+    """
+        Media stream pacing: burst then bitrate-paced, bandwidth shared between streams (no device needed)
+    """
+    import http.client
+    module = sys.modules[__name__]
+    monkeypatch.setattr(module, 'theTracks', TrackTable())
+    paths = make_synthetic_library(str(tmp_path / "lib"), 2, seconds=2)    # 128kbps: 16000 bytes/s
+    sizes = [os.path.getsize(p) for p in paths]
+    server = _start_test_server(monkeypatch, str(tmp_path), str(tmp_path))
+    ids = [theTracks.register(p) for p in paths]
+
+    def get(tid, results, i):
+        start = time.perf_counter()
+        conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1])
+        conn.request("GET", "/t/" + tid)
+        body = conn.getresponse().read()
+        conn.close()
+        results[i] = (len(body), time.perf_counter() - start)
+
+    try:
+        pacer = StreamPacer(rate_multiple=1.0, burst_seconds=0.5)
+        monkeypatch.setattr(module, 'thePacer', pacer)
+        assert pacer.get_bitrate(paths[0]) == 128000
+        results = {}
+        get(ids[0], results, 0)
+        expected = (sizes[0] - 8000) / 16000      # after the 0.5s (8000 byte) burst
+        assert results[0][0] == sizes[0]
+        assert expected * 0.8 < results[0][1] < expected + 1
+
+        # 2 streams limited to 32000 bytes/s in total, both finish together
+        pacer.rate_multiple = 4.0
+        pacer.max_bandwidth = 32000
+        pacer.burst_seconds = 0
+        threads = [threading.Thread(target=get, args=(tid, results, i)) for i, tid in enumerate(ids)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        expected = sum(sizes) / 32000
+        times = [results[i][1] for i in range(2)]
+        assert all(expected * 0.8 < t < expected + 1 for t in times)
+        assert abs(times[0] - times[1]) < 0.5
+        end = time.time() + 1
+        while pacer.active and time.time() < end:  # handlers finishing up
+            time.sleep(0.01)
+        assert pacer.active == 0
+
+        pacer.rate_multiple = 0     # unpaced
+        start = time.perf_counter()
+        get(ids[0], results, 0)
+        assert time.perf_counter() - start < 0.5
+    finally:
+        server.shutdown()
+
+
+def test22(tmp_path, monkeypatch):
+    """
+        play_folder starts within its time budget, the rest of the walk is shuffled in (no device needed)
+    """
+    module = sys.modules[__name__]
+    monkeypatch.setattr(module, 'theTracks', TrackTable())
+    paths = make_synthetic_library(str(tmp_path / "lib"), 40, seconds=1, cover=False)
+    real_find_tracks = find_tracks
+    def slow_find_tracks(folder):
+        for path in real_find_tracks(folder):
+            time.sleep(0.02)    # a slow (network) drive
+            yield path
+    monkeypatch.setattr(module, 'find_tracks', slow_find_tracks)
+    server = _start_test_server(monkeypatch, "/", str(tmp_path))
+    try:
+        cas = CcAudioStreamer(FakeChromecast(speed=0.1))
+        start = time.perf_counter()
+        cas.play_folder(str(tmp_path / "lib"), start_budget=0.2)
+        assert time.perf_counter() - start < 0.6
+        playlist = cas.get_playlist()
+        first = playlist[0]
+        assert not playlist.scan.done and 0 < playlist.scan.found < len(paths)
+        assert cas.prev_filename == first
+
+        # library update during the walk: not added twice when the walk reaches it
+        with cas.playlist_lock:
+            late = [p for p in paths if p not in cas.get_playlist()][-1]
+        cas.update_playlist(added=[late])
+        end = time.time() + 10
+        while not cas.get_playlist().scan.done and time.time() < end:
+            time.sleep(0.05)
+        playlist = cas.get_playlist()
+        assert playlist.scan.done and playlist.scan.found == len(paths) - 1
+        assert sorted(playlist) == sorted(paths)
+        assert playlist[0] == first     # playing track stays put
+        assert playlist != sorted(playlist)
+
+        # a new playlist stops the walk of the previous folder
+        cas.play_folder(str(tmp_path / "lib"), start_budget=0.1)
+        scan = cas.get_playlist().scan
+        cas.play_list(paths[:2])
+        found = scan.found
+        time.sleep(0.2)
+        assert scan.found == found and not scan.done
+        assert cas.get_playlist() == paths[:2]
+        cas.stop()
+    finally:
+        server.shutdown()
+
+def test23(tmp_path, monkeypatch):
+    """
+        .m3u/.m3u8 playlists: entries resolved via the library, missing reported, export (no device needed)
+    """
+    module = sys.modules[__name__]
+    library = LibraryIndex()
+    monkeypatch.setattr(module, 'theLibrary', library)
+    monkeypatch.setattr(module, 'theTracks', TrackTable())
+    paths = make_synthetic_library(str(tmp_path / "lib"), 6, seconds=1, cover=False)
+    library.scan(str(tmp_path / "lib"), LibraryScanner(workers=1))
+    outside = tmp_path / "other" / "Caf\xe9.mp3"
+    outside.parent.mkdir()
+    shutil.copy(paths[0], str(outside))
+
+    m3u = tmp_path / "lib" / "mix.m3u"
+    rel = [os.path.relpath(p, str(tmp_path / "lib")) for p in paths]
+    m3u.write_bytes(codecs.BOM_UTF8 + "\n".join([
+        "#EXTM3U",
+        "#EXTINF:1,Artist 00 - Track 0000",
+        rel[0],
+        "",
+        paths[1],                                   # absolute
+        "file://" + urllib.parse.quote(paths[2]),
+        rel[3].replace("/", "\\"),                  # written on Windows
+        "Artist 99/gone.mp3",                       # under the library, not indexed
+        "http://example.com/stream.mp3",
+        "../other/Caf\xe9.mp3",
+        ]).encode('utf-8') + b"\n../other/Caf\xe9.mp3\n")  # Latin-1 line
+    filelist, missing = load_m3u(str(m3u))
+    assert filelist == paths[:4] + [str(outside)] * 2
+    assert missing == [os.path.join(str(tmp_path / "lib"), "Artist 99", "gone.mp3"), "http://example.com/stream.mp3"]
+    # entries outside the roots can't be served, so are missing (rather than failing on play)
+    theTracks.set_roots([str(tmp_path / "lib")])
+    filelist, missing = load_m3u(str(m3u))
+    assert filelist == paths[:4] and missing[2:] == [str(outside)] * 2
+
+    # 50k entries load in well under a second
+    big = tmp_path / "lib" / "big.m3u8"
+    big.write_text("\n".join(rel * 8334), encoding='utf-8')
+    start = time.perf_counter()
+    filelist, missing = load_m3u(str(big))
+    assert len(filelist) == 50004 and not missing
+    assert time.perf_counter() - start < 1.0
+
+    # export the current playlist, from the current track
+    cas = CcAudioStreamer(FakeChromecast())
+    cas.playlist = list(reversed(paths))
+    cas.playlist_index = 2
+    out = tmp_path / "lib" / "saved.m3u8"
+    assert cas.export_m3u(str(out)) == len(paths)
+    text = out.read_text(encoding='utf-8')
+    assert text.startswith("#EXTM3U\n#EXTINF:1,Artist")
+    assert [line for line in text.splitlines() if not line.startswith("#")][0] == rel[3]
+    assert load_m3u(str(out)) == (paths[3::-1] + paths[:3:-1], [])
+
+    player = InteractivePlayer.__new__(InteractivePlayer)   # skip device discovery
+    player.playlist_folder = str(tmp_path / "lib")
+    assert player._playlist_file("saved.m3u8") == str(out)
+    import pytest
+    for name in ("../x.m3u", "/etc/x.m3u8", "saved.txt"):
+        with pytest.raises(ValueError):
+            player._playlist_file(name)
+
+def test24(tmp_path, monkeypatch):
+    """
+        Up-next queue: queued tracks play before the playlist, prev goes back through them (no device needed)
+    """
+    module = sys.modules[__name__]
+    library = LibraryIndex()
+    monkeypatch.setattr(module, 'theLibrary', library)
+    monkeypatch.setattr(module, 'theTracks', TrackTable())
+    paths = make_synthetic_library(str(tmp_path / "lib"), 8, seconds=1, n_artists=1, cover=False)
+    library.scan(str(tmp_path / "lib"), LibraryScanner(workers=1))
+    server = _start_test_server(monkeypatch, "/", str(tmp_path))
+    try:
+        cas = CcAudioStreamer(FakeChromecast(speed=0.1))
+        playlist = paths[:4]
+        cas.play_list(playlist)
+        ids = cas.enqueue([paths[4], paths[5]])
+        cas.enqueue([paths[6]], play_next=True)
+        assert [tid for tid, _ in cas.get_up_next()] == [theTracks.register(paths[6])] + ids
+        assert cas.get_playlist() is playlist and cas.get_playlist_index() == 0
+
+        played = [cas.prev_filename]
+        for _ in range(4):
+            cas.next_track()
+            played.append(cas.prev_filename)
+        assert played == [paths[0], paths[6], paths[4], paths[5], paths[1]]   # library paths, for gain etc.
+        cas.prev_track()    # back to the last queued track, which is queued again
+        assert cas.prev_filename == paths[5] and cas.get_playlist_index() == 0
+        cas.prev_track()
+        assert cas.prev_filename == paths[4]
+        assert [path for _, path in cas.get_up_next()] == [paths[5]]
+        cas.next_track()
+        cas.next_track()
+        assert cas.prev_filename == paths[1] and not cas.get_up_next()
+        cas.stop()
 
+        # queued tracks are played as tracks finish
+        cas = CcAudioStreamer(FakeChromecast(speed=20))
+        cas.play_list(paths[:2])
+        cas.enqueue([paths[7]], play_next=True)
+        end = time.time() + 10
+        while cas.get_playlist_index() != 1 and time.time() < end:
+            time.sleep(0.02)
+        assert paths[7] in [entry[0] for entry in cas.track_history]
+        cas.stop()
 
+        # API commands
+        monkeypatch.setattr(module, 'FAKE_DEVICES', 1)
+        player = InteractivePlayer(str(tmp_path / "lib"), watch_library=False)
+        player.run_commands([{'cmd': 'select_device', 'args': ['1']}])
+        results = player.run_commands([
+            {'cmd': 'enqueue_album', 'args': ["Album 00", "Artist 00"]},
+            {'cmd': 'play_next', 'args': [theTracks.register(paths[3])]},
+            {'cmd': 'get_up_next'},
+            ])[0]
+        assert [r['ok'] for r in results] == [True] * 3
+        up_next = results[2]['result']
+        assert len(up_next) == 1 + len(library.filter(album="Album 00"))
+        assert up_next[0]['title'] == library.get(paths[3]).title
+        assert player.cas.get_up_next()[0][1] == paths[3]     # queued by ID, played by library path
+        results = player.run_commands([{'cmd': 'clear_up_next'}, {'cmd': 'get_up_next'},
+            {'cmd': 'enqueue', 'args': ["/no/such/track.mp3"]}])[0]
+        assert results[1]['result'] == [] and "Invalid file" in results[2]['error']
+    finally:
+        server.shutdown()
+
+def test25(tmp_path, monkeypatch):
+    """
+        Status recording and replay through new_media_status (no device needed)
+    """
+    module = sys.modules[__name__]
+    monkeypatch.setattr(module, 'theTracks', TrackTable())
+    paths = make_synthetic_library(str(tmp_path / "lib"), 3, seconds=1, cover=False)
+    server = _start_test_server(monkeypatch, "/", str(tmp_path))
+    try:
+        cas = CcAudioStreamer(FakeChromecast(speed=5))
+        recording = str(tmp_path / "fake.s2s.gz")
+        recorder = StatusRecorder(recording, cas.get_name(), cas.state)
+        cas.status_listeners.append(recorder)
+        cas.play_list(paths)
+        end = time.time() + 10
+        while cas.get_playlist_index() != 2 and time.time() < end:
+            time.sleep(0.02)
+        cas.next_track()    # interrupts the last track
+        time.sleep(0.2)
+        cas.stop()
+        recorder.close()
+    finally:
+        server.shutdown()
+
+    header, rows = load_status_recording(recording)
+    assert header['device'] == "Fake Chromecast" and len(rows) == recorder.events > 6
+    report = replay_status_recording(recording, paths)
+    assert report['events'] == len(rows) and report['mismatches'] == []
+    messages = [msg for _, msg in report['transitions']]
+    advances = len(cas.cc.loads) - 2    # (less first track, next_track)
+    assert advances >= 2 and messages.count("Status: FINISHED") == report['advances'] == advances
+    assert report['us_p50'] <= report['us_p99'] <= report['us_max']
+    assert len(replay_status_recording(recording, paths, slow_ms=0)['slow']) == len(rows)
+
+    # replay command (a copy of this file, whose folder would get the history db): no history written
+    script = tmp_path / "bin" / os.path.basename(__file__)
+    script.parent.mkdir()
+    shutil.copy(__file__, str(script))
+    result = subprocess.run([sys.executable, str(script), "--folder", str(tmp_path / "lib"), "replay", recording],
+            cwd=str(tmp_path), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=60)
+    assert result.returncode == 0, result.stdout
+    assert not os.path.exists(str(script.parent / "s2c_history.db"))
+
+    # hand-written: PLAYING/INTERRUPTED 2+ seconds apart is a new song, a state regression is reported
+    handmade = str(tmp_path / "handmade.s2s")
+    with open(handmade, 'w') as f:
+        f.write(json.dumps({'format': STATUS_RECORDING_FORMAT, 'device': "Kitchen", 'state': 'IDLE',
+            'fields': ['state', 'player_state', 'idle_reason']}) + "\n")
+        for row in ([0.0, 'BUFFERING', 'BUFFERING', None], [0.5, 'PLAYING', 'PLAYING', None],
+                [1.0, 'PLAYING', 'PLAYING', 'INTERRUPTED'], [2.0, 'PLAYING', 'PLAYING', 'INTERRUPTED'],
+                [4.5, 'PLAYING', 'PLAYING', 'INTERRUPTED'], [5.0, 'PAUSED', 'PAUSED', None],
+                [6.0, 'PLAYING', 'PLAYING', 'INTERRUPTED'], [7.0, 'PLAYING', 'IDLE', 'CANCELLED']):
+            f.write(json.dumps(row) + "\n")
+    report = replay_status_recording(handmade, paths)
+    assert [t for t, msg in report['transitions'] if msg.startswith("Status: STARTED_NEW_SONG")] == [4.5]
+    assert "Status: RESUMED" in [msg for _, msg in report['transitions']]
+    assert report['mismatches'] == [(7, 7.0, 'PLAYING', 'IDLE')]
+    lines = []
+    print_replay_report(report, out=lines.append)
+    assert "1 state mismatches" in lines[0] and any("MISMATCH status 7" in line for line in lines)
+
+def test26(tmp_path, monkeypatch):
+    """
+        Memory watchdog: restart before the RSS ceiling, resuming the session in the new process (no device needed)
+    """
+    module = sys.modules[__name__]
+    monkeypatch.setattr(module, 'theTracks', TrackTable())
+    assert get_rss_kb() > 0
+
+    samples = iter([100 * 1024, 800 * 1024, 950 * 1024, 990 * 1024])
+    hits = []
+    watchdog = MemoryWatchdog(1000, hits.append, interval=0.01, min_uptime=0,
+            get_rss=lambda: next(samples, 0)).start()
+    watchdog.thread.join(5)
+    assert hits == [950 * 1024] and watchdog.peak_rss_kb == 950 * 1024
+    watchdog = MemoryWatchdog(1000, hits.append, interval=0.01, get_rss=lambda: 999 * 1024).start()
+    time.sleep(0.1)     # within MIN_UPTIME of starting: doesn't restart
+    watchdog.stop()
+    assert hits == [950 * 1024]
+
+    paths = make_synthetic_library(str(tmp_path / "lib"), 4, seconds=10, cover=False)
+    server = _start_test_server(monkeypatch, "/", str(tmp_path))
+    try:
+        cas = CcAudioStreamer(FakeChromecast(speed=2))
+        cas.play_list(paths)
+        cas.next_track()
+        cas.enqueue([paths[3]])
+        cas.set_vol(0.3)
+        cas.vol_toggle_mute()
+        time.sleep(0.3)
+        state = cas.get_handoff_state()
+        assert state['playlist_index'] == 1 and state['volume'] == 0.3 and state['muted']
+        assert 0 < state['position'] < 10
+
+        # before the exec: queued log records written out, the terminal's settings restored
+        execs = []
+        terminal = []
+        monkeypatch.setattr(os, 'execv', lambda path, argv: execs.append((argv, logging_queue.empty())))
+        monkeypatch.setattr(NonBlockingConsole, 'saved_settings', ['cooked'])
+        monkeypatch.setattr(termios, 'tcsetattr', lambda fd, when, settings: terminal.append(settings))
+        monkeypatch.delenv(HANDOFF_ENV, raising=False)
+        try:
+            restart_with_handoff(state, argv=["python3", "stream2cca.py", "serve"])
+        finally:
+            logging_listener.start()    # (no exec)
+        assert execs == [(["python3", "stream2cca.py", "serve"], True)] and terminal == [['cooked']]
+        with open(logging_fh.baseFilename) as f:
+            assert "Restarting (pid %d) with session handoff" % os.getpid() in f.read()
+        handoff_file = os.environ[HANDOFF_ENV]
+        cas.stop()
+        time.sleep(0.2)     # (the restart)
+
+        handoff = read_handoff()
+        assert HANDOFF_ENV not in os.environ and not os.path.exists(handoff_file)
+        assert handoff['restarts'] == 1 and read_handoff() is None
+        cas2 = CcAudioStreamer(FakeChromecast(handoff['device'], speed=2))
+        cas2.restore_handoff_state(handoff)
+        assert cas2.get_playlist() == paths and cas2.get_playlist_index() == 1
+        assert cas2.prev_filename == paths[1] and cas2.cc.loads
+        assert [path for _, path in cas2.get_up_next()] == [paths[3]]
+        assert cas2.cc.media_controller.position >= state['position'] + 0.2   # played on during the restart
+        assert cas2.muted and cas2.get_vol() == 0
+        cas2.vol_toggle_mute()
+        assert abs(cas2.get_vol() - 0.3) < 1e-6
+        cas2.stop()
+    finally:
+        server.shutdown()
+
+def test27(tmp_path, monkeypatch):
+    """
+        Media served by separate processes, track IDs looked up from the control process (no device needed)
+    """
+    import http.client
+    module = sys.modules[__name__]
+    monkeypatch.setattr(module, 'theTracks', TrackTable())
+    paths = make_synthetic_library(str(tmp_path / "lib"), 2, seconds=2)
+    server = _start_test_server(monkeypatch, "/", str(tmp_path))
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    media_port = sock.getsockname()[1]
+    sock.close()
+    media = MediaProcesses(2, media_port, ['--gain', 'off', '--no_history', '--stream_rate', '0', '--no_transcode'])
+
+    def get(path):
+        conn = http.client.HTTPConnection("127.0.0.1", media_port, timeout=10)
+        conn.request("GET", path)
+        response = conn.getresponse()
+        body = response.read()
+        conn.close()
+        return response.status, response.getheader('Content-type'), body
+
+    try:
+        media.CHECK_INTERVAL = 0.1
+        media.start()
+        assert media.wait_ready()
+        tid = theTracks.register(paths[0])
+        with open(paths[0], "rb") as f:
+            assert get("/t/" + tid) == (200, 'audio/mpeg', f.read())
+        status, content_type, body = get("/a/" + tid)
+        assert status == 200 and content_type == 'image/jpeg' and body == read_track_art(paths[0])
+        conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=10)
+        conn.request("GET", "/a/" + tid)
+        response = conn.getresponse()
+        assert response.read() == body and response.msg.get_all("Cache-Control") == ["max-age=3600"]
+        conn.close()
+        assert get("/t/0123456789abcdef")[0] == 404
+        assert get("/")[0] == 404 and get("/metrics")[0] == 404  # control side only
+
+        # a device plays from the media processes
+        monkeypatch.setattr(module, 'MEDIA_PORT', media_port)
+        cas = CcAudioStreamer(FakeChromecast(speed=20))
+        cas.play(paths[1])
+        assert cas.cc.loads[-1].startswith("http://127.0.0.1:%d/t/" % media_port)
+        end = time.time() + 10
+        while cas.cc.bytes_fetched < os.path.getsize(paths[1]) and time.time() < end:
+            time.sleep(0.02)
+        assert cas.cc.bytes_fetched == os.path.getsize(paths[1])
+        cas.stop()
 
+        # a media process that dies is restarted
+        media.processes[0].kill()
+        end = time.time() + 10
+        while media.restarts == 0 and time.time() < end:
+            time.sleep(0.05)
+        assert media.restarts == 1 and media.wait_ready()
+        for _ in range(4):
+            assert get("/t/" + tid)[0] == 200
+    finally:
+        media.stop()
+        server.shutdown()
+    assert all(process.poll() is not None for process in media.processes)
+    assert not os.path.exists(media.socket_dir)
+
+def test28(tmp_path, monkeypatch):
+    """
+        Server benchmark smoke test: runs the serve command in a subprocess (no device needed)
+    """
+    monkeypatch.chdir(tmp_path)
+    output = str(tmp_path / "results.json")
+    results = bench_server(n_receivers=1, n_clients=2, seconds=1, n_tracks=3, poll_interval=0.1,
+            output=output)
+    with open(output) as f:
+        assert json.load(f)['git_hash'] == results['git_hash']
+    endpoints = results['endpoints']
+    for endpoint in ("GET media", "POST get_status"):
+        assert endpoints[endpoint]['requests'] > 0 and endpoints[endpoint]['errors'] == 0
+    assert results['media_mb_per_s'] > 0
+    # the server ran from a copy in its own folder, only its log is written here
+    assert sorted(os.listdir(str(tmp_path))) == ["results.json", "s2c.bench.log"]
+
+def test29(tmp_path, monkeypatch):
+    """
+        Track-transition timings in the status, a failed play isn't charged to the next one (no device needed)
+    """
+    import pytest
+    paths = make_synthetic_library(str(tmp_path / "lib"), 3, seconds=2)
+    web_folder = tmp_path / "web"
+    web_folder.mkdir()
+    server = _start_test_server(monkeypatch, "/", str(web_folder))
+    player = InteractivePlayer.__new__(InteractivePlayer)   # skip device discovery
+    player.lock = threading.RLock()
+    player.connected = True
+    player.status_epoch = "e"
+    player.status_version = 0
+    player.status_history = collections.deque(maxlen=32)
+    try:
+        player.cas = CcAudioStreamer(FakeChromecast(speed=20))
+        assert player.get_status()[9] == ""     # none measured yet
+        version = player.get_status_since("")[0]
+
+        player.cas.play_list(list(paths))
+        end = time.time() + 10
+        while player.cas.transitions.summary()['count'] < 2 and time.time() < end:
+            time.sleep(0.05)
+        player.cas.stop()
+        transitions = player.get_status()[9]
+        assert re.fullmatch(r"gap p50 \d+\.\d{3}s p90 \d+\.\d{3}s \((%s)\)" % "|".join(TransitionStats.PHASES),
+                transitions), transitions
+        assert 9 in player.get_status_since(version)[2]     # (changed field in the delta)
+
+        count = player.cas.transitions.summary()['count']
+        player.cas.playlist = []    # (no advancing after the manual play)
+        player.cas.transition = TransitionTimer(0)
+        with pytest.raises(AssertionError, match="Invalid file"):
+            player.cas.play(str(tmp_path / "missing.mp3"))
+        assert player.cas.transition is None
+        player.cas.play(paths[0])
+        time.sleep(0.2)
+        player.cas.stop()
+        assert player.cas.transitions.summary()['count'] == count
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test30(tmp_path):
+    """
+        CLI playfile through a separately running server, for a track outside its library (no device needed)
+    """
+    import http.client
+    lib = make_synthetic_library(str(tmp_path / "libA"), 1, seconds=1)
+    other = make_synthetic_library(str(tmp_path / "other"), 1, seconds=1)[0]
+    for folder in ("server", "cli"):
+        (tmp_path / folder).mkdir()
+    with socket.socket() as s:     # pick a free port
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    common_args = ["--port", str(port), "--fake_devices", "1", "-d", "Fake Audio 1", "--no_history",
+            "--gain", "off", "--no_transcode"]
+    script = _copy_web_page(str(tmp_path / "bin"))    # (the server writes cover.jpg next to it)
+
+    def request(method, path, body=None):
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+        conn.request(method, path, body=body)
+        response = conn.getresponse()
+        data = response.read()
+        conn.close()
+        return response.status, data
+
+    server = subprocess.Popen([sys.executable, script, "serve", "-f", str(tmp_path / "libA"), "--no_watch"]
+            + common_args, cwd=str(tmp_path / "server"), stdout=subprocess.DEVNULL, stdin=subprocess.DEVNULL)
+    try:
+        end = time.time() + 30
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                assert time.time() < end and server.poll() is None, "server failed to start"
+                time.sleep(0.1)
+        while request("GET", "/t/" + track_id(lib[0]))[0] != 200 and time.time() < end:
+            time.sleep(0.1)     # (registered by the library scan)
+        assert request("GET", "/t/" + track_id(lib[0]))[0] == 200
+        assert request("GET", "/t/" + track_id(other))[0] == 404
+
+        cli = subprocess.run([sys.executable, script] + common_args + ["playfile", other],
+                cwd=str(tmp_path / "cli"), stdout=subprocess.DEVNULL, stdin=subprocess.DEVNULL, timeout=60)
+        assert cli.returncode == 0
+        status, data = request("GET", "/t/" + track_id(other))
+        with open(other, "rb") as f:
+            assert status == 200 and data == f.read()
+
+        # only track files
+        status, data = request("POST", "/tracks", json.dumps([str(tmp_path / "cli" / "ip_address.js")]))
+        assert status == 200 and "Not a track file" in json.loads(data)[0]['error']
+        assert request("POST", "/tracks", "not json")[0] == 400
+    finally:
+        server.terminate()
+        server.wait()
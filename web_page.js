@@ -22,245 +22,272 @@ function set_status_interval(){
 }
 
 function vol_toggle_mute(){
-    Http = new XMLHttpRequest();
-    Http.open("POST", url, true);
-    Http.setRequestHeader('Content-type', 'application/x-www-form-urlencoded');
-    Http.send("volume_toggle_mute");
-
-    // refresh status upon server response
-    Http.onreadystatechange = (e) => {
-        if (Http.readyState === XMLHttpRequest.DONE) {
-            get_status();
-        }
-    }
+    send_commands([{cmd: "volume_toggle_mute"}]);
 }
 
 function vol_down(){
-    //alert("Vol - from JS");
-    Http = new XMLHttpRequest();
-    Http.open("POST", url, true);
-    Http.setRequestHeader('Content-type', 'application/x-www-form-urlencoded');
-    Http.send("volume_down");
-
-    // refresh status upon server response
-    Http.onreadystatechange = (e) => {
-        if (Http.readyState === XMLHttpRequest.DONE) {
-            get_status();
-        }
-    }
+    send_commands([{cmd: "volume_down"}]);
 }
 
 function vol_up(){
-    //alert("Vol + from JS");
-    Http = new XMLHttpRequest();
-    Http.open("POST", url, true);
-    Http.setRequestHeader('Content-type', 'application/x-www-form-urlencoded');
-    Http.send("volume_up");
-
-    // refresh status upon server response
-    Http.onreadystatechange = (e) => {
-        if (Http.readyState === XMLHttpRequest.DONE) {
-            get_status();
-        }
-    }
+    send_commands([{cmd: "volume_up"}]);
 }
 
 function prev_track(){
-    Http = new XMLHttpRequest();
-    Http.open("POST", url, true);
-    Http.setRequestHeader('Content-type', 'application/x-www-form-urlencoded');
-    Http.send("prev_track");
-
-    // refresh status upon server response
-    Http.onreadystatechange = (e) => {
-        if (Http.readyState === XMLHttpRequest.DONE) {
-            get_status();
-        }
-    }
+    send_commands([{cmd: "prev_track"}]);
 }
 
 function next_track(){
-    Http = new XMLHttpRequest();
-    Http.open("POST", url, true);
-    Http.setRequestHeader('Content-type', 'application/x-www-form-urlencoded');
-    Http.send("next_track");
-
-    // refresh status upon server response
-    Http.onreadystatechange = (e) => {
-        if (Http.readyState === XMLHttpRequest.DONE) {
-            get_status();
-        }
-    }
+    send_commands([{cmd: "next_track"}]);
 }
 
 function play_pause_resume(){
-    Http = new XMLHttpRequest();
-    Http.open("POST", url, true);
-    Http.setRequestHeader('Content-type', 'application/x-www-form-urlencoded');
-    Http.send("play_pause_resume");
-
-    // refresh status upon server response
-    Http.onreadystatechange = (e) => {
-        if (Http.readyState === XMLHttpRequest.DONE) {
-            get_status();
-        }
+    send_commands([{cmd: "play_pause_resume"}]);
+}
+
+// up-next queue: tracks queued to play before the rest of the playlist
+function enqueue_album(){
+    if (status_cache) {
+        [connected, device, volume, artist, title, album] = status_cache;
+        send_commands([{cmd: "enqueue_album", args: [album, artist]}, {cmd: "get_up_next"}]);
     }
 }
 
-function get_status(){
-    // This gets called at regular intervals (currently every 1000 ms)
-    Http = new XMLHttpRequest();
-    Http.open("POST", url, true);
-    Http.setRequestHeader('Content-type', 'application/x-www-form-urlencoded');
-    Http.send("get_status");
-
-    Http.onreadystatechange = (e) => {
-        if (Http.readyState === XMLHttpRequest.DONE) {
-            MAX_LEN = 39;
-            NBSP = "\xa0";  // Non-breaking space
-            BOLD = "<b>";
-            BOLD_END = "</b>";
-            ITALIC = "<i>";
-            ITALIC_END = "</i>";
-            status_text = Http.responseText;
-            status_array = status_text.split(/\r?\n/);
-//          console.log(status_array);
-
-            function scroll_text(full_track_status) {
-                extended_track_status = full_track_status + NBSP.repeat(3);
-                len_extended = extended_track_status.length;
-                // first part
-                end_index = Math.min(...[len_extended, this.scroll_index + MAX_LEN]);
-                first_part = extended_track_status.substring(this.scroll_index, end_index);
-                // second part
-                second_part = "";
-                len_second = MAX_LEN - first_part.length;
-                if (len_second > 0) {
-                    second_part += extended_track_status.substring(0, len_second);
+function clear_up_next(){
+    send_commands([{cmd: "clear_up_next"}, {cmd: "get_up_next"}]);
+}
+
+function show_up_next(tracks){
+    text = "";
+    if (tracks.length > 0) {
+        text = "Up next (" + tracks.length + "): " + tracks[0].artist + " - " + tracks[0].title;
+    }
+    document.getElementById('up_next').innerHTML = text.split(' ').join("\xa0");
+}
+
+// run commands via the JSON control API, in order and in one request
+// - e.g. send_commands([{cmd: "select_device", args: ["2"]}, {cmd: "set_volume", args: [0.2]}])
+// - the response includes the resulting status, so no separate get_status is needed
+function send_commands(commands){
+    const http = new XMLHttpRequest();
+    http.open("POST", url + "/api/v1", true);
+    http.setRequestHeader('Content-type', 'text/plain');   // (avoids a CORS preflight)
+    http.send(JSON.stringify({commands: commands}));
+
+    http.onreadystatechange = (e) => {
+        if (http.readyState === XMLHttpRequest.DONE) {
+            if (http.status != 200) {
+                get_status();
+                return;
+            }
+            const response = JSON.parse(http.responseText);
+            for (const result of response.results) {
+                if (!result.ok) {
+                    console.log("Command " + result.cmd + " failed: " + result.error);
                 }
-                track_status = first_part + second_part;
-                this.scroll_index += 1;
-                if (this.scroll_index > len_extended) {
-                    this.scroll_index = 0;
+                else if (result.cmd == "get_up_next") {
+                    show_up_next(result.result || []);
                 }
-
-                return track_status;
             }
+            status_version = response.version;
+            status_cache = response.status;
+            show_status(status_cache);
+        }
+    }
+}
 
-            [connected, device, volume, artist, title, album, current_time, duration, paused] = status_array;
+// last status received from server, and its version
+// - sent with get_status so server can reply "not modified" (304) or with just the changed fields
+var status_version = "";
+var status_cache = null;
 
-            if (current_time.length > 0 && duration.length > 0) {
-                playback_len = current_time.length + duration.length + 1;
-                playback = current_time + BOLD + "/" + BOLD_END + duration;
+function get_status(){
+    // This gets called at regular intervals (currently every 1000 ms)
+    const http = new XMLHttpRequest();
+    http.open("POST", url, true);
+    http.setRequestHeader('Content-type', 'application/x-www-form-urlencoded');
+    http.send("get_status " + (status_cache ? status_version : ""));
+
+    http.onreadystatechange = (e) => {
+        if (http.readyState === XMLHttpRequest.DONE) {
+            if (http.status == 304) {
+                // not modified: only need to redraw if the track info is scrolling
+                if (status_cache && status_needs_scrolling(status_cache)) {
+                    show_status(status_cache);
+                }
+                return;
             }
-            else {
-                playback = "";
-                playback_len = playback.length;
+            if (http.status != 200) {
+                return;
             }
-
-            // status line 0:
-            // 0123456789012345678901234567890123456789
-            // device_name        vol       ee:ee/dd:dd
-            line0_len = device.length + volume.length + playback_len;
-            device = BOLD + device + BOLD_END;
-            if (connected == "1") {
-                if (line0_len >= MAX_LEN - 2) {
-                    line0 = device + NBSP + volume + NBSP + playback;
-                }
-                else {
-                    spacer0_len = Math.floor((MAX_LEN - line0_len) / 2);
-                    spacer1_len = MAX_LEN - line0_len - spacer0_len;
-                    spacer0 = NBSP.repeat(spacer0_len);
-                    spacer1 = NBSP.repeat(spacer1_len);
-                    line0 = device + spacer0 + volume + spacer1 + playback;
-    //              console.log("Spacers:" + spacer0_len + spacer1_len)
+            const lines = http.responseText.split(/\r?\n/);
+            status_version = lines[0];
+            if (lines[1] == "D" && status_cache) {
+                // delta: "index=value" per changed field
+                status_cache = status_cache.slice();
+                for (const line of lines.slice(2)) {
+                    const sep = line.indexOf("=");
+                    status_cache[parseInt(line.substring(0, sep))] = line.substring(sep + 1);
                 }
             }
             else {
-                DISCONNECTED_CH = "\u2716"; // ✖
-                line0 = device + " " + DISCONNECTED_CH + " Disconnected. Click to Scan Devices " + DISCONNECTED_CH;
+                status_cache = lines.slice(2);
             }
-            document.getElementById('status0').innerHTML = line0;
+            show_status(status_cache);
+        }
+    }
+}
 
-            if ((connected == "0") || (playback == "")){
-                document.getElementById('play_pause_img').src = "imgs/ipod-old.png";
-            }
-            else {
-                // set play/pause button image appropriately
-                if (paused == "0") {
-                    document.getElementById('play_pause_img').src = "imgs/icons8-pause-button-96.png";
-                }
-                else {
-                    document.getElementById('play_pause_img').src = "imgs/icons8-circled-play-96.png";
-                }
-            }
+const STATUS_MAX_LEN = 39;
+
+function status_needs_scrolling(status_array){
+    [connected, device, volume, artist, title, album, current_time, duration, paused] = status_array;
+    return (connected == "1") && (artist.length + title.length + album.length + 6 > STATUS_MAX_LEN);
+}
 
+function show_status(status_array){
+    MAX_LEN = STATUS_MAX_LEN;
+    NBSP = "\xa0";  // Non-breaking space
+    BOLD = "<b>";
+    BOLD_END = "</b>";
+    ITALIC = "<i>";
+    ITALIC_END = "</i>";
+//  console.log(status_array);
+
+    function scroll_text(full_track_status) {
+        extended_track_status = full_track_status + NBSP.repeat(3);
+        len_extended = extended_track_status.length;
+        // first part
+        end_index = Math.min(...[len_extended, this.scroll_index + MAX_LEN]);
+        first_part = extended_track_status.substring(this.scroll_index, end_index);
+        // second part
+        second_part = "";
+        len_second = MAX_LEN - first_part.length;
+        if (len_second > 0) {
+            second_part += extended_track_status.substring(0, len_second);
+        }
+        track_status = first_part + second_part;
+        this.scroll_index += 1;
+        if (this.scroll_index > len_extended) {
+            this.scroll_index = 0;
+        }
 
-            // status line 1:
-            // artist - title (album)
+        return track_status;
+    }
 
-            // Initialize a static variable for scroll index
-            if (typeof this.scroll_index == 'undefined') {
-                this.scroll_index = 0;
-                this.prev_track = "";
-            }
+    [connected, device, volume, artist, title, album, current_time, duration, paused] = status_array;
 
-            track_status = "";
-            full_track_status = "";
+    if (current_time.length > 0 && duration.length > 0) {
+        playback_len = current_time.length + duration.length + 1;
+        playback = current_time + BOLD + "/" + BOLD_END + duration;
+    }
+    else {
+        playback = "";
+        playback_len = playback.length;
+    }
 
-            var bHasActiveTrack = false;
-            if (connected == "1") {
-                // "ARTIST - TITLE (ALBUM)"
-                // Unfortunately: scroller implmentations doesn't like formatted text...
-                // track = BOLD + artist + BOLD_END + " - " + title + ITALIC + " (" + album + ")" + ITALIC_END;
-                track = artist + " - " + title + " (" + album + ")";
+    // status line 0:
+    // 0123456789012345678901234567890123456789
+    // device_name        vol       ee:ee/dd:dd
+    line0_len = device.length + volume.length + playback_len;
+    device = BOLD + device + BOLD_END;
+    if (connected == "1") {
+        if (line0_len >= MAX_LEN - 2) {
+            line0 = device + NBSP + volume + NBSP + playback;
+        }
+        else {
+            spacer0_len = Math.floor((MAX_LEN - line0_len) / 2);
+            spacer1_len = MAX_LEN - line0_len - spacer0_len;
+            spacer0 = NBSP.repeat(spacer0_len);
+            spacer1 = NBSP.repeat(spacer1_len);
+            line0 = device + spacer0 + volume + spacer1 + playback;
+    //              console.log("Spacers:" + spacer0_len + spacer1_len)
+        }
+    }
+    else {
+        DISCONNECTED_CH = "\u2716"; // ✖
+        line0 = device + " " + DISCONNECTED_CH + " Disconnected. Click to Scan Devices " + DISCONNECTED_CH;
+    }
+    document.getElementById('status0').innerHTML = line0;
 
-                // reset scroll_index when track changes
-                if (track != this.prev_track) {
-                    this.prev_track = track;
-                    this.scroll_index = 0;
-                }
+    if ((connected == "0") || (playback == "")){
+        document.getElementById('play_pause_img').src = "imgs/ipod-old.png";
+    }
+    else {
+        // set play/pause button image appropriately
+        if (paused == "0") {
+            document.getElementById('play_pause_img').src = "imgs/icons8-pause-button-96.png";
+        }
+        else {
+            document.getElementById('play_pause_img').src = "imgs/icons8-circled-play-96.png";
+        }
+    }
 
-                track_len = artist.length + title.length + album.length + 6;
-                full_track_status = track.split(' ').join(NBSP);
-                if (track_len <= MAX_LEN) {
-                    track_status = full_track_status;
-                }
-                else {
-                    track_status = scroll_text(full_track_status);
-                }
-                if (track_len > 6) {
-                    bHasActiveTrack = true;
-                }
-            }
-            document.getElementById('status1').innerHTML = track_status;
 
-            // Initialize a static variable for previous track
-            if (typeof this.prev_track_status == 'undefined') {
-                this.prev_track_status = "";
-            }
+    // status line 1:
+    // artist - title (album)
 
-            if (connected == "1") {
-                if (bHasActiveTrack) {
-                    // refresh img if track has changed
-                    if (this.prev_track_status.localeCompare(full_track_status) != 0) {
-                        // filter out spurious assignments of 'undefined' 
-                        // (not sure why we get these...)
-                        if ("undefined".localeCompare(full_track_status) != 0) {
-                            //console.log("Track status changed to: " + full_track_status)
-                            show_cover_img();
-                            this.prev_track_status = full_track_status;
-                        }
-                    }
-                }
-                else {
-                    show_flatline_img();
+    // Initialize a static variable for scroll index
+    if (typeof this.scroll_index == 'undefined') {
+        this.scroll_index = 0;
+        this.prev_track = "";
+    }
+
+    track_status = "";
+    full_track_status = "";
+
+    var bHasActiveTrack = false;
+    if (connected == "1") {
+        // "ARTIST - TITLE (ALBUM)"
+        // Unfortunately: scroller implmentations doesn't like formatted text...
+        // track = BOLD + artist + BOLD_END + " - " + title + ITALIC + " (" + album + ")" + ITALIC_END;
+        track = artist + " - " + title + " (" + album + ")";
+
+        // reset scroll_index when track changes
+        if (track != this.prev_track) {
+            this.prev_track = track;
+            this.scroll_index = 0;
+            send_commands([{cmd: "get_up_next"}]);     // (a queued track may have started)
+        }
+
+        track_len = artist.length + title.length + album.length + 6;
+        full_track_status = track.split(' ').join(NBSP);
+        if (track_len <= MAX_LEN) {
+            track_status = full_track_status;
+        }
+        else {
+            track_status = scroll_text(full_track_status);
+        }
+        if (track_len > 6) {
+            bHasActiveTrack = true;
+        }
+    }
+    document.getElementById('status1').innerHTML = track_status;
+
+    // Initialize a static variable for previous track
+    if (typeof this.prev_track_status == 'undefined') {
+        this.prev_track_status = "";
+    }
+
+    if (connected == "1") {
+        if (bHasActiveTrack) {
+            // refresh img if track has changed
+            if (this.prev_track_status.localeCompare(full_track_status) != 0) {
+                // filter out spurious assignments of 'undefined' 
+                // (not sure why we get these...)
+                if ("undefined".localeCompare(full_track_status) != 0) {
+                    //console.log("Track status changed to: " + full_track_status)
+                    show_cover_img();
+                    this.prev_track_status = full_track_status;
                 }
             }
-            else {
-                show_noise_img();
-            }
         }
+        else {
+            show_flatline_img();
+        }
+    }
+    else {
+        show_noise_img();
     }
 }
 
@@ -273,10 +300,10 @@ function scan_devices(){
         return;
     }
 
-    Http = new XMLHttpRequest();
-    Http.open("POST", url, true);
-    Http.setRequestHeader('Content-type', 'application/x-www-form-urlencoded');
-    Http.send("scan_devices");
+    const http = new XMLHttpRequest();
+    http.open("POST", url, true);
+    http.setRequestHeader('Content-type', 'application/x-www-form-urlencoded');
+    http.send("scan_devices");
 
     // Change the status0 display message
     NBSP = "\xa0";  // Non-breaking space
@@ -285,9 +312,9 @@ function scan_devices(){
 
     // set callback to handle server response
     clearInterval(status_interval); // disable the regular status pings until the response arrives
-    Http.onreadystatechange = (e) => {
-        if (Http.readyState === XMLHttpRequest.DONE) {
-            device_text = Http.responseText;
+    http.onreadystatechange = (e) => {
+        if (http.readyState === XMLHttpRequest.DONE) {
+            device_text = http.responseText;
             //console.log("scan_devices() DONE: " + device_text)
             showDynamicDropdown()
 
@@ -374,17 +401,7 @@ function deviceSelected() {
     deviceNum = dynamicDropdown.value;
 
     // send selected device to server!!
-    Http = new XMLHttpRequest();
-    Http.open("POST", url, true);
-    Http.setRequestHeader('Content-type', 'application/x-www-form-urlencoded');
-    Http.send("select_device "+deviceNum);
-
-    // refresh status upon server response
-    Http.onreadystatechange = (e) => {
-        if (Http.readyState === XMLHttpRequest.DONE) {
-            get_status();
-        }
-    }
+    send_commands([{cmd: "select_device", args: [deviceNum]}]);
 
     hideDynamicDropdown()
     //console.log("deviceSelected: " + deviceNum);